@@ -3,12 +3,22 @@
 __author__ = 'gotlium'
 __version__ = '1.1'
 
+import warnings
+from calendar import timegm
 from json import dumps, loads
 from datetime import datetime, timedelta
+from heapq import nlargest
+from itertools import islice
+from operator import itemgetter
+from weakref import WeakKeyDictionary
 
 from pytz import utc
 
+from metrics.cache import MISSING, LocalCache, cached_report
+from metrics.cleanup import KeysCleaner
 from metrics.redis_wrapper import RedisMetricsClient
+from metrics.sharding import is_distributed
+from metrics.scripts import UTM_SAVE_SCRIPT
 
 
 ADDITIONAL_STRUCT = ('id', 'type', 'label', 'count')
@@ -24,21 +34,76 @@ class MetricsAbstract(object):
     """
     variants_key = 'variants'
     namespace = 'metrics'
-
-    def __init__(self, variant_id, date_string, redis, save_variant=True):
+    version_key = ('version',)
+    track_version = False
+    hash_tag = False
+    cleaner_options = {}
+
+    # Opt-in compact layout: scalar counters & small maps of variant-day
+    # are packed into one hash with short field codes
+    compact = False
+    packed_key = ('packed',)
+    compact_fields = {}
+    compact_maps = {}
+
+    # HyperLogLog of visitors fingerprints
+    hll_key = ('hll_unique',)
+
+    # Opt-in sorted sets of top members (utm nodes, ips), they are
+    # incremented by the same writer as hashes
+    top_index = False
+    top_key = ('top',)
+    top_names = ()
+
+    # Keys are expired in `retention_days` after end of day (or month),
+    # EXPIREAT is sent once per key by process, while key is in cache.
+    # Key is cached after EXPIREAT was applied, for tracked pipelines
+    # (of `MetricsBatch`, facades & async classes) by replies of pipeline.
+    # Replies of pipeline passed by caller are not seen, so EXPIREAT
+    # is queued into it with every write
+    retention_days = None
+    retention_cache = LocalCache(maxsize=100000, ttl=3600)
+    pending_expires = WeakKeyDictionary()
+
+    # Calls are reported, when observer was installed by metrics.observer
+    observer = None
+
+    def __init__(self, variant_id, date_string, redis, save_variant=True,
+                 pipeline=None, aggregator=None, cache=None):
         self.variant_id = variant_id
         self.date_string = date_string
         self.save_variant = save_variant
 
         self.redis = redis
+        self.pipeline = pipeline
+        self.aggregator = aggregator
+        self.cache = cache
+        if cache is not None and not self.track_version:
+            warnings.warn(
+                'Reports of %s are cached, but track_version is off, '
+                'cached reports are not invalidated by writes'
+                % type(self).__name__, RuntimeWarning, stacklevel=2)
         self._save_variants()
 
+    @property
+    def writer(self):
+        """
+        Client for write commands.
+        When pipeline was defined, commands will be queued into it
+        """
+        if self.pipeline is not None:
+            return self.pipeline
+        return self.redis
+
+    @classmethod
+    def _build_variants_key(cls, date_string):
+        return '%s:%s:%s' % (cls.namespace, date_string, cls.variants_key)
+
     def __get_variants_key(self):
         """
         Get variants ids which stored to specified date
         """
-        return '%s:%s:%s' % (
-            self.namespace, self.date_string, self.variants_key)
+        return self._build_variants_key(self.date_string)
 
     def _save_variants(self):
         """
@@ -46,27 +111,281 @@ class MetricsAbstract(object):
         That need for sync data with database, without scanning by all variants
         """
         if self.variant_id and self.save_variant:
-            self.redis.hset(self.__get_variants_key(), self.variant_id, '')
+            key = self.__get_variants_key()
+            self.writer.hset(key, self.variant_id, '')
+            self._expire(key)
+
+    @classmethod
+    def _get_expire_at(cls, date_string):
+        """
+        Get unix time, when keys of day or month are expired
+        by retention policy. None for dates without retention
+        """
+        if not cls.retention_days:
+            return None
+        try:
+            if len(date_string) == 7:
+                day = datetime.strptime(date_string, '%Y-%m')
+                day = (day + timedelta(days=32)).replace(day=1)
+            else:
+                day = datetime.strptime(date_string, '%Y-%m-%d')
+                day += timedelta(days=1)
+        except ValueError:
+            return None
+        return timegm((day + timedelta(days=cls.retention_days)).timetuple())
+
+    def _expire(self, redis_key, date_string=None, writer=None,
+                deferred=False):
+        """
+        Queue EXPIREAT after first write of key. Command should follow
+        the write, so deferred writes of aggregator are expired by it
+        """
+        expire_at = self._get_expire_at(date_string or self.date_string)
+        if expire_at is None:
+            return
+        if self.retention_cache.get(redis_key) is not MISSING:
+            return
+        if deferred and self.aggregator is not None:
+            self.retention_cache.set(redis_key, expire_at)
+            return self.aggregator.expire_at(redis_key, expire_at)
+        return self._send_expire(
+            self.redis, writer or self.writer, redis_key, expire_at)
+
+    @classmethod
+    def _send_expire(cls, redis, writer, redis_key, expire_at):
+        """
+        EXPIREAT of not existing key does nothing, so key is cached
+        only by reply. Into tracked pipeline command is queued once,
+        into other pipelines it is queued for every write
+        """
+        if writer is redis:
+            result = writer.expireat(redis_key, expire_at)
+            if result:
+                cls.retention_cache.set(redis_key, expire_at)
+            return result
+        pending = cls.pending_expires.get(writer)
+        if pending is not None:
+            if redis_key in pending:
+                return
+            pending[redis_key] = (len(writer), expire_at, cls.retention_cache)
+        return writer.expireat(redis_key, expire_at)
+
+    @classmethod
+    def _track_expires(cls, pipe):
+        """
+        Collect EXPIREATs of pipeline till `_confirm_expires`
+        """
+        cls.pending_expires[pipe] = {}
+        return pipe
+
+    @classmethod
+    def _confirm_expires(cls, pipe, replies=None):
+        """
+        Cache keys of applied EXPIREATs of tracked pipeline,
+        without replies (pipeline was reset or failed) keys are forgotten
+        """
+        pending = cls.pending_expires.pop(pipe, None) or {}
+        if replies is not None:
+            for redis_key, (index, expire_at, cache) in pending.items():
+                if replies[index]:
+                    cache.set(redis_key, expire_at)
+        return replies
+
+    @classmethod
+    def _build_redis_key(cls, date_string, variant_id, args):
+        """
+        Get key with class namespace for any date & variant.
+        With `hash_tag` date & variant are placed into {...} tag,
+        so all keys of variant-day are stored on one cluster slot
+        """
+        if cls.hash_tag:
+            keys = [cls.namespace, '{%s:%s}' % (date_string, variant_id)]
+        else:
+            keys = [cls.namespace, date_string, variant_id]
+        keys.extend(args)
+        return ':'.join(map(str, keys))
 
     def _get_redis_key(self, args):
         """
         Get key with specified namespace, date & variant.
         Key can be mixed with some tuples
         """
-        keys = [self.namespace, self.date_string, self.variant_id]
-        keys.extend(args)
-        return ':'.join(map(str, keys))
+        return self._build_redis_key(self.date_string, self.variant_id, args)
+
+    @classmethod
+    def _build_location(cls, date_string, variant_id, key):
+        """
+        Get (redis key, hash field) of counter for any date & variant.
+        Field is None, when counter is stored as separate string key
+        """
+        if cls.compact:
+            field = cls.compact_fields.get(tuple(key))
+            if field is not None:
+                return cls._build_redis_key(
+                    date_string, variant_id, cls.packed_key), field
+        return cls._build_redis_key(date_string, variant_id, key), None
+
+    def _locate(self, key):
+        return self._build_location(self.date_string, self.variant_id, key)
+
+    def _locate_field(self, hash_key, field):
+        """
+        Get (redis key, hash field) of field of map
+        """
+        prefix = self.compact and self.compact_maps.get(tuple(hash_key))
+        if prefix:
+            return self._get_redis_key(self.packed_key), prefix + field
+        return self._get_redis_key(hash_key), field
+
+    @staticmethod
+    def _unpack_map(data, prefix):
+        """
+        Get fields of map, which was packed with prefix
+        """
+        return dict((field[len(prefix):], value)
+                    for field, value in data.items()
+                    if field.startswith(prefix))
+
+    def _get_cleaner(self, **options):
+        """
+        Get keys deletion engine, options override `cleaner_options`
+        """
+        params = dict(self.cleaner_options)
+        if is_distributed(self.redis):
+            # multi-key commands are not allowed across cluster slots
+            params['batch_size'] = 1
+        params.update(options)
+        return KeysCleaner(self.redis, **params)
+
+    def _del_by(self, *keys):
+        """
+        Delete data by specified keys
+        """
+        redis_keys = []
+        for key in keys:
+            redis_key = self._locate(key)[0]
+            if redis_key not in redis_keys:
+                redis_keys.append(redis_key)
+        return self._get_cleaner().delete_keys(redis_keys)
+
+    def _write_increment(self, redis_key, field, amount=1):
+        """
+        Increment string key or hash field.
+        When aggregator was defined, delta will be flushed later
+        """
+        if self.aggregator is not None:
+            if field is None:
+                result = self.aggregator.increment(redis_key, amount)
+            else:
+                result = self.aggregator.hash_increment(
+                    redis_key, field, amount)
+        elif field is None:
+            result = self.writer.incrby(redis_key, amount)
+        else:
+            result = self.writer.hincrby(redis_key, field, amount)
+        self._expire(redis_key, deferred=True)
+        return result
+
+    def _get_hll_dates(self):
+        """
+        Get dates of per-day & per-month HyperLogLogs,
+        it is one date, when date string is month already
+        """
+        dates = [self.date_string]
+        if self.date_string[:7] != self.date_string:
+            dates.append(self.date_string[:7])
+        return dates
+
+    def _get_hll_keys(self):
+        return [self._build_redis_key(date_string, self.variant_id,
+                                      self.hll_key)
+                for date_string in self._get_hll_dates()]
+
+    def _add_fingerprint(self, fingerprint):
+        """
+        Add visitor fingerprint into per-day & per-month HyperLogLogs,
+        memory of every key is bounded by 12 KB
+        """
+        pipe = self.pipeline
+        if pipe is None:
+            pipe = self._track_expires(self.redis.pipeline(transaction=False))
+        for date_string, key in zip(
+                self._get_hll_dates(), self._get_hll_keys()):
+            pipe.pfadd(key, fingerprint)
+            self._expire(key, date_string, pipe)
+        if self.pipeline is None:
+            self._execute(pipe)
+
+    def _execute(self, pipe):
+        """
+        Execute own tracked pipeline and confirm its EXPIREATs
+        """
+        replies = None
+        try:
+            replies = pipe.execute()
+            return replies
+        finally:
+            self._confirm_expires(pipe, replies)
+
+    def get_unique_estimate(self, month=False):
+        """
+        Count of unique fingerprints of day or month by PFCOUNT,
+        standard error is 0.81%
+        """
+        return self.redis.pfcount(self._get_hll_keys()[-1 if month else 0])
 
-    def _del_by(self, key):
+    @classmethod
+    def _build_top_key(cls, date_string, variant_id, name):
+        return cls._build_redis_key(
+            date_string, variant_id, cls.top_key + (name,))
+
+    def _top_increment(self, name, member, amount=1):
+        """
+        ZINCRBY of top index, members with zero delta are skipped.
+        Command is sent raw, so it does not depend on client version
         """
-        Delete data by specified key
+        if not (self.top_index and amount):
+            return
+        key = self._build_top_key(self.date_string, self.variant_id, name)
+        if self.aggregator is not None:
+            self.aggregator.sorted_increment(key, member, amount)
+        else:
+            self.writer.execute_command('ZINCRBY', key, amount, member)
+        self._expire(key, deferred=True)
+
+    def _get_top(self, name, n):
         """
-        self.redis.delete(self._get_redis_key(key))
+        Get [(member, count), ...] of top index by ZREVRANGE
+        """
+        key = self._build_top_key(self.date_string, self.variant_id, name)
+        return [(member, int(score)) for member, score in
+                self.redis.zrevrange(key, 0, n - 1, withscores=True)]
+
+    def _get_top_keys(self):
+        return [self.top_key + (name,) for name in self.top_names]
+
+    @staticmethod
+    def _get_count_type(name):
+        """
+        Get count type by counter name, reverse of `_get_counter_key`
+        """
+        try:
+            return {'visits': 0, 'unique': 1, 'goals': 2, 'leads': 3}[name]
+        except KeyError:
+            raise ValueError('Unknown counter %s' % name)
 
     def _hash_increment_by(self, hash_key, key, amount=1):
-        return self.redis.hincrby(self._get_redis_key(hash_key), key, amount)
+        """
+        Incrementing hash field by specified key
+        """
+        redis_key, field = self._locate_field(hash_key, key)
+        return self._write_increment(redis_key, field, amount)
 
     def _hash_get_by(self, key):
+        prefix = self.compact and self.compact_maps.get(tuple(key))
+        if prefix:
+            return self._unpack_map(self.redis.hgetall(
+                self._get_redis_key(self.packed_key)), prefix)
         return self.redis.hgetall(self._get_redis_key(key))
 
     @staticmethod
@@ -77,13 +396,51 @@ class MetricsAbstract(object):
         """
         Incrementing value by specified key
         """
-        return self.redis.incrby(self._get_redis_key(key), amount)
+        redis_key, field = self._locate(key)
+        return self._write_increment(redis_key, field, amount)
+
+    def _queue_count(self, pipe, key):
+        """
+        Queue read of counter into pipeline
+        """
+        redis_key, field = self._locate(key)
+        if field is None:
+            return pipe.get(redis_key)
+        return pipe.hget(redis_key, field)
 
     def _get_count_by(self, key):
         """
         Get incremented value by specified key
         """
-        return self.redis.get(self._get_redis_key(key)) or 0
+        return self._queue_count(self.redis, key) or 0
+
+    def _bump_version(self):
+        """
+        Variant-day version is used for invalidation of cached reports.
+        Writers should enable `track_version`, when reports are cached
+        """
+        if self.track_version:
+            self._increment_by(self.version_key)
+
+    def _get_generation_key(self):
+        """
+        Counter of flushes of day, it is not matched by flush patterns
+        """
+        return '%s_generation:%s' % (self.namespace, self.date_string)
+
+    def _get_version(self):
+        """
+        Get flush generation of day & variant-day version by one round
+        trip. They are read for every cached report, past days are
+        written too (late goals, clean up, replays). Version key is
+        removed by `flush_db`, generation keeps versions after flush
+        from matching reports cached before it
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self._get_generation_key())
+        self._queue_count(pipe, self.version_key)
+        generation, version = pipe.execute()
+        return int(generation or 0), int(version or 0)
 
     def clean_up(self):
         """
@@ -91,14 +448,31 @@ class MetricsAbstract(object):
         """
         raise NotImplementedError()
 
-    def flush_db(self):
+    def _get_flush_patterns(self):
+        patterns = ['%s:%s:*' % (self.namespace, self.date_string)]
+        if self.hash_tag:
+            patterns.append('%s:{%s:*' % (self.namespace, self.date_string))
+        return patterns
+
+    def flush_db(self, cursor=0, limit=None, **options):
         """
-        Remove all data for defined date
+        Remove all data for defined date.
+        Keys are found by SCAN, so deletion can be stopped by `limit`
+        and resumed from returned cursor (pattern index & SCAN cursor).
+        Options are passed to cleaner (count, batch_size, rate_limit,
+        dry_run). On cluster every node is scanned in parallel, cursor
+        is not supported there and deletion is limited per node.
+        With `track_version` flush generation of day is incremented,
+        when keys were deleted
         """
-        keys_list = self.redis.keys('%s:%s:*' % (
-            self.namespace, self.date_string))
-        for key in keys_list:
-            self.redis.delete(key)
+        cleaner = self._get_cleaner(**options)
+        deleted, cursor = cleaner.delete_patterns(
+            self._get_flush_patterns(), cursor, limit)
+        if deleted and self.track_version and not cleaner.dry_run:
+            key = self._get_generation_key()
+            self.redis.incr(key)
+            self._expire(key, writer=self.redis)
+        return deleted, cursor
 
     def get_variants(self):
         """
@@ -126,8 +500,31 @@ class VisitorMetrics(MetricsAbstract):
     goals_key = ('count', 2,)
     geo_goals_key = ('count_geo_goals',)
     geo_unique_key = ('count_geo_unique',)
+    geo_country_key = ('count_geo_country',)
+    geo_region_key = ('count_geo_region',)
     details_key = ('count_details',)
+    details_total_key = ('count_details_total',)
     additional_key = ('count_additional',)
+    details_limit = None
+
+    # Optional `metrics.geo.GeoResolver`, visits & goals are counted
+    # by country & region. Hashes by raw ips can be disabled
+    geo_resolver = None
+    geo_keep_ips = True
+
+    compact_fields = {
+        visits_key: 'v',
+        unique_key: 'u',
+        goals_key: 'g',
+        details_total_key: 'd',
+    }
+    compact_maps = {additional_key: 'a:'}
+    top_names = ('geo_unique', 'geo_goals')
+
+    def __init__(self, *args, **kwargs):
+        self.details_limit = kwargs.pop('details_limit', self.details_limit)
+        self.geo_resolver = kwargs.pop('geo_resolver', self.geo_resolver)
+        super(VisitorMetrics, self).__init__(*args, **kwargs)
 
     def get_unique(self):
         return self._get_count_by(self.unique_key)
@@ -138,55 +535,238 @@ class VisitorMetrics(MetricsAbstract):
     def get_goals(self):
         return self._get_count_by(self.goals_key)
 
+    @cached_report
     def get_additional_list(self):
+        return self._build_additional_list(
+            self._hash_get_by(self.additional_key))
+
+    @staticmethod
+    def _build_additional_list(ad_list):
         data = []
-        ad_list = self.redis.hgetall(self._get_redis_key(self.additional_key))
         for key, count in ad_list.items():
             values = key.split(':') + [count]
             data.append(dict(zip(ADDITIONAL_STRUCT, values)))
         return data
 
-    def get_details(self):
-        data = self.redis.lrange(self._get_redis_key(self.details_key), 0, -1)
+    def get_details(self, offset=0, limit=None, page_size=500):
+        """
+        Stream visits details from newest one by LRANGE pages
+        """
+        key = self._get_redis_key(self.details_key)
         keys = ['ip', 'time', 'channel']
-        for line in data:
-            yield dict(zip(keys, loads(line)))
+        stop = offset + limit if limit else None
+        start = offset
+        while stop is None or start < stop:
+            end = start + page_size - 1
+            if stop is not None:
+                end = min(end, stop - 1)
+            data = self.redis.lrange(key, start, end)
+            for line in data:
+                yield dict(zip(keys, loads(line)))
+            if len(data) <= end - start:
+                return
+            start = end + 1
+
+    def get_details_count(self):
+        return self.redis.llen(self._get_redis_key(self.details_key))
+
+    def get_details_overflow(self):
+        """
+        Count of details, which were trimmed by `details_limit`
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        self._queue_count(pipe, self.details_total_key)
+        pipe.llen(self._get_redis_key(self.details_key))
+        total, length = pipe.execute()
+        return max(int(total or 0) - length, 0)
 
-    def get_geo(self):
-        keys = self.redis.hgetall(self._get_redis_key(self.geo_unique_key))
-        data = []
-        for ip, unique in keys.items():
-            goals = self.redis.hget(
-                self._get_redis_key(self.geo_goals_key), ip)
-            data.append({
-                'ip': ip,
-                'unique': int(unique or 0),
-                'goals': int(goals or 0),
-            })
-        return data
+    @staticmethod
+    def _get_geo_row(ip, unique, goals):
+        return {
+            'ip': ip,
+            'unique': int(unique or 0),
+            'goals': int(goals or 0),
+        }
+
+    @cached_report
+    def get_geo(self, limit=None, order_by=None):
+        """
+        Both geo hashes are read by single pipelined call and joined
+        in memory. Rows can be sorted by `goals` or `unique` descending
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self._get_redis_key(self.geo_unique_key))
+        pipe.hgetall(self._get_redis_key(self.geo_goals_key))
+        unique_list, goals_list = pipe.execute()
+        data = (self._get_geo_row(ip, unique, goals_list.get(ip))
+                for ip, unique in unique_list.items())
+        return self._limit_geo(data, limit, order_by)
+
+    def iter_geo(self, limit=None, chunk_size=1000):
+        """
+        Yield geo rows by HSCAN chunks with bounded memory,
+        goals for every chunk are read by single HMGET
+        """
+        unique_key = self._get_redis_key(self.geo_unique_key)
+        goals_key = self._get_redis_key(self.geo_goals_key)
+        cursor, count = None, 0
+        while cursor != 0:
+            cursor, chunk = self.redis.hscan(
+                unique_key, cursor or 0, count=chunk_size)
+            if not chunk:
+                continue
+            ips = list(chunk.keys())
+            goals_list = self.redis.hmget(goals_key, ips)
+            for ip, goals in zip(ips, goals_list):
+                yield self._get_geo_row(ip, chunk[ip], goals)
+                count += 1
+                if limit and count >= limit:
+                    return
+
+    def get_top_geo(self, limit, order_by='goals', chunk_size=1000):
+        """
+        Top of geo rows, which was selected from HSCAN chunks,
+        only `limit` rows are kept in memory
+        """
+        return self._limit_geo(
+            self.iter_geo(chunk_size=chunk_size), limit, order_by)
+
+    @staticmethod
+    def _limit_geo(data, limit=None, order_by=None):
+        if order_by:
+            key = itemgetter(order_by)
+            if limit:
+                return nlargest(limit, data, key=key)
+            return sorted(data, key=key, reverse=True)
+        return list(islice(data, limit))
 
     def _save_details(self, data):
-        self.redis.lpush(
-            self._get_redis_key(self.details_key), dumps(data))
+        """
+        When `details_limit` was defined, list is trimmed
+        and pushes are counted in the same pipeline
+        """
+        key = self._get_redis_key(self.details_key)
+        if not self.details_limit:
+            result = self.writer.lpush(key, dumps(data))
+            self._expire(key)
+            return result
+
+        pipe = self.pipeline
+        if pipe is None:
+            pipe = self._track_expires(self.redis.pipeline(transaction=False))
+        pipe.lpush(key, dumps(data))
+        pipe.ltrim(key, 0, self.details_limit - 1)
+        self._expire(key, writer=pipe)
+        redis_key, field = self._locate(self.details_total_key)
+        if field is None:
+            pipe.incr(redis_key)
+        else:
+            pipe.hincrby(redis_key, field, 1)
+        self._expire(redis_key, writer=pipe)
+        if self.pipeline is None:
+            self._execute(pipe)
 
     def _save_geo(self, data, is_goal=0, amount=1):
+        if self.geo_resolver is not None:
+            self._save_location(data[0], is_goal, amount)
+            if not self.geo_keep_ips:
+                return
         if not is_goal:
-            self.redis.hincrby(
-                self._get_redis_key(self.geo_unique_key), data[0], amount)
-        self.redis.hincrby(
-            self._get_redis_key(self.geo_goals_key),
-            data[0], is_goal and amount or is_goal)
+            self._hash_increment_by(self.geo_unique_key, data[0], amount)
+            self._top_increment('geo_unique', data[0], amount)
+        self._hash_increment_by(
+            self.geo_goals_key, data[0], is_goal and amount or is_goal)
+        self._top_increment('geo_goals', data[0], is_goal and amount)
+
+    @classmethod
+    def _get_location_fields(cls, resolver, ip, is_goal=0):
+        """
+        Get (hash key, field) of country & region counters of ip,
+        field is `<country>[:<region>]:<count type>`
+        """
+        country, region = resolver.resolve(ip)
+        count_type = 2 if is_goal else 1
+        fields = [(cls.geo_country_key,
+                   cls._get_hash_key(country, count_type))]
+        if region:
+            fields.append((cls.geo_region_key, cls._get_hash_key(
+                country, region, count_type)))
+        return fields
+
+    def _save_location(self, ip, is_goal=0, amount=1):
+        for hash_key, field in self._get_location_fields(
+                self.geo_resolver, ip, is_goal):
+            self._hash_increment_by(hash_key, field, amount)
+
+    @classmethod
+    def _build_locations(cls, data):
+        """
+        Convert `<location>:<count type>` fields into
+        {location: {'unique': ..., 'goals': ...}}
+        """
+        locations = {}
+        for field, count in data.items():
+            location, count_type = field.rsplit(':', 1)
+            row = locations.setdefault(location, {'unique': 0, 'goals': 0})
+            row.update(cls._get_counter_key(count_type, int(count or 0)))
+        return locations
+
+    @cached_report
+    def get_geo_countries(self):
+        """
+        Unique & goals by countries, which were counted by `geo_resolver`
+        """
+        return self._build_locations(
+            self.redis.hgetall(self._get_redis_key(self.geo_country_key)))
 
-    def save_visitor(self, is_unique, data):
+    @cached_report
+    def get_geo_regions(self):
+        """
+        Unique & goals by regions grouped by countries
+        """
+        data = {}
+        for location, row in self._build_locations(self.redis.hgetall(
+                self._get_redis_key(self.geo_region_key))).items():
+            country, region = location.split(':', 1)
+            data.setdefault(country, {})[region] = row
+        return data
+
+    def top_geo(self, n, by='goals'):
+        """
+        Top ips by `goals` or `unique` from sorted set index
+        by ZREVRANGE, other counter is read by HMGET.
+        Without `top_index` geo hashes are scanned
+        """
+        if by not in ('goals', 'unique'):
+            raise ValueError('Unknown counter %s' % by)
+        if not self.top_index:
+            return self.get_top_geo(n, order_by=by)
+        if by == 'goals':
+            other, other_key = 'unique', self.geo_unique_key
+        else:
+            other, other_key = 'goals', self.geo_goals_key
+        top = self._get_top('geo_%s' % by, n)
+        if not top:
+            return []
+        values = self.redis.hmget(
+            self._get_redis_key(other_key), [ip for ip, count in top])
+        return [{'ip': ip, by: count, other: int(value or 0)}
+                for (ip, count), value in zip(top, values)]
+
+    def save_visitor(self, is_unique, data, fingerprint=None):
         if is_unique > 0:
             self._increment_by(self.unique_key)
             self._save_details(data)
             self._save_geo(data)
         self._increment_by(self.visits_key)
+        if fingerprint is not None:
+            self._add_fingerprint(fingerprint)
+        self._bump_version()
 
     def save_goal(self, data, amount=1):
         self._increment_by(self.goals_key, amount)
         self._save_geo(data, is_goal=1, amount=amount)
+        self._bump_version()
 
     def decrease_goal(self, data):
         self.save_goal(data, amount=-1)
@@ -194,20 +774,19 @@ class VisitorMetrics(MetricsAbstract):
     def save_additional(self, amount=1, **kwargs):
         if kwargs.get('ad_id') and kwargs.get('ad_type'):
             key = '%(ad_id)s:%(ad_type)s:%(ad_label)s' % kwargs
-            self.redis.hincrby(
-                self._get_redis_key(self.additional_key), key, amount)
+            self._hash_increment_by(self.additional_key, key, amount)
+            self._bump_version()
 
     def decrease_additional(self, amount=-1, **kwargs):
         self.save_additional(amount, **kwargs)
 
     def clean_up(self):
-        self._del_by(self.visits_key)
-        self._del_by(self.unique_key)
-        self._del_by(self.goals_key)
-        self._del_by(self.details_key)
-        self._del_by(self.additional_key)
-        self._del_by(self.geo_goals_key)
-        self._del_by(self.geo_unique_key)
+        self._del_by(
+            self.visits_key, self.unique_key, self.goals_key,
+            self.details_key, self.details_total_key, self.additional_key,
+            self.geo_goals_key, self.geo_unique_key, self.geo_country_key,
+            self.geo_region_key, self.hll_key, *self._get_top_keys())
+        self._bump_version()
 
 
 class UtmMetrics(MetricsAbstract):
@@ -217,9 +796,22 @@ class UtmMetrics(MetricsAbstract):
     utm_term_key = ('utm_term',)
     utm_additional_keys_key = ('utm_additional_keys',)
     utm_additional_key = ('utm_additional',)
+    utm_read_keys = (
+        utm_channel_key, utm_medium_key, utm_campaign_key, utm_term_key,
+        utm_additional_key,
+    )
     utm_amount = 1
+    top_names = (
+        'utm_term:0', 'utm_term:1', 'utm_term:2',
+        'utm_campaign:0', 'utm_campaign:1', 'utm_campaign:2',
+    )
+    top_fields = {
+        utm_term_key: ('term', 'campaign', 'medium', 'channel'),
+        utm_campaign_key: ('campaign', 'medium', 'channel'),
+    }
 
     def __init__(self, *args, **kwargs):
+        self.use_script = kwargs.pop('use_script', False)
         super(UtmMetrics, self).__init__(*args, **kwargs)
 
         self.channel_id = None
@@ -231,161 +823,315 @@ class UtmMetrics(MetricsAbstract):
         self.utm_campaign = None
 
         self.data = dict()
+        self._utm_script = None
 
     def __get_additional_name(self, name):
         return self._get_redis_key([self.utm_additional_keys_key[0], name])
 
-    def _save_utm_additional(self, name):
-        params = self.additional_params
+    def _get_utm_additional_suffix(self):
+        return self._build_utm_additional_suffix(
+            self.additional_params, self.count_type)
+
+    @staticmethod
+    def _build_utm_additional_suffix(params, count_type):
+        """
+        Additional params are saved only for goals
+        """
         if params and params.get('ad_id') and params.get('ad_type'):
-            if self.count_type == 2:
-                key = name + '-||-%(ad_id)s:%(ad_type)s:%(ad_label)s' % params
-                self.redis.sadd(self.__get_additional_name(name), key)
-                self._hash_increment_by(
-                    self.utm_additional_key, key, self.utm_amount)
+            if count_type == 2:
+                return '%(ad_id)s:%(ad_type)s:%(ad_label)s' % params
 
-    def _get_utm_additional(self, name):
-        data = []
-        # todo: remove try-except tomorrow
-        try:
-            for key in self.redis.smembers(self.__get_additional_name(name)):
-                cnt_key = self._get_redis_key(self.utm_additional_key)
-                count = [self.redis.hget(cnt_key, key)]
-                values = key.split('-||-')[1].split(':') + count
-                data.append(dict(zip(ADDITIONAL_STRUCT, values)))
-        except Exception as exc:
-            print('[ad-utm]', exc.__str__())
-        return {'additional': data}
+    def _save_utm_additional(self, name):
+        suffix = self._get_utm_additional_suffix()
+        if suffix:
+            key = name + '-||-' + suffix
+            if not self.compact:
+                set_key = self.__get_additional_name(name)
+                self.writer.sadd(set_key, key)
+                self._expire(set_key)
+            self._hash_increment_by(
+                self.utm_additional_key, key, self.utm_amount)
+
+    @staticmethod
+    def _get_utm_additional(name, additional):
+        return {'additional': additional.get(name, [])}
+
+    @staticmethod
+    def _group_utm_additional(utm_additional):
+        """
+        Group additional counters by utm node name.
+        Hash field is `<node name>-||-<ad_id>:<ad_type>:<ad_label>`
+        """
+        data = {}
+        for key, count in utm_additional.items():
+            try:
+                name, values = key.split('-||-')[:2]
+                values = values.split(':') + [count]
+            except ValueError:
+                # malformed field is skipped
+                continue
+            data.setdefault(name, []).append(
+                dict(zip(ADDITIONAL_STRUCT, values)))
+        return data
 
     def _del_utm_additional(self):
-        for key in self.redis.keys(self.__get_additional_name('*')):
-            self.redis.delete(key)
+        return self._get_cleaner().delete_patterns(
+            [self.__get_additional_name('*')])
 
-    def _save_utm_term(self):
-        utm_terms = self.utm_params.get('utm_term')
-        if utm_terms:
-            for term in utm_terms.split(','):
-                term = term.strip()
-                if term:
-                    key = self._get_hash_key(
-                        term, self.utm_campaign, self.utm_medium,
-                        self.channel_id, self.count_type)
-                    self._hash_increment_by(
-                        self.utm_term_key, key, self.utm_amount)
-                    self._save_utm_additional(key)
-
-    def _save_utm_campaign(self):
-        self.utm_campaign = self.utm_params.get('utm_campaign')
-        if self.utm_campaign:
-            key = self._get_hash_key(
-                self.utm_campaign, self.utm_medium,
-                self.channel_id, self.count_type)
-            self._save_utm_additional(key)
-            return self._hash_increment_by(
-                self.utm_campaign_key, key, self.utm_amount)
-
-    def _save_utm_medium(self):
-        self.utm_medium = self.utm_params.get('utm_medium')
-        if self.utm_medium:
-            key = self._get_hash_key(
-                self.utm_medium, self.channel_id, self.count_type)
-            self._save_utm_additional(key)
-            return self._hash_increment_by(
-                self.utm_medium_key, key, self.utm_amount)
-
-    def _save_channel(self):
-        key = self._get_hash_key(self.channel_id, self.count_type)
-        self._save_utm_additional(key)
-        return self._hash_increment_by(
-            self.utm_channel_key, key, self.utm_amount)
-
-    def _get_utm_terms(self):
-        utm_terms = self._hash_get_by(self.utm_term_key)
+    @classmethod
+    def _get_utm_terms(cls, data, utm_terms, additional):
         for term_key, term_count in utm_terms.items():
             term, campaign, medium, channel, count_type = term_key.split(':')
-            if term not in self.data[channel]['utm_medium'][medium]['utm_campaign'][campaign]['terms']:
-                self.data[channel]['utm_medium'][medium]['utm_campaign'][campaign]['terms'][term] = {}
+            terms = data[channel]['utm_medium'][medium][
+                'utm_campaign'][campaign]['terms']
+            if term not in terms:
+                terms[term] = {}
 
-            self.data[channel]['utm_medium'][medium]['utm_campaign'][campaign]['terms'][term].update(
-                self._get_counter_key(count_type, term_count))
+            terms[term].update(cls._get_counter_key(count_type, term_count))
 
             if count_type == '2':
-                self.data[channel]['utm_medium'][medium]['utm_campaign'][campaign]['terms'][term].update(
-                    self._get_utm_additional(term_key))
+                terms[term].update(
+                    cls._get_utm_additional(term_key, additional))
 
-    def _get_utm_campaign(self):
-        utm_campaign = self._hash_get_by(self.utm_campaign_key)
+    @classmethod
+    def _get_utm_campaign(cls, data, utm_campaign, additional):
         for campaign_key, campaign_count in utm_campaign.items():
             campaign, medium, channel, count_type = campaign_key.split(':')
+            campaigns = data[channel]['utm_medium'][medium]['utm_campaign']
 
-            if campaign not in self.data[channel]['utm_medium'][medium]['utm_campaign']:
-                self.data[channel]['utm_medium'][medium]['utm_campaign'][campaign] = {'terms': {}}
+            if campaign not in campaigns:
+                campaigns[campaign] = {'terms': {}}
 
-            self.data[channel]['utm_medium'][medium]['utm_campaign'][campaign].update(
-                self._get_counter_key(count_type, campaign_count))
+            campaigns[campaign].update(
+                cls._get_counter_key(count_type, campaign_count))
 
             if count_type == '2':
-                self.data[channel]['utm_medium'][medium]['utm_campaign'][campaign].update(
-                    self._get_utm_additional(campaign_key))
+                campaigns[campaign].update(
+                    cls._get_utm_additional(campaign_key, additional))
 
-    def _get_utm_medium(self):
-        utm_medium = self._hash_get_by(self.utm_medium_key)
+    @classmethod
+    def _get_utm_medium(cls, data, utm_medium, additional):
         for medium_key, medium_count in utm_medium.items():
             medium, channel, count_type = medium_key.split(':')
-            if medium not in self.data[channel]['utm_medium']:
-                self.data[channel]['utm_medium'][medium] = {'utm_campaign': {}}
+            mediums = data[channel]['utm_medium']
+            if medium not in mediums:
+                mediums[medium] = {'utm_campaign': {}}
 
-            self.data[channel]['utm_medium'][medium].update(
-                self._get_counter_key(count_type, medium_count))
+            mediums[medium].update(
+                cls._get_counter_key(count_type, medium_count))
 
             if count_type == '2':
-                self.data[channel]['utm_medium'][medium].update(
-                    self._get_utm_additional(medium_key))
-
-    def _get_utm_channel(self):
-        utm_channel = self._hash_get_by(self.utm_channel_key)
+                mediums[medium].update(
+                    cls._get_utm_additional(medium_key, additional))
 
+    @classmethod
+    def _get_utm_channel(cls, data, utm_channel, additional):
         for channel_data, channel_count in utm_channel.items():
             channel, channel_type = channel_data.split(':')
 
-            if channel not in self.data:
-                self.data[channel] = {'utm_medium': {}}
+            if channel not in data:
+                data[channel] = {'utm_medium': {}}
 
-            self.data[channel].update(self._get_counter_key(
+            data[channel].update(cls._get_counter_key(
                 channel_type, channel_count))
 
             if channel_type == '2':
-                self.data[channel].update(
-                    self._get_utm_additional(channel_data))
+                data[channel].update(
+                    cls._get_utm_additional(channel_data, additional))
+
+    @classmethod
+    def _build_utm(cls, utm_channel, utm_medium, utm_campaign, utm_term,
+                   utm_additional, data=None):
+        """
+        Assemble utm tree from raw hashes in memory
+        """
+        data = {} if data is None else data
+        additional = cls._group_utm_additional(utm_additional)
+        cls._get_utm_channel(data, utm_channel, additional)
+        cls._get_utm_medium(data, utm_medium, additional)
+        cls._get_utm_campaign(data, utm_campaign, additional)
+        cls._get_utm_terms(data, utm_term, additional)
+        return data
+
+    def _get_utm_nodes(self):
+        self.utm_medium = self.utm_params.get('utm_medium')
+        self.utm_campaign = self.utm_params.get('utm_campaign')
+        return self._build_utm_nodes(
+            self.channel_id, self.utm_params, self.count_type)
+
+    @classmethod
+    def _build_utm_nodes(cls, channel_id, utm_params, count_type):
+        """
+        Get (hash key, field) for every node of utm tree branch.
+        Cascade is channel -> medium -> campaign -> terms, every level
+        is saved only when previous one was defined.
+        It does not depend on redis replies, so can be queued into pipeline
+        """
+        nodes = [(cls.utm_channel_key, cls._get_hash_key(
+            channel_id, count_type))]
+
+        utm_medium = utm_params.get('utm_medium')
+        if not utm_medium:
+            return nodes
+        nodes.append((cls.utm_medium_key, cls._get_hash_key(
+            utm_medium, channel_id, count_type)))
+
+        utm_campaign = utm_params.get('utm_campaign')
+        if not utm_campaign:
+            return nodes
+        nodes.append((cls.utm_campaign_key, cls._get_hash_key(
+            utm_campaign, utm_medium, channel_id, count_type)))
+
+        utm_terms = utm_params.get('utm_term')
+        if utm_terms:
+            for term in utm_terms.split(','):
+                term = term.strip()
+                if term:
+                    nodes.append((cls.utm_term_key, cls._get_hash_key(
+                        term, utm_campaign, utm_medium,
+                        channel_id, count_type)))
+        return nodes
+
+    def _get_utm_script(self):
+        """
+        Script object is cached and executed by EVALSHA,
+        it will be loaded again on NOSCRIPT error
+        """
+        if self._utm_script is None:
+            self._utm_script = self.redis.register_script(UTM_SAVE_SCRIPT)
+        return self._utm_script
+
+    def _save_utm_by_script(self, nodes):
+        """
+        Save all nodes with additional params atomically by one round trip
+        """
+        levels = (self.utm_channel_key, self.utm_medium_key,
+                  self.utm_campaign_key, self.utm_term_key)
+        suffix = self._get_utm_additional_suffix()
+
+        keys = [self._get_redis_key(k) for k in levels]
+        keys.append(self._get_redis_key(self.utm_additional_key))
+        args = [self.utm_amount, suffix or '']
+        # only keys, which are written by script, are expired
+        written = []
+        for hash_key, key in nodes:
+            level = levels.index(hash_key)
+            args.extend([level + 1, key])
+            if keys[level] not in written:
+                written.append(keys[level])
+            if suffix and not self.compact:
+                keys.append(self.__get_additional_name(key))
+        if suffix and nodes:
+            written.extend(keys[len(levels):])
+
+        script = self._get_utm_script()
+        if self.pipeline is not None:
+            self.pipeline.scripts.add(script)
+            result = self.pipeline.evalsha(
+                script.sha, len(keys), *(keys + args))
+        else:
+            result = script(keys=keys, args=args, client=self.redis)
+        for key in written:
+            self._expire(key)
+        for hash_key, key in nodes:
+            self._save_top(hash_key, key)
+        return result
+
+    def _save_top(self, hash_key, key):
+        """
+        Terms & campaigns are indexed by node without count type
+        """
+        if self.top_index and hash_key in self.top_fields:
+            member, count_type = key.rsplit(':', 1)
+            self._top_increment(
+                '%s:%s' % (hash_key[0], count_type), member, self.utm_amount)
+
+    def _get_top_nodes(self, hash_key, n, by):
+        """
+        Top utm nodes from sorted set index by ZREVRANGE.
+        Without `top_index` hash is read and sorted in memory
+        """
+        count_type = self._get_count_type(by)
+        if self.top_index:
+            top = self._get_top('%s:%s' % (hash_key[0], count_type), n)
+        else:
+            suffix = ':%s' % count_type
+            top = nlargest(n, (
+                (key[:-len(suffix)], int(count)) for key, count in
+                self.redis.hgetall(self._get_redis_key(hash_key)).items()
+                if key.endswith(suffix)), key=itemgetter(1))
+        return self._build_top_nodes(hash_key, top, by)
+
+    @classmethod
+    def _build_top_nodes(cls, hash_key, top, by):
+        names = cls.top_fields[hash_key]
+        return [dict(zip(names, member.split(':')), **{by: count})
+                for member, count in top]
+
+    def top_terms(self, n, by='goals'):
+        return self._get_top_nodes(self.utm_term_key, n, by)
+
+    def top_campaigns(self, n, by='goals'):
+        return self._get_top_nodes(self.utm_campaign_key, n, by)
 
     def _save_utm(self):
         if self.variant_id and self.channel_id:
-            if self._save_channel() is not None:
-                if self._save_utm_medium() is not None:
-                    if self._save_utm_campaign() is not None:
-                        self._save_utm_term()
+            nodes = self._get_utm_nodes()
+            if self.use_script:
+                return self._save_utm_by_script(nodes)
+            for hash_key, key in nodes:
+                self._save_utm_additional(key)
+                self._hash_increment_by(hash_key, key, self.utm_amount)
+                self._save_top(hash_key, key)
 
     def _encode_params(self):
+        """
+        Params are converted into native strings, hash fields are built
+        by string formatting
+        """
         for k, v in self.utm_params.items():
-            if v is not None:
-                try:
-                    self.utm_params[k] = v.encode('utf-8', 'ignore')
-                except UnicodeDecodeError:
-                    self.utm_params[k] = v
+            self.utm_params[k] = self._encode_value(v)
+
+    @staticmethod
+    def _encode_value(value):
+        """
+        Unicode is encoded into utf-8 on Python 2, bytes are decoded
+        on Python 3 (otherwise `b'...'` would be written into fields)
+        """
+        if value is None or isinstance(value, str):
+            return value
+        try:
+            if isinstance(value, bytes):
+                return value.decode('utf-8', 'ignore')
+            return value.encode('utf-8', 'ignore')
+        except UnicodeDecodeError:
+            return value
 
     def clean_up(self):
-        self._del_by(self.utm_channel_key)
-        self._del_by(self.utm_medium_key)
-        self._del_by(self.utm_campaign_key)
-        self._del_by(self.utm_term_key)
-        self._del_by(self.utm_additional_key)
+        self._del_by(
+            self.utm_channel_key, self.utm_medium_key, self.utm_campaign_key,
+            self.utm_term_key, self.utm_additional_key,
+            *self._get_top_keys())
         self._del_utm_additional()
+        self._bump_version()
+
+    def _queue_utm(self, pipe):
+        """
+        Queue reads of all utm hashes, replies are ordered
+        as `_build_utm` arguments
+        """
+        for key in self.utm_read_keys:
+            pipe.hgetall(self._get_redis_key(key))
+        return pipe
 
+    @cached_report
     def get_utm(self):
-        self._get_utm_channel()
-        self._get_utm_medium()
-        self._get_utm_campaign()
-        self._get_utm_terms()
+        """
+        All utm hashes are read by single pipelined call,
+        tree is assembled in memory
+        """
+        pipe = self._queue_utm(self.redis.pipeline(transaction=False))
+        self.data = self._build_utm(*pipe.execute())
         return self.data
 
     def save_utm(self, channel_id, utm_params, additional_params,
@@ -398,6 +1144,7 @@ class UtmMetrics(MetricsAbstract):
 
         self._encode_params()
         self._save_utm()
+        self._bump_version()
 
     def save_visit_with_utm(self, is_unique, channel_id=None, utm_params=None):
         if is_unique:
@@ -415,18 +1162,26 @@ class HourMetrics(MetricsAbstract):
     hour_key = ('hour_statistics',)
     namespace = 'hours'
 
-    def __init__(self, variant_id, date_string, redis, save_variant=True):
+    def __init__(self, variant_id, date_string, redis, save_variant=True,
+                 **kwargs):
         super(HourMetrics, self).__init__(
-            variant_id, date_string, redis, save_variant)
+            variant_id, date_string, redis, save_variant, **kwargs)
+
+        # Fixed hour can be defined, otherwise hour of every write is used
+        self.time_string = None
 
-        self.time_string = now().strftime('%H')
+    def _get_time_string(self):
+        return self.time_string or now().strftime('%H')
 
     def clean_up(self):
         self._del_by(self.hour_key)
+        self._bump_version()
 
     def _save_by_key(self, type_key, amount=1):
-        key = self._get_hash_key(self.time_string, type_key)
-        return self._hash_increment_by(self.hour_key, key, amount)
+        key = self._get_hash_key(self._get_time_string(), type_key)
+        result = self._hash_increment_by(self.hour_key, key, amount)
+        self._bump_version()
+        return result
 
     def _save_visitor(self, is_unique=0):
         self._save_by_key(is_unique)
@@ -448,14 +1203,19 @@ class HourMetrics(MetricsAbstract):
     def decrease_goal(self):
         return self._save_by_key(2, amount=-1)
 
+    @cached_report
     def get_hours_stats(self):
-        data_list = self.redis.hgetall(self._get_redis_key(self.hour_key))
+        return self._build_hours_stats(
+            self.redis.hgetall(self._get_redis_key(self.hour_key)))
+
+    @classmethod
+    def _build_hours_stats(cls, data_list):
         hours_stats = {}
         for data, count in data_list.items():
             hour, count_type = data.split(':')
             if hour not in hours_stats:
                 hours_stats[hour] = {}
-            hours_stats[hour].update(self._get_counter_key(count_type, count))
+            hours_stats[hour].update(cls._get_counter_key(count_type, count))
         return hours_stats
 
 
@@ -466,20 +1226,35 @@ class TariffStats(MetricsAbstract):
     variants_key = 'profiles'
     namespace = 'stats'
     tariff_key = ('tariff',)
+    hll_key = ('tariff_hll',)
 
-    def save_unique(self):
+    def save_unique(self, fingerprint=None):
+        """
+        With visitor fingerprint uniqueness is decided by HyperLogLog,
+        use `get_unique_estimate` for reading
+        """
+        if fingerprint is not None:
+            return self._add_fingerprint(fingerprint)
         return self._increment_by(self.tariff_key)
 
     def get_unique(self):
         return self._get_count_by(self.tariff_key)
 
     def clean_up(self):
+        """
+        Delete counters of previous month. Not needed,
+        when keys are expired by `retention_days`
+        """
         previous_mon = (now() - timedelta(days=31)).strftime('%Y-%m')
-        self.date_string = previous_mon
-        for profile in self.get_variants():
-            self.variant_id = profile
-            key = self._get_redis_key(self.tariff_key)
-            self.redis.delete(key)
+        keys = []
+        for profile in self.redis.hkeys(
+                self._build_variants_key(previous_mon)):
+            if isinstance(profile, bytes):
+                profile = profile.decode('utf-8')
+            for key in (self.tariff_key, self.hll_key):
+                keys.append(
+                    self._build_redis_key(previous_mon, profile, key))
+        return self._get_cleaner().delete_keys(keys)
 
 
 class TotalMetrics(MetricsAbstract):
@@ -487,31 +1262,102 @@ class TotalMetrics(MetricsAbstract):
     Class for save total counters for page to view on /pages/
     """
     namespace = 'total_metrics'
+    total_date = '0000-00-00'
 
     conversion_key = ('count', 0,)
     unique_key = ('count', 1,)
     goals_key = ('count', 2,)
     details_key = ('count_details',)
+    compact_fields = {
+        unique_key: 'u',
+        goals_key: 'g',
+    }
 
-    def __init__(self, page_id, redis, save_variant=True):
+    def __init__(self, page_id, redis, save_variant=True, **kwargs):
         super(TotalMetrics, self).__init__(
-            page_id, '0000-00-00', redis, save_variant)
+            page_id, self.total_date, redis, save_variant, **kwargs)
 
     def get_unique(self):
         return self._get_count_by(self.unique_key)
 
-    def get_conversions(self):
-        pipe = self.redis.pipeline(transaction=True)
-        pipe.get(self._get_redis_key(self.goals_key))
-        pipe.get(self._get_redis_key(self.unique_key))
-        data = pipe.execute()
-        goals = float(data[0] or 0)
-        unique = float(data[1] or 0)
+    @staticmethod
+    def _get_conversion(goals, unique):
         try:
-            conversions = goals / unique * 100.0
+            return float(goals or 0) / float(unique or 0) * 100.0
         except ZeroDivisionError:
-            conversions = 0.0
-        return '%0.2f' % conversions
+            return 0.0
+
+    def get_conversion(self):
+        """
+        Get page conversion as float value
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        self._queue_count(pipe, self.goals_key)
+        self._queue_count(pipe, self.unique_key)
+        goals, unique = pipe.execute()
+        return self._get_conversion(goals, unique)
+
+    def get_conversions(self):
+        return '%0.2f' % self.get_conversion()
+
+    @classmethod
+    def get_bulk(cls, redis, page_ids, chunk_size=1000, as_array=False):
+        """
+        Get unique, goals & conversion for many pages without
+        metrics objects and write side effects.
+        Counters are read by MGET chunks sent by one pipeline
+        (by HMGET of packed hashes for compact layout).
+        With `as_array` NumPy arrays are returned for sorting & filtering
+        """
+        page_ids = list(page_ids)
+        pipe = redis.pipeline(transaction=False)
+        if cls.compact:
+            fields = [cls.compact_fields[cls.unique_key],
+                      cls.compact_fields[cls.goals_key]]
+            for page_id in page_ids:
+                pipe.hmget(cls._build_redis_key(
+                    cls.total_date, page_id, cls.packed_key), fields)
+        else:
+            for i in range(0, len(page_ids), chunk_size):
+                chunk = page_ids[i:i + chunk_size]
+                for key in (cls.unique_key, cls.goals_key):
+                    pipe.mget([
+                        cls._build_redis_key(cls.total_date, page_id, key)
+                        for page_id in chunk])
+        replies = pipe.execute()
+
+        unique, goals = [], []
+        if cls.compact:
+            for page_unique, page_goals in replies:
+                unique.append(int(page_unique or 0))
+                goals.append(int(page_goals or 0))
+        else:
+            for i in range(0, len(replies), 2):
+                unique.extend(int(value or 0) for value in replies[i])
+                goals.extend(int(value or 0) for value in replies[i + 1])
+
+        if as_array:
+            import numpy
+            unique = numpy.array(unique, dtype='int64')
+            goals = numpy.array(goals, dtype='int64')
+            conversion = numpy.zeros(len(page_ids), dtype='float64')
+            numpy.divide(goals * 100.0, unique, out=conversion,
+                         where=unique != 0)
+            return {
+                'page_id': numpy.array(page_ids),
+                'unique': unique,
+                'goals': goals,
+                'conversion': conversion,
+            }
+
+        data = {}
+        for page_id, page_unique, page_goals in zip(page_ids, unique, goals):
+            data[page_id] = {
+                'unique': page_unique,
+                'goals': page_goals,
+                'conversion': cls._get_conversion(page_goals, page_unique),
+            }
+        return data
 
     def get_goals(self):
         return self._get_count_by(self.goals_key)
@@ -532,6 +1378,53 @@ class TotalMetrics(MetricsAbstract):
             self._increment_by(self.goals_key, -abs(goals))
 
     def clean_up(self):
-        self._del_by(self.unique_key)
-        self._del_by(self.goals_key)
-        self._del_by(self.details_key)
+        self._del_by(self.unique_key, self.goals_key, self.details_key)
+
+
+class MetricsBatch(object):
+    """
+    Unit of work for one tracked hit.
+    Writes of all bound metrics are queued into one non-transactional
+    pipeline and sent to redis by single round trip.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.pipeline = MetricsAbstract._track_expires(
+            redis.pipeline(transaction=False))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.reset()
+
+    def reset(self):
+        """
+        Discard queued commands, EXPIREATs of them are not cached
+        """
+        self.pipeline.reset()
+        MetricsAbstract._confirm_expires(self.pipeline)
+        MetricsAbstract._track_expires(self.pipeline)
+
+    def bind(self, metrics_class, *args, **kwargs):
+        """
+        Create metrics instance, which writes into current batch
+        """
+        kwargs['redis'] = self.redis
+        kwargs['pipeline'] = self.pipeline
+        return metrics_class(*args, **kwargs)
+
+    def execute(self):
+        """
+        Send all queued commands, replies returned in order of queueing
+        """
+        replies = None
+        try:
+            replies = self.pipeline.execute()
+            return replies
+        finally:
+            MetricsAbstract._confirm_expires(self.pipeline, replies)
+            MetricsAbstract._track_expires(self.pipeline)
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import logging
+import threading
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class CounterAggregator(object):
+    """
+    Write-behind aggregator for counters.
+
+    Deltas are merged in memory by (key, field) and flushed to redis
+    as INCRBY/HINCRBY/ZINCRBY batches from background thread, when
+    ``interval`` seconds passed or ``max_keys`` distinct counters
+    was collected.
+    Redis commands count depends on distinct counters, not on hits.
+
+    Loss is bounded: on crash only not flushed deltas are lost, i.e. not
+    more than ``interval`` seconds of traffic. When redis is unavailable,
+    deltas are kept for retry, but not more than ``max_pending`` distinct
+    counters, new counters over the limit are dropped and counted in stats.
+    Delta, which command was rejected by redis (e.g. WRONGTYPE), is retried
+    not more than ``max_retries`` times, then it is dropped and logged.
+    """
+    def __init__(self, redis, interval=1.0, max_keys=10000, max_pending=None,
+                 batch_size=1000, max_retries=3, autostart=True):
+        self.redis = redis
+        self.interval = interval
+        self.max_keys = max_keys
+        self.max_pending = max_pending or max_keys * 10
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+
+        self._deltas = {}
+        self._expires = {}
+        self._failures = {}
+        self._hits = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._registered = False
+
+        self._stats = {
+            'hits': 0,
+            'commands': 0,
+            'flushes': 0,
+            'errors': 0,
+            'dropped': 0,
+            'flush_time_last': 0.0,
+            'flush_time_max': 0.0,
+            'flush_time_total': 0.0,
+        }
+
+        if autostart:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _add(self, key, field, amount, sorted_set=False):
+        with self._lock:
+            index = (key, field, sorted_set)
+            if index in self._deltas:
+                self._deltas[index] += amount
+            elif len(self._deltas) < self.max_pending:
+                self._deltas[index] = amount
+            else:
+                self._stats['dropped'] += 1
+                return
+            self._hits += 1
+            size = len(self._deltas)
+        if size >= self.max_keys:
+            self._wakeup.set()
+
+    def increment(self, key, amount=1):
+        """
+        Queue INCRBY delta for key
+        """
+        self._add(key, None, amount)
+
+    def hash_increment(self, key, field, amount=1):
+        """
+        Queue HINCRBY delta for hash field
+        """
+        self._add(key, field, amount)
+
+    def sorted_increment(self, key, member, amount=1):
+        """
+        Queue ZINCRBY delta for member of sorted set
+        """
+        self._add(key, member, amount, sorted_set=True)
+
+    def expire_at(self, key, timestamp):
+        """
+        Queue EXPIREAT for key, it is sent after deltas of flush
+        """
+        with self._lock:
+            self._expires[key] = timestamp
+
+    def _restore(self, deltas, hits, expires=None):
+        """
+        Merge not flushed deltas back for next retry
+        """
+        with self._lock:
+            for key, timestamp in (expires or {}).items():
+                self._expires.setdefault(key, timestamp)
+            for index, amount in deltas.items():
+                if index in self._deltas:
+                    self._deltas[index] += amount
+                elif len(self._deltas) < self.max_pending:
+                    self._deltas[index] = amount
+                else:
+                    self._stats['dropped'] += 1
+            self._hits += hits
+
+    def _record_sent(self, hits, commands):
+        with self._lock:
+            self._stats['hits'] += hits
+            self._stats['commands'] += commands
+
+    def _check_replies(self, batch, replies):
+        """
+        Keep deltas of rejected commands for retry, return count of
+        applied deltas. Pipeline is not transactional, other commands
+        of batch are applied and must not be sent again
+        """
+        failed = {}
+        applied = 0
+        with self._lock:
+            for (index, amount), reply in zip(batch, replies):
+                if not isinstance(reply, Exception):
+                    self._failures.pop(index, None)
+                    applied += 1
+                    continue
+                self._stats['errors'] += 1
+                failures = self._failures.get(index, 0) + 1
+                if failures < self.max_retries:
+                    self._failures[index] = failures
+                    failed[index] = amount
+                    continue
+                self._failures.pop(index, None)
+                self._stats['dropped'] += 1
+                logger.error('[aggregator] delta %s of %s:%s is dropped: %s',
+                             amount, index[0], index[1], reply)
+        if failed:
+            self._restore(failed, 0)
+        return applied
+
+    def flush(self):
+        """
+        Send all collected deltas to redis, return count of applied deltas.
+        Deltas are sent before EXPIREATs, on failure only not sent part
+        is kept for retry: deltas of executed batches are not sent again,
+        when only EXPIREATs were failed, only they are retried
+        """
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+                expires, self._expires = self._expires, {}
+                hits, self._hits = self._hits, 0
+            if not deltas and not expires:
+                return 0
+
+            started = time()
+            items = list(deltas.items())
+            sent = applied = 0
+            try:
+                for i in range(0, len(items), self.batch_size):
+                    pipe = self.redis.pipeline(transaction=False)
+                    batch = items[i:i + self.batch_size]
+                    for (key, field, sorted_set), amount in batch:
+                        if sorted_set:
+                            pipe.execute_command(
+                                'ZINCRBY', key, amount, field)
+                        elif field is None:
+                            pipe.incrby(key, amount)
+                        else:
+                            pipe.hincrby(key, field, amount)
+                    replies = pipe.execute(raise_on_error=False)
+                    sent = i + len(batch)
+                    applied += self._check_replies(batch, replies)
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+                # hits are accounted by first executed batch
+                if sent:
+                    self._record_sent(hits, applied)
+                    hits = 0
+                self._restore(dict(items[sent:]), hits, expires)
+                raise
+            self._record_sent(hits, applied)
+
+            try:
+                self._send_expires(expires)
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+                self._restore({}, 0, expires)
+                raise
+
+            elapsed = time() - started
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['flush_time_last'] = elapsed
+                self._stats['flush_time_total'] += elapsed
+                if elapsed > self._stats['flush_time_max']:
+                    self._stats['flush_time_max'] = elapsed
+            return applied
+
+    def _send_expires(self, expires):
+        items = list(expires.items())
+        for i in range(0, len(items), self.batch_size):
+            pipe = self.redis.pipeline(transaction=False)
+            for key, timestamp in items[i:i + self.batch_size]:
+                pipe.expireat(key, timestamp)
+            pipe.execute()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.warning('[aggregator] flush failed: %s', exc)
+
+    def start(self):
+        """
+        Start background flushing thread, collected data will be flushed
+        on interpreter exit too
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='metrics-aggregator')
+        self._thread.daemon = True
+        self._thread.start()
+        if not self._registered:
+            atexit.register(self.close)
+            self._registered = True
+
+    def close(self):
+        """
+        Stop background thread and flush rest of data
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def pending(self):
+        """
+        Count of distinct counters, which are waiting for flush
+        """
+        with self._lock:
+            return len(self._deltas)
+
+    def get_stats(self):
+        """
+        Flush statistics with coalescing ratio (hits per redis command)
+        and flush latency in seconds
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._deltas)
+        commands = stats['commands']
+        flushes = stats['flushes']
+        stats['coalescing_ratio'] = (
+            float(stats['hits']) / commands if commands else 0.0)
+        stats['flush_time_avg'] = (
+            stats['flush_time_total'] / flushes if flushes else 0.0)
+        return stats
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asyncio variants of metrics classes, built on `redis.asyncio` client.
+
+Writes are delegated to sync metrics classes, which queue commands
+into asyncio pipeline, so keys are built by the same code.
+Every write call is sent by single round trip.
+"""
+
+import asyncio
+from json import loads
+
+from metrics import (
+    HourMetrics, MetricsAbstract, TariffStats, TotalMetrics, UtmMetrics,
+    VisitorMetrics)
+
+
+async def _execute(pipe):
+    """
+    Execute tracked pipeline and confirm its EXPIREATs
+    """
+    replies = None
+    try:
+        replies = await pipe.execute()
+        return replies
+    finally:
+        MetricsAbstract._confirm_expires(pipe, replies)
+
+
+def _get_pipeline(redis):
+    return MetricsAbstract._track_expires(redis.pipeline(transaction=False))
+
+
+class AsyncMetricsBatch(object):
+    """
+    Share one pipeline between async metrics of one hit.
+    Writes, which were queued in the same loop iteration
+    (e.g. by `asyncio.gather`), are sent by single round trip
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.pipeline = _get_pipeline(redis)
+        self._future = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and len(self.pipeline):
+            await self.execute()
+
+    def bind(self, metrics_class, *args, **kwargs):
+        """
+        Create async metrics instance, which writes into current batch
+        """
+        kwargs['redis'] = self.redis
+        kwargs['batch'] = self
+        return metrics_class(*args, **kwargs)
+
+    async def execute(self):
+        """
+        Send all queued commands
+        """
+        pipe, self.pipeline = self.pipeline, _get_pipeline(self.redis)
+        return await _execute(pipe)
+
+    async def _send(self, future):
+        self._future = None
+        try:
+            future.set_result(await self.execute())
+        except Exception as exc:
+            future.set_exception(exc)
+
+    def commit(self):
+        """
+        Wait for sending of queued commands. All callers of current
+        loop iteration share one round trip
+        """
+        if self._future is None:
+            loop = asyncio.get_event_loop()
+            self._future = loop.create_future()
+            loop.call_soon(asyncio.ensure_future, self._send(self._future))
+        return self._future
+
+
+def _async_write(name):
+    async def method(self, *args, **kwargs):
+        return await self._write(name, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class AsyncMetricsAbstract(object):
+    """
+    Base class for async metrics, wraps sync metrics instance
+    """
+    metrics_class = None
+    write_methods = ()
+
+    def __init__(self, *args, **kwargs):
+        self.batch = kwargs.pop('batch', None)
+        self.save_variant = kwargs.pop('save_variant', True)
+        self._variant_saved = False
+
+        kwargs['save_variant'] = False
+        self.metrics = self.metrics_class(*args, **kwargs)
+        self.redis = self.metrics.redis
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.write_methods:
+            setattr(cls, name, _async_write(name))
+
+    def _get_redis_key(self, args):
+        return self.metrics._get_redis_key(args)
+
+    async def _write(self, name, *args, **kwargs):
+        """
+        Queue commands of sync write method and send them
+        """
+        if self.batch is not None:
+            pipe = self.batch.pipeline
+        else:
+            pipe = _get_pipeline(self.redis)
+
+        self.metrics.pipeline = pipe
+        if self.save_variant and not self._variant_saved:
+            self.metrics.save_variant = True
+            self.metrics._save_variants()
+            self.metrics.save_variant = False
+            self._variant_saved = True
+        getattr(self.metrics, name)(*args, **kwargs)
+        self.metrics.pipeline = None
+
+        if self.batch is not None:
+            return await self.batch.commit()
+        return await _execute(pipe)
+
+    async def _get_count_by(self, key):
+        return await self.metrics._queue_count(self.redis, key) or 0
+
+    async def get_unique_estimate(self, month=False):
+        return await self.redis.pfcount(
+            self.metrics._get_hll_keys()[-1 if month else 0])
+
+    async def get_variants(self):
+        return await self.redis.hkeys('%s:%s:%s' % (
+            self.metrics.namespace, self.metrics.date_string,
+            self.metrics.variants_key))
+
+
+class AsyncVisitorMetrics(AsyncMetricsAbstract):
+    metrics_class = VisitorMetrics
+    write_methods = (
+        'save_visitor', 'save_goal', 'decrease_goal',
+        'save_additional', 'decrease_additional',
+    )
+
+    async def get_unique(self):
+        return await self._get_count_by(VisitorMetrics.unique_key)
+
+    async def get_visits(self):
+        return await self._get_count_by(VisitorMetrics.visits_key)
+
+    async def get_goals(self):
+        return await self._get_count_by(VisitorMetrics.goals_key)
+
+    async def get_additional_list(self):
+        metrics = self.metrics
+        prefix = metrics.compact and metrics.compact_maps.get(
+            metrics.additional_key)
+        if prefix:
+            ad_list = metrics._unpack_map(await self.redis.hgetall(
+                self._get_redis_key(metrics.packed_key)), prefix)
+        else:
+            ad_list = await self.redis.hgetall(
+                self._get_redis_key(metrics.additional_key))
+        return VisitorMetrics._build_additional_list(ad_list)
+
+    async def get_details(self, offset=0, limit=None, page_size=500):
+        key = self._get_redis_key(VisitorMetrics.details_key)
+        keys = ['ip', 'time', 'channel']
+        stop = offset + limit if limit else None
+        start = offset
+        while stop is None or start < stop:
+            end = start + page_size - 1
+            if stop is not None:
+                end = min(end, stop - 1)
+            data = await self.redis.lrange(key, start, end)
+            for line in data:
+                yield dict(zip(keys, loads(line)))
+            if len(data) <= end - start:
+                return
+            start = end + 1
+
+    async def get_geo(self, limit=None, order_by=None):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self._get_redis_key(VisitorMetrics.geo_unique_key))
+        pipe.hgetall(self._get_redis_key(VisitorMetrics.geo_goals_key))
+        unique_list, goals_list = await pipe.execute()
+        data = (VisitorMetrics._get_geo_row(ip, unique, goals_list.get(ip))
+                for ip, unique in unique_list.items())
+        return VisitorMetrics._limit_geo(data, limit, order_by)
+
+
+class AsyncUtmMetrics(AsyncMetricsAbstract):
+    metrics_class = UtmMetrics
+    write_methods = (
+        'save_utm', 'save_visit_with_utm', 'save_utm_goal',
+        'decrease_utm_goal',
+    )
+
+    async def get_utm(self):
+        pipe = self.metrics._queue_utm(
+            self.redis.pipeline(transaction=False))
+        return UtmMetrics._build_utm(*await pipe.execute())
+
+
+class AsyncHourMetrics(AsyncMetricsAbstract):
+    metrics_class = HourMetrics
+    write_methods = (
+        'save_visitor', 'save_goal', 'save_lead',
+        'decrease_lead', 'decrease_goal',
+    )
+
+    async def get_hours_stats(self):
+        return HourMetrics._build_hours_stats(await self.redis.hgetall(
+            self._get_redis_key(HourMetrics.hour_key)))
+
+
+class AsyncTotalMetrics(AsyncMetricsAbstract):
+    metrics_class = TotalMetrics
+    write_methods = ('save_unique', 'save_goal', 'decrease_goal')
+
+    async def get_unique(self):
+        return await self._get_count_by(TotalMetrics.unique_key)
+
+    async def get_goals(self):
+        return await self._get_count_by(TotalMetrics.goals_key)
+
+    async def get_conversion(self):
+        pipe = self.redis.pipeline(transaction=True)
+        self.metrics._queue_count(pipe, TotalMetrics.goals_key)
+        self.metrics._queue_count(pipe, TotalMetrics.unique_key)
+        goals, unique = await pipe.execute()
+        return TotalMetrics._get_conversion(goals, unique)
+
+    async def get_conversions(self):
+        return '%0.2f' % await self.get_conversion()
+
+
+class AsyncTariffStats(AsyncMetricsAbstract):
+    metrics_class = TariffStats
+    write_methods = ('save_unique',)
+
+    async def get_unique(self):
+        return await self._get_count_by(TariffStats.tariff_key)
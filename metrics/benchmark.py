@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of public save_*/get_* methods of all metrics classes.
+
+Every operation is measured by ops/sec, p50/p99 latency and by redis
+round trips & commands per call, which are counted by client wrapper.
+Data is generated synthetically: count of variants, utm terms per hit,
+ips per day and length of details list can be scaled.
+
+Usage:
+
+    python -m metrics.benchmark --host localhost --port 6379 --db 15
+    python -m metrics.benchmark --fake --iterations 200 --output out.json
+    python -m metrics.benchmark --micro --iterations 10000
+    python -m metrics.benchmark --memory --iterations 10000
+
+Without redis-server in-process `fakeredis` can be used (`--fake`),
+latency is not comparable with real server in this case,
+but round trips & commands are. With `MemoryStorage` (`--memory`)
+latency is overhead of library without network.
+
+Microbenchmarks (`--micro`) need no redis: commands are dropped by null
+client, so only client-side CPU time & memory of one hit are measured
+for metrics classes and for stateless facades.
+"""
+
+import argparse
+import json
+import random
+import sys
+from time import time
+
+try:
+    from time import process_time
+except ImportError:
+    from time import clock as process_time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from metrics import (
+    HourMetrics, MetricsBatch, TariffStats, TotalMetrics, UtmMetrics,
+    VisitorMetrics)
+from metrics.cache import LocalCache
+from metrics.cleanup import KeysCleaner
+from metrics.facade import (
+    HourFacade, MetricsFacade, UtmFacade, VisitorFacade)
+from metrics.observer import CountingRedis
+
+
+class Benchmark(object):
+    """
+    Prepare synthetic data and measure every operation.
+    Metrics are written with `benchmark_` namespaces, so real data
+    is not changed
+    """
+    prefix = 'benchmark_'
+    date_string = '2000-01-01'
+    page_id = 1
+    profile_id = 1
+    channel_id = 1
+
+    def __init__(self, redis, iterations=1000, variants=100, utm_terms=3,
+                 ips=1000, details=1000, seed=0):
+        self.redis = CountingRedis(redis)
+        self.iterations = iterations
+        self.variants = variants
+        self.utm_terms = utm_terms
+        self.ips = ips
+        self.details = details
+        self.random = random.Random(seed)
+
+        for metrics_class in (VisitorMetrics, UtmMetrics, HourMetrics,
+                              TotalMetrics, TariffStats):
+            setattr(self, metrics_class.__name__, type(
+                metrics_class.__name__, (metrics_class,),
+                {'namespace': self.prefix + metrics_class.namespace}))
+
+    def _get_ip(self):
+        index = self.random.randrange(self.ips)
+        return '10.%s.%s.%s' % (
+            index >> 16 & 255, index >> 8 & 255, index & 255)
+
+    def _get_data(self):
+        return [self._get_ip(), time(), None]
+
+    def _get_utm_params(self):
+        terms = ['term%s' % self.random.randrange(self.utm_terms * 10)
+                 for i in range(self.utm_terms)]
+        return {
+            'utm_medium': 'cpc',
+            'utm_campaign': 'campaign%s' % self.random.randrange(10),
+            'utm_term': ','.join(terms),
+        }
+
+    def _get_additional_params(self):
+        return {'ad_id': 10, 'ad_type': 1, 'ad_label': 'form'}
+
+    def _get_variant_id(self):
+        return self.random.randrange(1, self.variants + 1)
+
+    def populate(self):
+        """
+        Fill every variant by visits of `ips` addresses,
+        details list has `details` items
+        """
+        redis = self.redis.redis
+        for variant_id in range(1, self.variants + 1):
+            with MetricsBatch(redis) as batch:
+                visitor = batch.bind(
+                    self.VisitorMetrics, variant_id, self.date_string)
+                utm = batch.bind(
+                    self.UtmMetrics, variant_id, self.date_string)
+                hour = batch.bind(
+                    self.HourMetrics, variant_id, self.date_string)
+                for i in range(max(self.ips, self.details)):
+                    visitor.save_visitor(
+                        int(i < self.details), self._get_data())
+                    if i % 10 == 0:
+                        visitor.save_goal(self._get_data())
+                        utm.save_utm_goal(
+                            self.channel_id, self._get_utm_params(),
+                            self._get_additional_params())
+                    hour.save_visitor(1)
+            self.TotalMetrics(variant_id, redis).save_unique()
+
+    def clean_up(self):
+        """
+        Delete all benchmark keys
+        """
+        return KeysCleaner(self.redis.redis).delete_pattern(
+            self.prefix + '*')[0]
+
+    def get_operations(self):
+        """
+        Get (name, callable) of all measured operations
+        """
+        date = self.date_string
+        redis = self.redis
+
+        def visitor():
+            return self.VisitorMetrics(self._get_variant_id(), date, redis)
+
+        def utm():
+            return self.UtmMetrics(self._get_variant_id(), date, redis)
+
+        def hour():
+            return self.HourMetrics(self._get_variant_id(), date, redis)
+
+        def total():
+            return self.TotalMetrics(self._get_variant_id(), redis)
+
+        def tariff():
+            return self.TariffStats(self.profile_id, date, redis)
+
+        variant_ids = list(range(1, self.variants + 1))
+        return [
+            ('VisitorMetrics.save_visitor', lambda: visitor().save_visitor(
+                1, self._get_data())),
+            ('VisitorMetrics.save_goal', lambda: visitor().save_goal(
+                self._get_data())),
+            ('VisitorMetrics.save_additional',
+             lambda: visitor().save_additional(
+                 **self._get_additional_params())),
+            ('VisitorMetrics.get_unique', lambda: visitor().get_unique()),
+            ('VisitorMetrics.get_visits', lambda: visitor().get_visits()),
+            ('VisitorMetrics.get_goals', lambda: visitor().get_goals()),
+            ('VisitorMetrics.get_additional_list',
+             lambda: visitor().get_additional_list()),
+            ('VisitorMetrics.get_details',
+             lambda: list(visitor().get_details(limit=100))),
+            ('VisitorMetrics.get_details_count',
+             lambda: visitor().get_details_count()),
+            ('VisitorMetrics.get_details_overflow',
+             lambda: visitor().get_details_overflow()),
+            ('VisitorMetrics.get_geo', lambda: visitor().get_geo()),
+            ('VisitorMetrics.get_top_geo',
+             lambda: visitor().get_top_geo(10)),
+            ('VisitorMetrics.get_geo_countries',
+             lambda: visitor().get_geo_countries()),
+            ('VisitorMetrics.get_geo_regions',
+             lambda: visitor().get_geo_regions()),
+            ('VisitorMetrics.get_unique_estimate',
+             lambda: visitor().get_unique_estimate()),
+            ('VisitorMetrics.get_variants',
+             lambda: visitor().get_variants()),
+            ('UtmMetrics.save_utm', lambda: utm().save_utm(
+                self.channel_id, self._get_utm_params(),
+                self._get_additional_params())),
+            ('UtmMetrics.save_visit_with_utm',
+             lambda: utm().save_visit_with_utm(
+                 1, self.channel_id, self._get_utm_params())),
+            ('UtmMetrics.save_utm_goal', lambda: utm().save_utm_goal(
+                self.channel_id, self._get_utm_params(),
+                self._get_additional_params())),
+            ('UtmMetrics.get_utm', lambda: utm().get_utm()),
+            ('HourMetrics.save_visitor', lambda: hour().save_visitor(1)),
+            ('HourMetrics.save_goal', lambda: hour().save_goal()),
+            ('HourMetrics.save_lead', lambda: hour().save_lead()),
+            ('HourMetrics.get_hours_stats',
+             lambda: hour().get_hours_stats()),
+            ('TotalMetrics.save_unique', lambda: total().save_unique()),
+            ('TotalMetrics.save_goal', lambda: total().save_goal()),
+            ('TotalMetrics.get_unique', lambda: total().get_unique()),
+            ('TotalMetrics.get_goals', lambda: total().get_goals()),
+            ('TotalMetrics.get_conversion',
+             lambda: total().get_conversion()),
+            ('TotalMetrics.get_conversions',
+             lambda: total().get_conversions()),
+            ('TotalMetrics.get_bulk',
+             lambda: self.TotalMetrics.get_bulk(redis, variant_ids)),
+            ('TariffStats.save_unique', lambda: tariff().save_unique()),
+            ('TariffStats.get_unique', lambda: tariff().get_unique()),
+            ('TariffStats.get_unique_estimate',
+             lambda: tariff().get_unique_estimate()),
+        ]
+
+    @staticmethod
+    def _percentile(values, percent):
+        index = int(round(percent / 100.0 * (len(values) - 1)))
+        return values[index]
+
+    def measure(self, operation):
+        """
+        Run operation `iterations` times, return stats of single call
+        """
+        latencies = []
+        self.redis.reset()
+        for i in range(self.iterations):
+            started = time()
+            operation()
+            latencies.append(time() - started)
+        total = sum(latencies)
+        latencies.sort()
+        return {
+            'ops_per_second': self.iterations / total if total else 0.0,
+            'p50_ms': self._percentile(latencies, 50) * 1000,
+            'p99_ms': self._percentile(latencies, 99) * 1000,
+            'round_trips_per_call':
+                float(self.redis.round_trips) / self.iterations,
+            'commands_per_call':
+                float(self.redis.commands) / self.iterations,
+        }
+
+    def run(self, names=None):
+        """
+        Measure all operations (or operations with specified names),
+        return machine-readable report
+        """
+        results = {}
+        for name, operation in self.get_operations():
+            if names and name not in names:
+                continue
+            results[name] = self.measure(operation)
+        return {
+            'params': {
+                'iterations': self.iterations,
+                'variants': self.variants,
+                'utm_terms': self.utm_terms,
+                'ips': self.ips,
+                'details': self.details,
+            },
+            'results': results,
+        }
+
+
+def run_benchmarks(redis, names=None, **params):
+    """
+    Populate data, measure operations and delete benchmark keys
+    """
+    benchmark = Benchmark(redis, **params)
+    benchmark.populate()
+    try:
+        return benchmark.run(names)
+    finally:
+        benchmark.clean_up()
+
+
+class NullRedis(object):
+    """
+    Client, which drops all commands
+    """
+    def __getattr__(self, name):
+        return self._command
+
+    def _command(self, *args, **kwargs):
+        return None
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return NullPipeline()
+
+
+class NullPipeline(object):
+    def __len__(self):
+        return 0
+
+    def __getattr__(self, name):
+        return self._command
+
+    def _command(self, *args, **kwargs):
+        return self
+
+    def execute(self, raise_on_error=True):
+        return []
+
+
+class MicroBenchmark(Benchmark):
+    """
+    Measure CPU time & allocated memory of one hit on client side.
+    Metrics classes are created for every hit, facades are created once
+    per variant and reused
+    """
+    def __init__(self, iterations=10000, variants=100, utm_terms=3,
+                 seed=0):
+        super(MicroBenchmark, self).__init__(
+            NullRedis(), iterations, variants, utm_terms, seed=seed)
+        self.redis = self.redis.redis
+        self.facades = {}
+
+    def _get_facades(self, variant_id):
+        facades = self.facades.get(variant_id)
+        if facades is None:
+            facades = self.facades[variant_id] = tuple(
+                facade_class(variant_id, self.date_string, self.redis)
+                for facade_class in (VisitorFacade, UtmFacade, HourFacade))
+        return facades
+
+    def get_operations(self):
+        date = self.date_string
+        redis = self.redis
+
+        def classic_hit():
+            variant_id = self._get_variant_id()
+            with MetricsBatch(redis) as batch:
+                batch.bind(VisitorMetrics, variant_id, date).save_visitor(
+                    1, self._get_data())
+                batch.bind(UtmMetrics, variant_id, date).save_visit_with_utm(
+                    1, self.channel_id, self._get_utm_params())
+                batch.bind(HourMetrics, variant_id, date).save_visitor(1)
+
+        def facade_hit():
+            visitor, utm, hour = self._get_facades(self._get_variant_id())
+            pipe = redis.pipeline(transaction=False)
+            visitor.save_visitor(1, self._get_data(), pipeline=pipe)
+            utm.save_visit_with_utm(
+                1, self.channel_id, self._get_utm_params(), pipeline=pipe)
+            hour.save_visitor(1, pipeline=pipe)
+            pipe.execute()
+
+        return [
+            ('VisitorMetrics.save_visitor',
+             lambda: VisitorMetrics(
+                 self._get_variant_id(), date, redis).save_visitor(
+                     1, self._get_data())),
+            ('VisitorFacade.save_visitor',
+             lambda: self._get_facades(
+                 self._get_variant_id())[0].save_visitor(
+                     1, self._get_data())),
+            ('UtmMetrics.save_visit_with_utm',
+             lambda: UtmMetrics(
+                 self._get_variant_id(), date, redis).save_visit_with_utm(
+                     1, self.channel_id, self._get_utm_params())),
+            ('UtmFacade.save_visit_with_utm',
+             lambda: self._get_facades(
+                 self._get_variant_id())[1].save_visit_with_utm(
+                     1, self.channel_id, self._get_utm_params())),
+            ('HourMetrics.save_visitor',
+             lambda: HourMetrics(
+                 self._get_variant_id(), date, redis).save_visitor(1)),
+            ('HourFacade.save_visitor',
+             lambda: self._get_facades(
+                 self._get_variant_id())[2].save_visitor(1)),
+            ('MetricsBatch.hit', classic_hit),
+            ('MetricsFacade.hit', facade_hit),
+        ]
+
+    def _measure_memory(self, operation, samples=100):
+        """
+        Average peak of memory allocated by one call, in bytes
+        """
+        if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+            return None
+        tracemalloc.start()
+        try:
+            total = 0
+            for i in range(samples):
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                operation()
+                total += tracemalloc.get_traced_memory()[1] - current
+            return float(total) / samples
+        finally:
+            tracemalloc.stop()
+
+    def measure(self, operation):
+        # seen-sets are warmed, as for long running worker
+        operation()
+        started = process_time()
+        for i in range(self.iterations):
+            operation()
+        elapsed = process_time() - started
+        return {
+            'cpu_us_per_call': elapsed * 1000000 / self.iterations,
+            'peak_bytes_per_call': self._measure_memory(operation),
+        }
+
+
+def run_microbenchmarks(names=None, **params):
+    """
+    Compare client-side cost of metrics classes and facades per hit
+    """
+    variants_cache = MetricsFacade.variants_cache
+    MetricsFacade.variants_cache = LocalCache(maxsize=variants_cache.maxsize)
+    try:
+        return MicroBenchmark(**params).run(names)
+    finally:
+        MetricsFacade.variants_cache = variants_cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--fake', action='store_true',
+                        help='use in-process fakeredis')
+    parser.add_argument('--memory', action='store_true',
+                        help='use in-process MemoryStorage, no network')
+    parser.add_argument('--micro', action='store_true',
+                        help='client-side CPU & memory, redis is not used')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--variants', type=int, default=100)
+    parser.add_argument('--utm-terms', type=int, default=3)
+    parser.add_argument('--ips', type=int, default=1000)
+    parser.add_argument('--details', type=int, default=1000)
+    parser.add_argument('--operation', action='append', dest='names')
+    parser.add_argument('--output', help='JSON file, default is stdout')
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        report = run_microbenchmarks(
+            names=args.names, iterations=args.iterations,
+            variants=args.variants, utm_terms=args.utm_terms)
+    elif args.fake:
+        import fakeredis
+        redis = fakeredis.FakeStrictRedis(decode_responses=True)
+    elif args.memory:
+        from metrics.storage import MemoryStorage
+        redis = MemoryStorage()
+    else:
+        from redis import StrictRedis
+        redis = StrictRedis(host=args.host, port=args.port, db=args.db,
+                            decode_responses=True)
+
+    if not args.micro:
+        report = run_benchmarks(
+            redis, names=args.names, iterations=args.iterations,
+            variants=args.variants, utm_terms=args.utm_terms, ips=args.ips,
+            details=args.details)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
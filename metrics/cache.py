@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+from functools import wraps
+from time import time
+
+
+MISSING = object()
+
+
+class LocalCache(object):
+    """
+    In-process LRU cache with TTL
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return MISSING
+            expires, value = item
+            if expires < time():
+                del self._data[key]
+                return MISSING
+            self._data[key] = self._data.pop(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache(object):
+    """
+    Shared cache tier, values are pickled into redis strings with TTL
+    """
+    def __init__(self, redis, ttl=3600, prefix='metrics_cache'):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _get_key(self, key):
+        return '%s:%s' % (self.prefix, ':'.join(map(str, key)))
+
+    def get(self, key):
+        value = self.redis.get(self._get_key(key))
+        if value is None:
+            return MISSING
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        self.redis.setex(
+            self._get_key(key), self.ttl,
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class ReportCache(object):
+    """
+    Two-tier cache for report getters.
+    In-process LRU is checked first, shared tier fills it on miss
+    """
+    def __init__(self, local=None, shared=None):
+        self.local = local if local is not None else LocalCache()
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is MISSING and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not MISSING:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+
+def cached_report(method):
+    """
+    Cache result of metrics getter, when metrics object has cache.
+    Cache key contains variant-day version, which is bumped by writers,
+    so changed data is recomputed once per version.
+    Caller gets a copy, so cached value can't be changed by it
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        key = (self.namespace, self.date_string, self.variant_id,
+               method.__name__, args, tuple(sorted(kwargs.items())),
+               self._get_version())
+        value = self.cache.get(key)
+        if value is MISSING:
+            value = method(self, *args, **kwargs)
+            self.cache.set(key, value)
+        return deepcopy(value)
+    return wrapper
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+from copy import copy
+from time import sleep, time
+
+from redis.exceptions import ResponseError
+
+from metrics.sharding import fan_out, is_distributed
+
+
+class KeysCleaner(object):
+    """
+    Incremental keys deletion without blocking redis server.
+
+    Keyspace is walked by SCAN cursor with specified COUNT hint,
+    found keys are removed by pipelined UNLINK batches
+    (DEL is used for redis servers without UNLINK).
+    Deletion can be throttled by ``rate_limit`` keys per second,
+    and stopped & resumed from returned cursor.
+    """
+    def __init__(self, redis, count=1000, batch_size=500, rate_limit=None,
+                 dry_run=False, use_unlink=True):
+        self.redis = redis
+        self.count = count
+        self.batch_size = batch_size
+        self.rate_limit = rate_limit
+        self.dry_run = dry_run
+        self.use_unlink = use_unlink
+
+        self._started = None
+        self._processed = 0
+
+    def _throttle(self, amount):
+        """
+        Sleep, when deletion is faster than rate limit
+        """
+        if not self.rate_limit:
+            return
+        if self._started is None:
+            self._started = time()
+        self._processed += amount
+        delay = self._processed / float(self.rate_limit) - (
+            time() - self._started)
+        if delay > 0:
+            sleep(delay)
+
+    def _execute(self, keys, command):
+        pipe = self.redis.pipeline(transaction=False)
+        for i in range(0, len(keys), self.batch_size):
+            pipe.execute_command(command, *keys[i:i + self.batch_size])
+        return sum(pipe.execute())
+
+    def delete_keys(self, keys):
+        """
+        Delete list of keys, return count of deleted keys.
+        In dry-run mode only count of keys will be returned
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        if self.dry_run:
+            return len(keys)
+        self._throttle(len(keys))
+        if self.use_unlink:
+            try:
+                return self._execute(keys, 'UNLINK')
+            except ResponseError as exc:
+                if 'unknown command' not in str(exc).lower():
+                    raise
+                self.use_unlink = False
+        return self._execute(keys, 'DEL')
+
+    def delete_pattern(self, pattern, cursor=0, limit=None):
+        """
+        Delete all keys by pattern.
+        Return count of deleted keys and cursor for resume,
+        cursor is 0, when whole keyspace was processed.
+        With `limit`, deletion is stopped after specified count of keys
+        """
+        deleted = 0
+        while True:
+            cursor, keys = self.redis.scan(
+                cursor, match=pattern, count=self.count)
+            deleted += self.delete_keys(keys)
+            if int(cursor) == 0 or (limit and deleted >= limit):
+                return deleted, int(cursor)
+
+    def delete_patterns(self, patterns, cursor=0, limit=None):
+        """
+        Delete all keys by patterns one by one.
+        Cursor is 0 or (pattern index, SCAN cursor) for resume,
+        `limit` is applied to whole call.
+        Keyspace of sharded client or cluster is scanned on every node
+        in parallel, cursor is not supported there and deletion
+        is limited per node
+        """
+        patterns = list(patterns)
+        if is_distributed(self.redis):
+            def _delete(node):
+                cleaner = copy(self)
+                cleaner.redis = node
+                return cleaner.delete_patterns(patterns, 0, limit)[0]
+            return sum(fan_out(self.redis, _delete)), 0
+
+        if not isinstance(cursor, (tuple, list)):
+            cursor = (0, cursor)
+        index, cursor = cursor
+        deleted = 0
+        for index in range(index, len(patterns)):
+            count, cursor = self.delete_pattern(
+                patterns[index], cursor, limit and limit - deleted)
+            deleted += count
+            if cursor:
+                return deleted, (index, cursor)
+            if limit and deleted >= limit and index + 1 < len(patterns):
+                return deleted, (index + 1, 0)
+        return deleted, 0
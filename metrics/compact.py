@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact layout of variant-day counters.
+
+With `compact = True` scalar counters and small maps of variant-day
+are packed into one hash `<namespace>:<date>:<variant>:packed` with
+short field codes. Small hashes are kept in listpack encoding by redis,
+so overhead of many top-level keys is removed. Maps, which can grow
+over listpack limits (geo, utm trees, hours), are still separate keys.
+
+Legacy data of existing days is moved by `convert_day`.
+"""
+
+from metrics import VisitorMetrics
+from metrics.cleanup import KeysCleaner
+from metrics.scripts import COMPACT_MOVE_SCRIPT
+from metrics.sharding import fan_out, is_distributed
+
+
+def _get_move_args(metrics_class, date_string, variant_id):
+    """
+    Get keys & args of move script for one variant-day
+    """
+    keys = [metrics_class._build_redis_key(
+        date_string, variant_id, metrics_class.packed_key)]
+    args = []
+    for key, field in sorted(metrics_class.compact_fields.items()):
+        keys.append(metrics_class._build_redis_key(
+            date_string, variant_id, key))
+        args.extend(['string', field])
+    for key, prefix in sorted(metrics_class.compact_maps.items()):
+        keys.append(metrics_class._build_redis_key(
+            date_string, variant_id, key))
+        args.extend(['hash', prefix])
+    return keys, args
+
+
+def convert_variant(redis, metrics_class, date_string, variant_id):
+    """
+    Move legacy counters of one variant-day into packed hash atomically.
+    Return count of moved values
+    """
+    keys, args = _get_move_args(metrics_class, date_string, variant_id)
+    script = redis.register_script(COMPACT_MOVE_SCRIPT)
+    return script(keys=keys, args=args)
+
+
+def convert_day(redis, date_string, metrics_class=VisitorMetrics,
+                count=1000):
+    """
+    Move legacy counters of all variants of day into packed hashes.
+    Variants are read by HSCAN chunks, every chunk is converted
+    by one pipeline. Values are added into packed hash, so day
+    can be converted while writers are switched to compact layout.
+    Return count of moved values
+    """
+    variants_key = '%s:%s:%s' % (
+        metrics_class.namespace, date_string, metrics_class.variants_key)
+    script = redis.register_script(COMPACT_MOVE_SCRIPT)
+    moved = 0
+    cursor = None
+    while cursor != 0:
+        cursor, variants = redis.hscan(variants_key, cursor or 0, count=count)
+        if not variants:
+            continue
+        pipe = redis.pipeline(transaction=False)
+        pipe.scripts.add(script)
+        for variant_id in variants:
+            if isinstance(variant_id, bytes):
+                variant_id = variant_id.decode('utf-8')
+            keys, args = _get_move_args(metrics_class, date_string, variant_id)
+            pipe.evalsha(script.sha, len(keys), *(keys + args))
+        moved += sum(pipe.execute())
+    return moved
+
+
+def drop_utm_additional_sets(redis, date_string, namespace='metrics',
+                             **options):
+    """
+    Delete `utm_additional_keys` sets of day, they are not written
+    in compact layout. Return count of deleted keys
+    """
+    if is_distributed(redis):
+        # multi-key commands are not allowed across cluster slots
+        options.setdefault('batch_size', 1)
+    patterns = ('%s:%s:*:utm_additional_keys:*',
+                '%s:{%s:*}:utm_additional_keys:*')
+    return KeysCleaner(redis, **options).delete_patterns(
+        [pattern % (namespace, date_string) for pattern in patterns])[0]
+
+
+def get_memory_usage(redis, pattern, count=1000):
+    """
+    Get count of keys and sum of MEMORY USAGE for keys by pattern,
+    nodes of sharded client or cluster are scanned in parallel
+    """
+    if is_distributed(redis):
+        usages = fan_out(redis, lambda node: get_memory_usage(
+            node, pattern, count))
+        return {'keys': sum(usage['keys'] for usage in usages),
+                'bytes': sum(usage['bytes'] for usage in usages)}
+    keys = size = 0
+    cursor = None
+    while cursor != 0:
+        cursor, chunk = redis.scan(cursor or 0, match=pattern, count=count)
+        if not chunk:
+            continue
+        pipe = redis.pipeline(transaction=False)
+        for key in chunk:
+            pipe.memory_usage(key)
+        keys += len(chunk)
+        size += sum(value or 0 for value in pipe.execute())
+    return {'keys': keys, 'bytes': size}
+
+
+def benchmark_memory(redis, variants=1000, visits=5, goals=1,
+                     date_string='2000-01-01'):
+    """
+    Write the same sample of low-traffic variants in legacy and compact
+    layouts under separate namespaces and compare memory usage.
+    Sample keys are deleted afterwards
+    """
+    result = {}
+    for name, compact in (('legacy', False), ('compact', True)):
+        metrics_class = type('Benchmark', (VisitorMetrics,), {
+            'namespace': 'benchmark_%s' % name,
+            'compact': compact,
+        })
+        pipe = redis.pipeline(transaction=False)
+        for variant_id in range(1, variants + 1):
+            metrics = metrics_class(
+                variant_id, date_string, redis, pipeline=pipe)
+            for visit in range(visits):
+                data = ['10.0.0.%s' % visit, '12:00', 'direct']
+                metrics.save_visitor(int(visit == 0), data)
+            for goal in range(goals):
+                metrics.save_goal(data)
+                metrics.save_additional(
+                    ad_id=1, ad_type='banner', ad_label='top')
+            if len(pipe) >= 10000:
+                pipe.execute()
+        pipe.execute()
+
+        pattern = '%s:*' % metrics_class.namespace
+        result[name] = get_memory_usage(redis, pattern)
+        KeysCleaner(redis).delete_pattern(pattern)
+
+    result['ratio'] = (
+        float(result['compact']['bytes']) / result['legacy']['bytes']
+        if result['legacy']['bytes'] else 0.0)
+    return result
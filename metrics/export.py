@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming export of all variants of day for database sync.
+
+Variants are read from day `variants` hash by HSCAN chunks, all counters
+and hashes of chunk are read by one pipeline, no metrics objects
+are created. Records are flat `(date, variant_id, metric, key, value)`
+tuples, so they can be written as CSV, JSON lines or columnar file
+with memory bounded by chunk size.
+"""
+
+import csv
+import zipfile
+from collections import namedtuple
+from json import dumps
+from multiprocessing import Pool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from metrics import (
+    HourMetrics, TariffStats, TotalMetrics, UtmMetrics, VisitorMetrics)
+
+
+Record = namedtuple('Record', 'date variant_id metric key value')
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class DayExporter(object):
+    """
+    Export counters, additional params, hours & utm hashes of day.
+    Geo hashes can be large, they are exported only by request.
+    Tariff stats of profiles (`profiles` section) and total counters
+    of pages (`totals` section) are read from own variants hashes.
+    Metrics classes can be replaced by subclasses, keys are built
+    by their options (namespace, hash_tag, compact)
+    """
+    counters = (
+        ('visits', 'visits_key'),
+        ('unique', 'unique_key'),
+        ('goals', 'goals_key'),
+    )
+    sections = ('counters', 'additional', 'hours', 'utm')
+    variant_sections = ('counters', 'additional', 'geo', 'hours', 'utm')
+
+    def __init__(self, redis, date_string, chunk_size=500, sections=None,
+                 visitor_class=VisitorMetrics, hour_class=HourMetrics,
+                 utm_class=UtmMetrics, tariff_class=TariffStats,
+                 total_class=TotalMetrics):
+        self.redis = redis
+        self.date_string = date_string
+        self.chunk_size = chunk_size
+        self.sections = tuple(sections or self.sections)
+        self.visitor_class = visitor_class
+        self.hour_class = hour_class
+        self.utm_class = utm_class
+        self.tariff_class = tariff_class
+        self.total_class = total_class
+
+    def _get_options(self):
+        """
+        Constructor options of worker exporter
+        """
+        return {
+            'date_string': self.date_string, 'sections': self.sections,
+            'visitor_class': self.visitor_class,
+            'hour_class': self.hour_class, 'utm_class': self.utm_class,
+            'tariff_class': self.tariff_class,
+            'total_class': self.total_class,
+        }
+
+    def _get_scopes(self):
+        """
+        Get (scope, metrics class, date) of selected sections,
+        ids of every scope are stored in variants hash of class
+        """
+        scopes = []
+        if set(self.sections) & set(self.variant_sections):
+            scopes.append(('variants', self.visitor_class, self.date_string))
+        if 'profiles' in self.sections:
+            scopes.append(('profiles', self.tariff_class, self.date_string))
+        if 'totals' in self.sections:
+            scopes.append(('totals', self.total_class,
+                           self.total_class.total_date))
+        return scopes
+
+    def iter_variants(self, metrics_class=None, date_string=None):
+        """
+        Yield chunks of variants ids of day by HSCAN
+        """
+        metrics_class = metrics_class or self.visitor_class
+        key = metrics_class._build_variants_key(
+            date_string or self.date_string)
+        cursor = None
+        while cursor != 0:
+            cursor, variants = self.redis.hscan(
+                key, cursor or 0, count=self.chunk_size)
+            if variants:
+                yield [_decode(variant_id) for variant_id in variants]
+
+    @staticmethod
+    def _queue_counter(pipe, cls, date_string, variant_id, key):
+        redis_key, field = cls._build_location(date_string, variant_id, key)
+        if field is None:
+            pipe.get(redis_key)
+        else:
+            pipe.hget(redis_key, field)
+
+    @staticmethod
+    def _queue_map(pipe, cls, date_string, variant_id, key):
+        """
+        Queue read of hash, packed hash is read for compact map
+        """
+        if cls.compact and tuple(key) in cls.compact_maps:
+            key = cls.packed_key
+        pipe.hgetall(cls._build_redis_key(date_string, variant_id, key))
+
+    @staticmethod
+    def _read_map(cls, key, reply):
+        data = dict((_decode(field), value)
+                    for field, value in reply.items())
+        prefix = cls.compact and cls.compact_maps.get(tuple(key))
+        if prefix:
+            data = cls._unpack_map(data, prefix)
+        return data
+
+    @staticmethod
+    def _get_hll_dates(date_string):
+        dates = [date_string]
+        if date_string[:7] != date_string:
+            dates.append(date_string[:7])
+        return dates
+
+    def _queue_variant(self, pipe, variant_id, scope='variants'):
+        """
+        Queue all reads of variant, return count of queued commands
+        """
+        if scope == 'profiles':
+            return self._queue_profile(pipe, variant_id)
+        if scope == 'totals':
+            return self._queue_page(pipe, variant_id)
+        date_string = self.date_string
+        visitor = self.visitor_class
+        hour = self.hour_class
+        utm = self.utm_class
+        queued = 0
+        if 'counters' in self.sections:
+            for name, attr in self.counters:
+                self._queue_counter(pipe, visitor, date_string, variant_id,
+                                    getattr(visitor, attr))
+                queued += 1
+        if 'additional' in self.sections:
+            self._queue_map(pipe, visitor, date_string, variant_id,
+                            visitor.additional_key)
+            queued += 1
+        if 'geo' in self.sections:
+            for key in (visitor.geo_unique_key, visitor.geo_goals_key):
+                self._queue_map(pipe, visitor, date_string, variant_id, key)
+                queued += 1
+        if 'hours' in self.sections:
+            self._queue_map(pipe, hour, date_string, variant_id,
+                            hour.hour_key)
+            queued += 1
+        if 'utm' in self.sections:
+            for key in utm.utm_read_keys:
+                self._queue_map(pipe, utm, date_string, variant_id, key)
+                queued += 1
+        return queued
+
+    def _queue_profile(self, pipe, profile_id):
+        cls = self.tariff_class
+        self._queue_counter(
+            pipe, cls, self.date_string, profile_id, cls.tariff_key)
+        dates = self._get_hll_dates(self.date_string)
+        for date_string in dates:
+            pipe.pfcount(cls._build_redis_key(
+                date_string, profile_id, cls.hll_key))
+        return 1 + len(dates)
+
+    def _queue_page(self, pipe, page_id):
+        cls = self.total_class
+        for key in (cls.unique_key, cls.goals_key):
+            self._queue_counter(pipe, cls, cls.total_date, page_id, key)
+        return 2
+
+    @staticmethod
+    def _hash_records(record, metric, data):
+        for key, value in data.items():
+            yield record(metric, _decode(key), int(value or 0))
+
+    def _build_records(self, variant_id, replies, scope='variants'):
+        """
+        Convert replies of one variant into flat records
+        """
+        date_string = self.date_string
+        if scope == 'totals':
+            date_string = self.total_class.total_date
+
+        def record(metric, key, value):
+            return Record(date_string, variant_id, metric, key, value)
+
+        replies = iter(replies)
+        if scope == 'profiles':
+            yield record('tariff', '', int(next(replies) or 0))
+            names = ('tariff_unique', 'tariff_unique_month')
+            for name, _ in zip(names, self._get_hll_dates(date_string)):
+                yield record(name, '', int(next(replies) or 0))
+            return
+        if scope == 'totals':
+            for name in ('unique', 'goals'):
+                yield record('total_%s' % name, '', int(next(replies) or 0))
+            return
+
+        visitor = self.visitor_class
+        hour = self.hour_class
+        utm = self.utm_class
+        if 'counters' in self.sections:
+            for name, attr in self.counters:
+                yield record(name, '', int(next(replies) or 0))
+        if 'additional' in self.sections:
+            data = self._read_map(
+                visitor, visitor.additional_key, next(replies))
+            for item in self._hash_records(record, 'additional', data):
+                yield item
+        if 'geo' in self.sections:
+            for metric, key in (('geo_unique', visitor.geo_unique_key),
+                                ('geo_goals', visitor.geo_goals_key)):
+                data = self._read_map(visitor, key, next(replies))
+                for item in self._hash_records(record, metric, data):
+                    yield item
+        if 'hours' in self.sections:
+            data = self._read_map(hour, hour.hour_key, next(replies))
+            for key, value in data.items():
+                hour_string, count_type = key.split(':')
+                name = list(hour._get_counter_key(count_type, 0))[0]
+                yield record('hour_%s' % name, hour_string, int(value or 0))
+        if 'utm' in self.sections:
+            for key in utm.utm_read_keys:
+                data = self._read_map(utm, key, next(replies))
+                metric = ':'.join(map(str, key))
+                for item in self._hash_records(record, metric, data):
+                    yield item
+
+    def export_chunk(self, variant_ids, scope='variants'):
+        """
+        Read all data of variants by one pipeline, return list of records
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        sizes = [self._queue_variant(pipe, variant_id, scope)
+                 for variant_id in variant_ids]
+        replies = pipe.execute()
+        records = []
+        offset = 0
+        for variant_id, size in zip(variant_ids, sizes):
+            records.extend(self._build_records(
+                variant_id, replies[offset:offset + size], scope))
+            offset += size
+        return records
+
+    def _iter_chunks(self):
+        for scope, metrics_class, date_string in self._get_scopes():
+            for variant_ids in self.iter_variants(metrics_class, date_string):
+                yield scope, variant_ids
+
+    def iter_records(self, processes=None, redis_factory=None):
+        """
+        Yield records of all variants of day. With `processes` chunks
+        are exported by process pool, every worker creates own client
+        by `redis_factory` (picklable callable, e.g. client class)
+        """
+        if not processes:
+            for scope, variant_ids in self._iter_chunks():
+                for record in self.export_chunk(variant_ids, scope):
+                    yield record
+            return
+
+        pool = Pool(processes)
+        try:
+            options = self._get_options()
+            tasks = ((redis_factory, options, scope, variant_ids)
+                     for scope, variant_ids in self._iter_chunks())
+            for records in pool.imap(_export_chunk, tasks):
+                for record in records:
+                    yield Record(*record)
+        finally:
+            pool.terminate()
+
+
+_worker_clients = {}
+
+
+def _export_chunk(task):
+    redis_factory, options, scope, variant_ids = task
+    if redis_factory not in _worker_clients:
+        _worker_clients[redis_factory] = redis_factory()
+    exporter = DayExporter(_worker_clients[redis_factory], **options)
+    return [tuple(record)
+            for record in exporter.export_chunk(variant_ids, scope)]
+
+
+def write_csv(records, fileobj, header=True):
+    """
+    Write records as CSV rows, return count of written records
+    """
+    writer = csv.writer(fileobj)
+    if header:
+        writer.writerow(Record._fields)
+    count = 0
+    for record in records:
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+def write_jsonl(records, fileobj):
+    """
+    Write records as JSON lines, return count of written records
+    """
+    count = 0
+    for record in records:
+        fileobj.write(dumps(record._asdict()) + '\n')
+        count += 1
+    return count
+
+
+def write_columnar(records, path, chunk_size=100000):
+    """
+    Write records into zip archive of NumPy columns. Every chunk
+    of records is stored as separate `<column>/<number>.npy` entries,
+    so memory is bounded by chunk size. Return count of records
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required for columnar export')
+
+    def _write(archive, number, chunk):
+        columns = zip(*chunk)
+        for name, values in zip(Record._fields, columns):
+            dtype = 'int64' if name == 'value' else 'U'
+            with archive.open('%s/%08d.npy' % (name, number), 'w') as f:
+                numpy.lib.format.write_array(
+                    f, numpy.array(values, dtype=dtype))
+
+    count = number = 0
+    chunk = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                _write(archive, number, chunk)
+                count += len(chunk)
+                number += 1
+                chunk = []
+        if chunk:
+            _write(archive, number, chunk)
+            count += len(chunk)
+    return count
+
+
+def read_columnar(path):
+    """
+    Read columnar file into dict of NumPy arrays
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required for columnar export')
+    parts = dict((name, []) for name in Record._fields)
+    with zipfile.ZipFile(path) as archive:
+        for entry in sorted(archive.namelist()):
+            name = entry.split('/')[0]
+            with archive.open(entry) as f:
+                parts[name].append(numpy.lib.format.read_array(f))
+    return dict(
+        (name, numpy.concatenate(arrays) if arrays else numpy.array([]))
+        for name, arrays in parts.items())
+
+
+def export_day(redis, date_string, fileobj_or_path, file_format='jsonl',
+               processes=None, redis_factory=None, **options):
+    """
+    Export day into file, file format is `csv`, `jsonl` or `columnar`.
+    Return count of written records
+    """
+    records = DayExporter(redis, date_string, **options).iter_records(
+        processes, redis_factory)
+    if file_format == 'columnar':
+        return write_columnar(records, fileobj_or_path)
+    writers = {'csv': write_csv, 'jsonl': write_jsonl}
+    if isinstance(fileobj_or_path, str):
+        with open(fileobj_or_path, 'w') as fileobj:
+            return writers[file_format](records, fileobj)
+    return writers[file_format](records, fileobj_or_path)
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stateless facades for hot write path.
+
+Facade is bound to variant-day only, all per-hit data is passed
+by arguments, so one instance can be reused by many threads.
+Redis keys are built once per facade and memoized, variant is saved
+into day variants hash once per process (bounded seen-set): with own
+pipeline it is remembered after reply, into caller `pipeline` it is
+queued once and saved again after TTL of seen-set.
+Every call is sent by single round trip, or queued into `pipeline`.
+
+Keys are the same as for metrics classes (including `hash_tag`,
+`compact` & `retention_days` options), so reports are read
+by metrics classes, e.g. by `facade.reader()`.
+"""
+
+from json import dumps
+
+from metrics import (
+    HourMetrics, TariffStats, TotalMetrics, UtmMetrics, VisitorMetrics, now)
+from metrics.cache import MISSING, LocalCache
+
+
+class MetricsFacade(object):
+    __slots__ = ('redis', 'date_string', 'variant_id', 'save_variant',
+                 '_counters', '_maps', '_variants_key', '_variant_index')
+    metrics_class = None
+
+    # (variants key, variant) pairs, which were saved by process
+    variants_cache = LocalCache(maxsize=100000, ttl=3600)
+
+    def __init__(self, variant_id, date_string, redis, save_variant=True):
+        self.redis = redis
+        self.date_string = date_string
+        self.variant_id = variant_id
+        self.save_variant = save_variant
+        self._counters = {}
+        self._maps = {}
+        self._variants_key = self.metrics_class._build_variants_key(
+            date_string)
+        self._variant_index = (self._variants_key, variant_id)
+
+    def reader(self):
+        """
+        Metrics object for reports, nothing is written by it
+        """
+        return self.metrics_class(
+            self.variant_id, self.date_string, self.redis, save_variant=False)
+
+    def _locate(self, key, field=None):
+        """
+        Get (redis key, hash field) of counter or of field of map.
+        Redis keys are memoized, so fields of maps (ips, utm nodes)
+        do not grow memo
+        """
+        locations = self._counters if field is None else self._maps
+        location = locations.get(key)
+        if location is None:
+            cls = self.metrics_class
+            if field is None:
+                location = cls._build_location(
+                    self.date_string, self.variant_id, key)
+            else:
+                prefix = cls.compact and cls.compact_maps.get(key)
+                if prefix:
+                    location = (cls._build_redis_key(
+                        self.date_string, self.variant_id, cls.packed_key),
+                        prefix)
+                else:
+                    location = (cls._build_redis_key(
+                        self.date_string, self.variant_id, key), '')
+            locations[key] = location
+        if field is None:
+            return location
+        return location[0], location[1] + field
+
+    def _is_variant_saved(self):
+        return (not (self.variant_id and self.save_variant) or
+                self.variants_cache.get(self._variant_index) is not MISSING)
+
+    def _begin(self, pipeline):
+        cls = self.metrics_class
+        pipe = pipeline
+        if pipe is None:
+            pipe = self.redis.pipeline(transaction=False)
+            if cls.retention_days:
+                cls._track_expires(pipe)
+        if not self._is_variant_saved():
+            if pipeline is not None:
+                self.variants_cache.set(self._variant_index, True)
+            pipe.hset(self._variants_key, self.variant_id, '')
+            self._expire(pipe, self._variants_key)
+        return pipe
+
+    def _end(self, pipe, pipeline):
+        cls = self.metrics_class
+        if cls.track_version:
+            self._increment(pipe, cls.version_key)
+        if pipeline is None:
+            replies = None
+            try:
+                replies = pipe.execute()
+            finally:
+                cls._confirm_expires(pipe, replies)
+            if not self._is_variant_saved():
+                self.variants_cache.set(self._variant_index, True)
+            return replies
+
+    def _expire(self, pipe, redis_key, date_string=None):
+        cls = self.metrics_class
+        expire_at = cls._get_expire_at(date_string or self.date_string)
+        if expire_at is None:
+            return
+        if cls.retention_cache.get(redis_key) is not MISSING:
+            return
+        cls._send_expire(self.redis, pipe, redis_key, expire_at)
+
+    def _increment(self, pipe, key, amount=1, field=None):
+        """
+        Increment counter or field of map
+        """
+        redis_key, field = self._locate(key, field)
+        if field is None:
+            pipe.incrby(redis_key, amount)
+        else:
+            pipe.hincrby(redis_key, field, amount)
+        self._expire(pipe, redis_key)
+
+    def _add_fingerprint(self, pipe, fingerprint):
+        """
+        Per-day & per-month HyperLogLogs, the same keys as
+        `_add_fingerprint` of metrics class
+        """
+        cls = self.metrics_class
+        dates = [self.date_string]
+        if self.date_string[:7] != self.date_string:
+            dates.append(self.date_string[:7])
+        for date_string in dates:
+            key = cls._build_redis_key(
+                date_string, self.variant_id, cls.hll_key)
+            pipe.pfadd(key, fingerprint)
+            self._expire(pipe, key, date_string)
+
+    def _top_increment(self, pipe, name, member, amount=1):
+        cls = self.metrics_class
+        if cls.top_index and amount:
+            redis_key = self._locate(cls.top_key + (name,))[0]
+            pipe.execute_command('ZINCRBY', redis_key, amount, member)
+            self._expire(pipe, redis_key)
+
+
+class VisitorFacade(MetricsFacade):
+    __slots__ = ('details_limit',)
+    metrics_class = VisitorMetrics
+
+    def __init__(self, variant_id, date_string, redis, save_variant=True,
+                 details_limit=MISSING):
+        super(VisitorFacade, self).__init__(
+            variant_id, date_string, redis, save_variant)
+        if details_limit is MISSING:
+            details_limit = self.metrics_class.details_limit
+        self.details_limit = details_limit
+
+    def _save_geo(self, pipe, ip, is_goal=0, amount=1):
+        cls = self.metrics_class
+        if cls.geo_resolver is not None:
+            for hash_key, field in cls._get_location_fields(
+                    cls.geo_resolver, ip, is_goal):
+                self._increment(pipe, hash_key, amount, field)
+            if not cls.geo_keep_ips:
+                return
+        if not is_goal:
+            self._increment(pipe, cls.geo_unique_key, amount, ip)
+            self._top_increment(pipe, 'geo_unique', ip, amount)
+        self._increment(
+            pipe, cls.geo_goals_key, is_goal and amount or is_goal, ip)
+        self._top_increment(pipe, 'geo_goals', ip, is_goal and amount)
+
+    def _save_details(self, pipe, data):
+        cls = self.metrics_class
+        key = self._locate(cls.details_key)[0]
+        pipe.lpush(key, dumps(data))
+        if self.details_limit:
+            pipe.ltrim(key, 0, self.details_limit - 1)
+            self._increment(pipe, cls.details_total_key)
+        self._expire(pipe, key)
+
+    def save_visitor(self, is_unique, data, fingerprint=None,
+                     pipeline=None):
+        cls = self.metrics_class
+        pipe = self._begin(pipeline)
+        if is_unique > 0:
+            self._increment(pipe, cls.unique_key)
+            self._save_details(pipe, data)
+            self._save_geo(pipe, data[0])
+        self._increment(pipe, cls.visits_key)
+        if fingerprint is not None:
+            self._add_fingerprint(pipe, fingerprint)
+        return self._end(pipe, pipeline)
+
+    def save_goal(self, data, amount=1, pipeline=None):
+        pipe = self._begin(pipeline)
+        self._increment(pipe, self.metrics_class.goals_key, amount)
+        self._save_geo(pipe, data[0], is_goal=1, amount=amount)
+        return self._end(pipe, pipeline)
+
+    def decrease_goal(self, data, pipeline=None):
+        return self.save_goal(data, -1, pipeline)
+
+    def save_additional(self, amount=1, pipeline=None, **kwargs):
+        if kwargs.get('ad_id') and kwargs.get('ad_type'):
+            pipe = self._begin(pipeline)
+            self._increment(
+                pipe, self.metrics_class.additional_key, amount,
+                '%(ad_id)s:%(ad_type)s:%(ad_label)s' % kwargs)
+            return self._end(pipe, pipeline)
+
+    def decrease_additional(self, amount=-1, pipeline=None, **kwargs):
+        return self.save_additional(amount, pipeline, **kwargs)
+
+
+class UtmFacade(MetricsFacade):
+    __slots__ = ()
+    metrics_class = UtmMetrics
+
+    def _get_additional_set_key(self, name):
+        cls = self.metrics_class
+        return cls._build_redis_key(
+            self.date_string, self.variant_id,
+            [cls.utm_additional_keys_key[0], name])
+
+    def _save_utm(self, pipe, channel_id, utm_params, additional_params,
+                  count_type=0, utm_amount=1):
+        cls = self.metrics_class
+        suffix = cls._build_utm_additional_suffix(
+            additional_params, count_type)
+        for hash_key, key in cls._build_utm_nodes(
+                channel_id, utm_params, count_type):
+            if suffix:
+                member = key + '-||-' + suffix
+                if not cls.compact:
+                    set_key = self._get_additional_set_key(key)
+                    pipe.sadd(set_key, member)
+                    self._expire(pipe, set_key)
+                self._increment(
+                    pipe, cls.utm_additional_key, utm_amount, member)
+            self._increment(pipe, hash_key, utm_amount, key)
+            if hash_key in cls.top_fields:
+                member, count_type = key.rsplit(':', 1)
+                self._top_increment(pipe, '%s:%s' % (
+                    hash_key[0], count_type), member, utm_amount)
+
+    def _encode_params(self, utm_params):
+        encode = self.metrics_class._encode_value
+        return dict((k, encode(v)) for k, v in utm_params.items())
+
+    def save_utm(self, channel_id, utm_params, additional_params,
+                 count_type=0, utm_amount=1, pipeline=None):
+        if not (self.variant_id and channel_id):
+            return
+        pipe = self._begin(pipeline)
+        self._save_utm(pipe, channel_id, self._encode_params(utm_params),
+                       additional_params, count_type, utm_amount)
+        return self._end(pipe, pipeline)
+
+    def save_visit_with_utm(self, is_unique, channel_id=None,
+                            utm_params=None, pipeline=None):
+        pipe = self._begin(pipeline)
+        if self.variant_id and channel_id:
+            utm_params = self._encode_params(utm_params)
+            if is_unique:
+                self._save_utm(pipe, channel_id, utm_params, None, 1)
+            self._save_utm(pipe, channel_id, utm_params, None, 0)
+        return self._end(pipe, pipeline)
+
+    def save_utm_goal(self, channel_id, utm_params, additional_params,
+                      pipeline=None):
+        return self.save_utm(channel_id, utm_params, additional_params, 2,
+                             pipeline=pipeline)
+
+    def decrease_utm_goal(self, channel_id, utm_params, additional_params,
+                          pipeline=None):
+        return self.save_utm(channel_id, utm_params, additional_params, 2,
+                             -1, pipeline)
+
+
+class HourFacade(MetricsFacade):
+    """
+    Hour of every write is taken from current time
+    """
+    __slots__ = ()
+    metrics_class = HourMetrics
+
+    def _save_by_key(self, pipe, type_key, amount=1):
+        cls = self.metrics_class
+        self._increment(pipe, cls.hour_key, amount, cls._get_hash_key(
+            '%02d' % now().hour, type_key))
+
+    def save_visitor(self, is_unique=0, pipeline=None):
+        pipe = self._begin(pipeline)
+        if is_unique:
+            self._save_by_key(pipe, 1)
+        self._save_by_key(pipe, 0)
+        return self._end(pipe, pipeline)
+
+    def _save(self, type_key, amount, pipeline):
+        pipe = self._begin(pipeline)
+        self._save_by_key(pipe, type_key, amount)
+        return self._end(pipe, pipeline)
+
+    def save_goal(self, pipeline=None):
+        return self._save(2, 1, pipeline)
+
+    def save_lead(self, pipeline=None):
+        return self._save(3, 1, pipeline)
+
+    def decrease_lead(self, pipeline=None):
+        return self._save(3, -1, pipeline)
+
+    def decrease_goal(self, pipeline=None):
+        return self._save(2, -1, pipeline)
+
+
+class TotalFacade(MetricsFacade):
+    __slots__ = ()
+    metrics_class = TotalMetrics
+
+    def __init__(self, page_id, redis, save_variant=True):
+        super(TotalFacade, self).__init__(
+            page_id, TotalMetrics.total_date, redis, save_variant)
+
+    def reader(self):
+        return self.metrics_class(
+            self.variant_id, self.redis, save_variant=False)
+
+    def _save(self, key, amount, pipeline):
+        pipe = self._begin(pipeline)
+        self._increment(pipe, key, amount)
+        return self._end(pipe, pipeline)
+
+    def save_unique(self, pipeline=None):
+        return self._save(self.metrics_class.unique_key, 1, pipeline)
+
+    def save_goal(self, pipeline=None):
+        return self._save(self.metrics_class.goals_key, 1, pipeline)
+
+    def decrease_goal(self, pipeline=None):
+        return self._save(self.metrics_class.goals_key, -1, pipeline)
+
+
+class TariffFacade(MetricsFacade):
+    __slots__ = ()
+    metrics_class = TariffStats
+
+    def save_unique(self, fingerprint=None, pipeline=None):
+        cls = self.metrics_class
+        pipe = self._begin(pipeline)
+        if fingerprint is not None:
+            self._add_fingerprint(pipe, fingerprint)
+        else:
+            self._increment(pipe, cls.tariff_key)
+        return self._end(pipe, pipeline)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+Resolve IP address into country & region by local ranges database.
+
+Database is CSV file with `network,country,region` rows (CIDR network,
+region is optional, header line is skipped), e.g. converted from
+GeoLite2 country or city blocks. Ranges are kept in sorted arrays
+(IPv4 in `array` of unsigned ints), address is found by binary search,
+repeated addresses are resolved by LRU cache.
+Ranges should not overlap, nested networks are not supported.
+"""
+
+import csv
+import socket
+from array import array
+from binascii import hexlify
+from bisect import bisect_right
+
+from metrics.cache import MISSING, LocalCache
+
+
+UNKNOWN = ('ZZ', '')
+
+
+def _parse_ip(ip):
+    """
+    Get (bits, int value) of IPv4 or IPv6 address
+    """
+    if ':' in ip:
+        return 128, int(hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
+    return 32, int(hexlify(socket.inet_pton(socket.AF_INET, ip)), 16)
+
+
+def _parse_network(network):
+    """
+    Get (bits, first, last) addresses of CIDR network
+    """
+    address, _, prefix = network.strip().partition('/')
+    bits, value = _parse_ip(address)
+    size = bits - int(prefix or bits)
+    first = value >> size << size
+    return bits, first, first | ((1 << size) - 1)
+
+
+def _get_ulong_array():
+    """
+    Array type, which holds 32 bits unsigned ints
+    """
+    for code in ('I', 'L'):
+        if array(code).itemsize >= 4:
+            return code
+
+
+class GeoResolver(object):
+    """
+    Sorted arrays of ranges starts & ends with index of location,
+    locations are stored once
+    """
+    def __init__(self, ranges=(), cache_size=100000):
+        self.locations = []
+        self.cache = LocalCache(maxsize=cache_size, ttl=86400)
+        indexes = {}
+        tables = {32: [], 128: []}
+        for network, country, region in ranges:
+            bits, first, last = _parse_network(network)
+            location = (country, region or '')
+            if location not in indexes:
+                indexes[location] = len(self.locations)
+                self.locations.append(location)
+            tables[bits].append((first, last, indexes[location]))
+
+        self.tables = {}
+        for bits, rows in tables.items():
+            rows.sort()
+            if bits == 32:
+                code = _get_ulong_array()
+                starts = array(code, (row[0] for row in rows))
+                ends = array(code, (row[1] for row in rows))
+            else:
+                starts = [row[0] for row in rows]
+                ends = [row[1] for row in rows]
+            self.tables[bits] = (
+                starts, ends, array('l', (row[2] for row in rows)))
+
+    @classmethod
+    def from_csv(cls, path_or_fileobj, **options):
+        """
+        Load ranges from CSV file with `network,country,region` rows
+        """
+        if isinstance(path_or_fileobj, str):
+            with open(path_or_fileobj) as fileobj:
+                return cls.from_csv(fileobj, **options)
+        return cls(cls._read_csv(path_or_fileobj), **options)
+
+    @staticmethod
+    def _read_csv(fileobj):
+        for row in csv.reader(fileobj):
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            try:
+                _parse_network(row[0])
+            except (ValueError, socket.error):
+                # header or broken line
+                continue
+            yield row[0], row[1], row[2] if len(row) > 2 else ''
+
+    def __len__(self):
+        return sum(len(table[0]) for table in self.tables.values())
+
+    def _search(self, ip):
+        try:
+            bits, value = _parse_ip(ip)
+        except (ValueError, socket.error, TypeError):
+            return UNKNOWN
+        starts, ends, locations = self.tables[bits]
+        index = bisect_right(starts, value) - 1
+        if index < 0 or ends[index] < value:
+            return UNKNOWN
+        return self.locations[locations[index]]
+
+    def resolve(self, ip):
+        """
+        Get (country, region) of address, `UNKNOWN` when it was not found
+        """
+        location = self.cache.get(ip)
+        if location is MISSING:
+            location = self._search(ip)
+            self.cache.set(ip, location)
+        return location
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Unique counting by HyperLogLog.
+
+Metrics classes add visitor fingerprints into per-day & per-month
+HyperLogLogs (see `MetricsAbstract._add_fingerprint`), memory of every
+key is bounded by 12 KB and standard error is 0.81%.
+Helpers below count unions of many days & variants.
+"""
+
+from time import time
+from uuid import uuid4
+
+from metrics.sharding import is_distributed
+
+
+def _merge_on_node(redis, keys, destination=None, ttl=None):
+    """
+    Keys of many nodes are copied by DUMP & RESTORE into temporary keys
+    with one hash tag and merged there
+    """
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+    values = [value for value in pipe.execute() if value is not None]
+
+    prefix = 'hll_union:{%s}' % uuid4().hex
+    sources = ['%s:%s' % (prefix, i) for i in range(len(values))]
+    target = '%s:result' % prefix
+    pipe = redis.pipeline(transaction=False)
+    for source, value in zip(sources, values):
+        pipe.restore(source, 0, value)
+    pipe.pfmerge(target, *sources)
+    pipe.pfcount(target)
+    pipe.dump(target)
+    pipe.delete(target, *sources)
+    count, value = pipe.execute()[-3:-1]
+
+    if destination is not None:
+        redis.restore(destination, (ttl or 0) * 1000, value, replace=True)
+    return count
+
+
+def count_union(redis, keys):
+    """
+    Count unique fingerprints of union of HyperLogLogs
+    """
+    keys = list(keys)
+    if not keys:
+        return 0
+    if is_distributed(redis):
+        return _merge_on_node(redis, keys)
+    return redis.pfcount(*keys)
+
+
+def merge_union(redis, destination, keys, ttl=None):
+    """
+    Save union of HyperLogLogs into destination key by PFMERGE,
+    return count of unique fingerprints
+    """
+    keys = list(keys)
+    if is_distributed(redis):
+        return _merge_on_node(redis, keys, destination, ttl)
+    pipe = redis.pipeline(transaction=False)
+    pipe.pfmerge(destination, *keys)
+    if ttl:
+        pipe.expire(destination, ttl)
+    pipe.pfcount(destination)
+    return pipe.execute()[-1]
+
+
+def _memory_usage(redis, key):
+    try:
+        return redis.memory_usage(key)
+    except Exception:
+        return None
+
+
+def benchmark_unique(redis, hits=100000, visitors=20000, chunk_size=1000):
+    """
+    Compare HyperLogLog with exact dedup set of fingerprints:
+    accuracy, writes per second and memory of keys.
+    Sample keys are deleted afterwards
+    """
+    prefix = 'benchmark_hll:%s' % uuid4().hex
+    fingerprints = ['visitor-%s' % (i % visitors) for i in range(hits)]
+    result = {'hits': hits, 'exact': visitors}
+
+    for name, command in (('hll', 'pfadd'), ('set', 'sadd')):
+        key = '%s:%s' % (prefix, name)
+        started = time()
+        for i in range(0, hits, chunk_size):
+            pipe = redis.pipeline(transaction=False)
+            for fingerprint in fingerprints[i:i + chunk_size]:
+                getattr(pipe, command)(key, fingerprint)
+            pipe.execute()
+        elapsed = time() - started
+
+        if name == 'hll':
+            count = redis.pfcount(key)
+        else:
+            count = redis.scard(key)
+        result[name] = {
+            'count': count,
+            'error': abs(count - visitors) / float(visitors),
+            'ops_per_second': hits / elapsed if elapsed else 0.0,
+            'bytes': _memory_usage(redis, key),
+        }
+        redis.delete(key)
+    return result
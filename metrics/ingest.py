@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk ingestion of hits logs for backfills & replays after incidents.
+
+Events are read from JSON lines files and replayed by metrics classes
+into in-memory `AggregatingPipeline`, so keys & fields are the same
+as for hit by hit writes. Counters are summed per (key, field),
+HSET/SADD/EXPIREAT are deduplicated, and aggregated chunk is applied
+by large pipelined batches.
+
+With `processes` lines of chunk are sharded by variant across process
+pool, every worker aggregates own variants. Writes of chunk are sorted
+and split into batches of `batch_size` commands of one node, so server
+is not blocked by large chunk and keys of many nodes can be written.
+Every batch is applied by MULTI/EXEC together with its marker key,
+batches with existing markers are skipped, so chunk, which was
+interrupted by failure, is not applied twice (resume it with the same
+chunk & batch sizes). File checkpoint (byte offset) is written after
+all batches of chunk, so ingested file is skipped by next run, lines
+appended to file later are ingested by next run. Checkpoints are kept
+by file path, rotated file with other content is ingested from start.
+
+Events:
+
+    {"event": "visit", "variant_id": 1, "time": 1401600000,
+     "ip": "1.2.3.4", "is_unique": 1, "page_id": 2, "profile_id": 3,
+     "channel_id": 1, "utm": {"utm_medium": "cpc"}, "fingerprint": "x"}
+    {"event": "goal", "variant_id": 1, "time": 1401600100,
+     "ip": "1.2.3.4", "page_id": 2, "channel_id": 1, "utm": {...},
+     "additional": {"ad_id": 1, "ad_type": 1, "ad_label": "form"}}
+    {"event": "lead", "variant_id": 1, "time": 1401600200}
+
+Date & hour are taken from `time` (UTC) or `date` & `hour` fields,
+when `hour` is missing, it is taken from `time`.
+
+Usage:
+
+    python -m metrics.ingest hits-2014-06-01.jsonl --processes 4
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import datetime
+from multiprocessing import Pool
+from time import time
+
+from metrics import (
+    HourMetrics, TariffStats, TotalMetrics, UtmMetrics, VisitorMetrics)
+from metrics.sharding import get_hash_tag, get_key_group
+
+
+def _get_order(item):
+    """
+    Sort key of (index, value) items with mixed types of fields
+    """
+    return repr(item[0])
+
+
+class AggregatingPipeline(object):
+    """
+    Pipeline-like writer for metrics classes. Commands are merged
+    in memory, state is picklable, so it can be returned by workers
+    """
+    def __init__(self):
+        self.counters = {}
+        self.sorted_sets = {}
+        self.fields = {}
+        self.sets = {}
+        self.lists = {}
+        self.trims = {}
+        self.hlls = {}
+        self.expires = {}
+        self.scripts = set()
+
+    def __len__(self):
+        return (len(self.counters) + len(self.sorted_sets) +
+                len(self.fields) + len(self.sets) + len(self.lists) +
+                len(self.trims) + len(self.hlls) + len(self.expires))
+
+    @staticmethod
+    def _add(data, index, amount):
+        data[index] = data.get(index, 0) + int(amount)
+
+    def incrby(self, key, amount=1):
+        self._add(self.counters, (key, None), amount)
+        return self
+
+    def incr(self, key, amount=1):
+        return self.incrby(key, amount)
+
+    def hincrby(self, key, field, amount=1):
+        self._add(self.counters, (key, field), amount)
+        return self
+
+    def hset(self, key, field, value):
+        self.fields[(key, field)] = value
+        return self
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+        return self
+
+    def lpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+        return self
+
+    def ltrim(self, key, start, end):
+        self.trims[key] = (start, end)
+        return self
+
+    def pfadd(self, key, *values):
+        self.hlls.setdefault(key, set()).update(values)
+        return self
+
+    def expireat(self, key, timestamp):
+        self.expires[key] = timestamp
+        return self
+
+    def execute_command(self, command, *args):
+        if command.upper() != 'ZINCRBY':
+            raise ValueError('Command %s is not aggregated' % command)
+        key, amount, member = args
+        self._add(self.sorted_sets, (key, member), amount)
+        return self
+
+    def evalsha(self, *args):
+        raise ValueError('Scripts are not aggregated, use_script=False')
+
+    def execute(self):
+        return []
+
+    def update(self, other):
+        """
+        Merge state of other pipeline, other writes are newer
+        """
+        for index, amount in other.counters.items():
+            self._add(self.counters, index, amount)
+        for index, amount in other.sorted_sets.items():
+            self._add(self.sorted_sets, index, amount)
+        self.fields.update(other.fields)
+        for key, members in other.sets.items():
+            self.sets.setdefault(key, set()).update(members)
+        for key, values in other.lists.items():
+            self.lists.setdefault(key, []).extend(values)
+        self.trims.update(other.trims)
+        for key, values in other.hlls.items():
+            self.hlls.setdefault(key, set()).update(values)
+        self.expires.update(other.expires)
+
+    @staticmethod
+    def _chunks(values, size):
+        values = list(values)
+        for i in range(0, len(values), size):
+            yield values[i:i + size]
+
+    def iter_commands(self, batch_size=1000):
+        """
+        Get (command, args) of all writes, keys are expired after writes.
+        Members & values of SADD/LPUSH/PFADD are split by `batch_size`.
+        Commands are sorted, so the same data gives the same sequence
+        """
+        for (key, field), value in sorted(self.fields.items(),
+                                          key=_get_order):
+            yield 'hset', (key, field, value)
+        for (key, field), amount in sorted(self.counters.items(),
+                                           key=_get_order):
+            if field is None:
+                yield 'incrby', (key, amount)
+            else:
+                yield 'hincrby', (key, field, amount)
+        for (key, member), amount in sorted(self.sorted_sets.items(),
+                                            key=_get_order):
+            yield 'execute_command', ('ZINCRBY', key, amount, member)
+        for command, data in (('sadd', self.sets), ('lpush', self.lists),
+                              ('pfadd', self.hlls)):
+            for key, values in sorted(data.items(), key=_get_order):
+                if command != 'lpush':
+                    values = sorted(values, key=repr)
+                for chunk in self._chunks(values, batch_size):
+                    yield command, (key,) + tuple(chunk)
+        for key, (start, end) in sorted(self.trims.items()):
+            yield 'ltrim', (key, start, end)
+        for key, timestamp in sorted(self.expires.items()):
+            yield 'expireat', (key, timestamp)
+
+    def apply(self, pipe, batch_size=1000):
+        """
+        Queue all writes into redis pipeline, return count of commands
+        """
+        commands = 0
+        for command, args in self.iter_commands(batch_size):
+            getattr(pipe, command)(*args)
+            commands += 1
+        return commands
+
+
+def _get_moment(event):
+    """
+    Get (date, hour) of event. Without `hour` field hour is taken
+    from `time`, event without both fields is broken
+    """
+    moment = None
+    if event.get('time') is not None:
+        moment = datetime.utcfromtimestamp(float(event['time']))
+    if event.get('date'):
+        hour = event.get('hour')
+        if hour is None:
+            if moment is None:
+                raise ValueError('Hour of event is unknown')
+            hour = moment.hour
+        return event['date'], '%02d' % int(hour)
+    if moment is None:
+        raise ValueError('Time of event is unknown')
+    return moment.strftime('%Y-%m-%d'), moment.strftime('%H')
+
+
+def replay_event(event, pipe, redis=None, details_limit=None):
+    """
+    Replay one event by metrics classes into pipeline
+    """
+    name = event.get('event', 'visit')
+    if name not in ('visit', 'goal', 'lead'):
+        raise ValueError('Unknown event %s' % name)
+    variant_id = event['variant_id']
+    date_string, hour_string = _get_moment(event)
+    is_unique = int(event.get('is_unique') or 0)
+    channel_id = event.get('channel_id')
+    utm_params = event.get('utm') or {}
+    data = [event.get('ip'), event.get('time'), channel_id]
+    page_id = event.get('page_id')
+    profile_id = event.get('profile_id')
+
+    def bind(metrics_class, *args, **kwargs):
+        return metrics_class(*args, redis=redis, pipeline=pipe, **kwargs)
+
+    hour = bind(HourMetrics, variant_id, date_string)
+    hour.time_string = hour_string
+
+    if name == 'visit':
+        bind(VisitorMetrics, variant_id, date_string,
+             details_limit=details_limit).save_visitor(
+                 is_unique, data, event.get('fingerprint'))
+        hour.save_visitor(is_unique)
+        if channel_id:
+            bind(UtmMetrics, variant_id, date_string).save_visit_with_utm(
+                is_unique, channel_id, dict(utm_params))
+        if is_unique and page_id:
+            bind(TotalMetrics, page_id).save_unique()
+        if is_unique and profile_id:
+            bind(TariffStats, profile_id, date_string[:7]).save_unique(
+                event.get('fingerprint'))
+    elif name == 'goal':
+        visitor = bind(VisitorMetrics, variant_id, date_string)
+        visitor.save_goal(data)
+        hour.save_goal()
+        additional = event.get('additional') or {}
+        if additional:
+            visitor.save_additional(**additional)
+        if channel_id:
+            bind(UtmMetrics, variant_id, date_string).save_utm_goal(
+                channel_id, dict(utm_params), additional)
+        if page_id:
+            bind(TotalMetrics, page_id).save_goal()
+    else:
+        hour.save_lead()
+
+
+def aggregate_lines(lines, details_limit=None):
+    """
+    Parse & replay lines, return (pipeline, events, errors).
+    Event is replayed into own pipeline and merged on success,
+    so broken event leaves no writes
+    """
+    pipe = AggregatingPipeline()
+    events = errors = 0
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        event_pipe = AggregatingPipeline()
+        try:
+            replay_event(json.loads(line), event_pipe,
+                         details_limit=details_limit)
+        except (ValueError, KeyError, TypeError):
+            errors += 1
+            continue
+        pipe.update(event_pipe)
+        events += 1
+    return pipe, events, errors
+
+
+def _aggregate_task(task):
+    return aggregate_lines(*task)
+
+
+_variant_re = re.compile(br'"variant_id"\s*:\s*"?([^",}\s]+)')
+
+
+def _shard_lines(lines, shards):
+    """
+    Split lines by variant, so every worker aggregates own variants
+    """
+    parts = [[] for i in range(shards)]
+    for line in lines:
+        match = _variant_re.search(line)
+        index = hash(match.group(1)) % shards if match else 0
+        parts[index].append(line)
+    return [part for part in parts if part]
+
+
+def get_file_id(path):
+    """
+    Identity of file for checkpoint: digest of absolute path,
+    file keeps identity, when lines are appended
+    """
+    path = os.path.abspath(path)
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return hashlib.sha1(path).hexdigest()
+
+
+def _get_head_digest(f, size):
+    """
+    Digest of first `size` bytes of file, it checks, that file
+    of checkpoint was not replaced
+    """
+    f.seek(0)
+    head = f.read(size)
+    if len(head) < size:
+        return None
+    return hashlib.sha1(head).hexdigest()
+
+
+class Ingestion(object):
+    """
+    Ingest JSON lines files by chunks of `chunk_size` lines.
+    Checkpoints are stored in `checkpoint_key` hash by file identity,
+    markers of applied batches are removed after checkpoint
+    """
+    checkpoint_key = 'metrics_ingest:checkpoints'
+    marker_prefix = 'metrics_ingest:applied'
+    marker_ttl = 7 * 86400
+    head_size = 65536
+
+    def __init__(self, redis, processes=None, chunk_size=50000,
+                 batch_size=1000, details_limit=None, checkpoint=True):
+        self.redis = redis
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.details_limit = details_limit
+        self.checkpoint = checkpoint
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _aggregate(self, lines):
+        if not self.processes:
+            return aggregate_lines(lines, self.details_limit)
+        if self._pool is None:
+            self._pool = Pool(self.processes)
+        pipe = AggregatingPipeline()
+        events = errors = 0
+        tasks = [(part, self.details_limit)
+                 for part in _shard_lines(lines, self.processes)]
+        for part, part_events, part_errors in self._pool.imap(
+                _aggregate_task, tasks):
+            pipe.update(part)
+            events += part_events
+            errors += part_errors
+        return pipe, events, errors
+
+    def _get_offset(self, f, file_id):
+        """
+        Get offset of checkpoint, it is dropped, when head of file
+        was changed (e.g. file was rotated)
+        """
+        if not self.checkpoint:
+            return 0
+        value = self.redis.hget(self.checkpoint_key, file_id)
+        if not value:
+            return 0
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        offset, digest = value.split(':')
+        offset = int(offset)
+        if _get_head_digest(f, min(offset, self.head_size)) != digest:
+            return 0
+        return offset
+
+    def _save_offset(self, f, file_id, offset):
+        digest = _get_head_digest(f, min(offset, self.head_size))
+        self.redis.hset(self.checkpoint_key, file_id,
+                        '%s:%s' % (offset, digest))
+
+    def _get_batches(self, aggregated):
+        """
+        Split writes of chunk into batches of one node, every batch
+        with its marker is not longer than `batch_size` commands
+        """
+        size = max(self.batch_size - 1, 1)
+        groups = {}
+        for command, args in aggregated.iter_commands(self.batch_size):
+            key = args[1] if command == 'execute_command' else args[0]
+            batches = groups.setdefault(
+                get_key_group(self.redis, key), [[]])
+            if len(batches[-1]) >= size:
+                batches.append([])
+            batches[-1].append((command, args))
+        return [batch for group in sorted(groups) for batch in groups[group]]
+
+    def _get_marker(self, chunk_id, index, batch):
+        """
+        Marker is placed on node of batch by hash tag of its first key
+        """
+        command, args = batch[0]
+        key = args[1] if command == 'execute_command' else args[0]
+        return '%s:{%s}:%s:%s' % (
+            self.marker_prefix, get_hash_tag(key), chunk_id, index)
+
+    def _read_markers(self, markers):
+        applied = []
+        for i in range(0, len(markers), self.batch_size):
+            pipe = self.redis.pipeline(transaction=False)
+            for marker in markers[i:i + self.batch_size]:
+                pipe.exists(marker)
+            applied.extend(pipe.execute())
+        return applied
+
+    def _delete_markers(self, markers):
+        for i in range(0, len(markers), self.batch_size):
+            pipe = self.redis.pipeline(transaction=False)
+            for marker in markers[i:i + self.batch_size]:
+                pipe.delete(marker)
+            pipe.execute()
+
+    def _apply(self, aggregated, chunk_id):
+        """
+        Apply batches of chunk, which have no markers yet, every batch
+        is applied with its marker by MULTI/EXEC. Without checkpoints
+        batches are sent by non-transactional pipelines
+        """
+        batches = self._get_batches(aggregated)
+        markers = []
+        applied = [0] * len(batches)
+        if self.checkpoint:
+            markers = [self._get_marker(chunk_id, index, batch)
+                       for index, batch in enumerate(batches)]
+            applied = self._read_markers(markers)
+        commands = 0
+        for batch, marker, done in zip(batches, markers or batches, applied):
+            if done:
+                continue
+            pipe = self.redis.pipeline(transaction=self.checkpoint)
+            for command, args in batch:
+                getattr(pipe, command)(*args)
+            if self.checkpoint:
+                pipe.set(marker, 1, ex=self.marker_ttl)
+            pipe.execute()
+            commands += len(batch)
+        return commands, markers
+
+    def _read_chunks(self, f):
+        lines, size = [], 0
+        for line in iter(f.readline, b''):
+            lines.append(line)
+            size += len(line)
+            if len(lines) >= self.chunk_size:
+                yield lines, size
+                lines, size = [], 0
+        if lines:
+            yield lines, size
+
+    @staticmethod
+    def _is_complete(line):
+        if line.endswith(b'\n'):
+            return True
+        try:
+            json.loads(line.decode('utf-8'))
+        except ValueError:
+            return False
+        return True
+
+    def _get_chunk_id(self, file_id, offset, lines):
+        """
+        Identity of chunk by its position & content
+        """
+        digest = hashlib.sha1(('%s:%s:%s:' % (
+            file_id, offset, self.batch_size)).encode('utf-8'))
+        for line in lines:
+            digest.update(line)
+        return digest.hexdigest()
+
+    def ingest_file(self, path):
+        """
+        Ingest not ingested part of file, return report
+        """
+        started = time()
+        file_id = get_file_id(path)
+        with open(path, 'rb') as f:
+            offset = start = self._get_offset(f, file_id)
+            report = {'path': path, 'events': 0, 'errors': 0,
+                      'commands': 0, 'skipped_bytes': start}
+            f.seek(offset)
+            for lines, size in self._read_chunks(f):
+                if not self._is_complete(lines[-1]):
+                    # line is being written, it is ingested by next run
+                    size -= len(lines.pop())
+                    if not lines:
+                        break
+                aggregated, events, errors = self._aggregate(lines)
+                commands, markers = self._apply(
+                    aggregated, self._get_chunk_id(file_id, offset, lines))
+                offset += size
+                if self.checkpoint:
+                    position = f.tell()
+                    self._save_offset(f, file_id, offset)
+                    self._delete_markers(markers)
+                    f.seek(position)
+                report['commands'] += commands
+                report['events'] += events
+                report['errors'] += errors
+        elapsed = time() - started
+        report['bytes'] = offset - start
+        report['seconds'] = elapsed
+        report['events_per_second'] = (
+            report['events'] / elapsed if elapsed else 0.0)
+        return report
+
+    def ingest(self, paths):
+        reports = [self.ingest_file(path) for path in paths]
+        events = sum(report['events'] for report in reports)
+        seconds = sum(report['seconds'] for report in reports)
+        return {
+            'files': reports,
+            'events': events,
+            'errors': sum(report['errors'] for report in reports),
+            'commands': sum(report['commands'] for report in reports),
+            'seconds': seconds,
+            'events_per_second': events / seconds if seconds else 0.0,
+        }
+
+
+def ingest_files(redis, paths, **options):
+    """
+    Ingest JSON lines files, return throughput report
+    """
+    with Ingestion(redis, **options) as ingestion:
+        return ingestion.ingest(paths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('paths', nargs='+', metavar='path')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=5)
+    parser.add_argument('--password')
+    parser.add_argument('--processes', type=int,
+                        default=getattr(os, 'cpu_count', lambda: None)())
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--details-limit', type=int)
+    parser.add_argument('--no-checkpoint', action='store_false',
+                        dest='checkpoint',
+                        help='ingest files again from start')
+    args = parser.parse_args(argv)
+
+    from redis import StrictRedis
+    redis = StrictRedis(host=args.host, port=args.port, db=args.db,
+                        password=args.password)
+    report = ingest_files(
+        redis, args.paths, processes=args.processes,
+        chunk_size=args.chunk_size, batch_size=args.batch_size,
+        details_limit=args.details_limit, checkpoint=args.checkpoint)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
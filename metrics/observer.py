@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of metrics classes.
+
+`install` wraps public methods of metrics classes, every call is
+reported to observer with latency, count of redis commands, round trips
+and payload bytes. Nothing is wrapped until `install` is called,
+so disabled instrumentation has no overhead on hot path.
+
+Clients of metrics objects are not replaced: while call is observed,
+`redis` & `pipeline` attributes are read through counting wrappers
+of the call by current thread only, so objects can be shared
+by threads.
+
+Observers:
+
+* `StatsObserver` - in-process counters & latency histograms,
+  dumped in Prometheus text format
+* `StatsdObserver` - statsd lines sent by UDP
+"""
+
+import inspect
+import random
+import socket
+import threading
+from functools import wraps
+from time import time
+
+
+def _get_size(value):
+    """
+    Approximate size of command arguments in bytes
+    """
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_get_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_get_size(k) + _get_size(v) for k, v in value.items())
+    if value is None:
+        return 0
+    return len(str(value))
+
+
+class CountingRedis(object):
+    """
+    Client wrapper, which counts round trips, commands & payload bytes.
+    Every direct command is one round trip,
+    pipeline is one round trip for all queued commands.
+    Commands of fan-out operations are sent to nodes directly,
+    they are not counted
+    """
+    # client is unwrapped by `metrics.sharding` for checks of nodes
+    wraps_client = True
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.reset()
+
+    def reset(self):
+        self.round_trips = 0
+        self.commands = 0
+        self.payload_bytes = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.redis, name)
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            self.round_trips += 1
+            self.commands += 1
+            self.payload_bytes += _get_size(args)
+            return attr(*args, **kwargs)
+        return command
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self, self.redis.pipeline(transaction))
+
+    def register_script(self, script):
+        return self.redis.register_script(script)
+
+
+class CountingPipeline(object):
+    """
+    Wrapper is equal to its pipeline, so EXPIREATs tracked
+    for pipeline are found by wrapper too
+    """
+    def __init__(self, client, pipe):
+        self.client = client
+        self.pipe = pipe
+
+    def __len__(self):
+        return len(self.pipe)
+
+    def __hash__(self):
+        return hash(self.pipe)
+
+    def __eq__(self, other):
+        if isinstance(other, CountingPipeline):
+            other = other.pipe
+        return self.pipe is other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getattr__(self, name):
+        attr = getattr(self.pipe, name)
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            self.client.commands += 1
+            self.client.payload_bytes += _get_size(args)
+            attr(*args, **kwargs)
+            return self
+        return command
+
+    def execute(self, raise_on_error=True):
+        if len(self.pipe):
+            self.client.round_trips += 1
+            if getattr(self.pipe, 'scripts', None):
+                # scripts existence is checked before pipeline
+                self.client.round_trips += 1
+        return self.pipe.execute(raise_on_error)
+
+
+class MetricsObserver(object):
+    """
+    Observer interface
+    """
+    def record(self, class_name, method, elapsed, commands, round_trips,
+               payload_bytes):
+        raise NotImplementedError
+
+
+class StatsObserver(MetricsObserver):
+    """
+    Collect calls, latency histogram, commands, round trips
+    & payload bytes per class method
+    """
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1.0)
+
+    def __init__(self, buckets=None, prefix='lp_metrics'):
+        self.buckets = tuple(sorted(buckets or self.buckets))
+        self.prefix = prefix
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, class_name, method, elapsed, commands, round_trips,
+               payload_bytes):
+        with self._lock:
+            stats = self._stats.get((class_name, method))
+            if stats is None:
+                stats = self._stats[(class_name, method)] = {
+                    'calls': 0,
+                    'seconds': 0.0,
+                    'buckets': [0] * len(self.buckets),
+                    'commands': 0,
+                    'round_trips': 0,
+                    'payload_bytes': 0,
+                }
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['commands'] += commands
+            stats['round_trips'] += round_trips
+            stats['payload_bytes'] += payload_bytes
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def get_stats(self):
+        with self._lock:
+            return dict((key, dict(value, buckets=list(value['buckets'])))
+                        for key, value in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def to_prometheus(self):
+        """
+        Dump collected stats in Prometheus text exposition format
+        """
+        stats = sorted(self.get_stats().items())
+        prefix = self.prefix
+        lines = []
+
+        def labels(class_name, method, extra=''):
+            return '{class="%s",method="%s"%s}' % (class_name, method, extra)
+
+        for name, field, help_text in (
+                ('calls_total', 'calls', 'Calls of metrics methods'),
+                ('redis_commands_total', 'commands', 'Redis commands'),
+                ('redis_round_trips_total', 'round_trips',
+                 'Redis round trips'),
+                ('redis_payload_bytes_total', 'payload_bytes',
+                 'Bytes of redis commands arguments')):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for (class_name, method), value in stats:
+                lines.append('%s_%s%s %s' % (
+                    prefix, name, labels(class_name, method), value[field]))
+
+        name = '%s_call_duration_seconds' % prefix
+        lines.append('# HELP %s Latency of metrics methods' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for (class_name, method), value in stats:
+            count = 0
+            for bound, hits in zip(self.buckets, value['buckets']):
+                count += hits
+                lines.append('%s_bucket%s %s' % (name, labels(
+                    class_name, method, ',le="%s"' % bound), count))
+            lines.append('%s_bucket%s %s' % (name, labels(
+                class_name, method, ',le="+Inf"'), value['calls']))
+            lines.append('%s_sum%s %r' % (
+                name, labels(class_name, method), value['seconds']))
+            lines.append('%s_count%s %s' % (
+                name, labels(class_name, method), value['calls']))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdObserver(MetricsObserver):
+    """
+    Send statsd lines by UDP for every call, errors are ignored.
+    With `sample_rate` only part of calls is sent
+    """
+    def __init__(self, host='localhost', port=8125, prefix='lp_metrics',
+                 sample_rate=1.0):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sample_rate = sample_rate
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _format(self, class_name, method, elapsed, commands, round_trips,
+                payload_bytes):
+        name = '%s.%s.%s' % (self.prefix, class_name, method)
+        rate = ''
+        if self.sample_rate < 1:
+            rate = '|@%s' % self.sample_rate
+        return '\n'.join([
+            '%s.calls:1|c%s' % (name, rate),
+            '%s.duration:%0.3f|ms%s' % (name, elapsed * 1000, rate),
+            '%s.commands:%s|c%s' % (name, commands, rate),
+            '%s.round_trips:%s|c%s' % (name, round_trips, rate),
+            '%s.payload_bytes:%s|c%s' % (name, payload_bytes, rate),
+        ])
+
+    def record(self, class_name, method, elapsed, commands, round_trips,
+               payload_bytes):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        try:
+            self._socket.sendto(self._format(
+                class_name, method, elapsed, commands, round_trips,
+                payload_bytes).encode('utf-8'), self.address)
+        except (IOError, OSError):
+            pass
+
+
+_calls = threading.local()
+
+
+def _get_calls():
+    """
+    Get {id of object: {attribute: (client, wrapper)}} of calls
+    observed by current thread
+    """
+    calls = getattr(_calls, 'calls', None)
+    if calls is None:
+        calls = _calls.calls = {}
+    return calls
+
+
+class ObservedClient(object):
+    """
+    Descriptor of client attribute (`redis`, `pipeline`) of observed
+    class. Value is kept in object, while call of object is observed
+    by current thread, counting wrapper of the call is returned
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            value = instance.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+        call = _get_calls().get(id(instance))
+        if call is not None and self.name in call:
+            client, wrapper = call[self.name]
+            # client can be replaced by method
+            if client is value:
+                return wrapper
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+def _observe(metrics_class, name, method):
+    class_name = metrics_class.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        observer = self.observer
+        calls = _get_calls()
+        # nested calls are counted by outer call
+        if observer is None or id(self) in calls:
+            return method(self, *args, **kwargs)
+
+        redis = self.__dict__.get('redis')
+        pipeline = self.__dict__.get('pipeline')
+        counter = CountingRedis(redis)
+        call = calls[id(self)] = {'redis': (redis, counter)}
+        if pipeline is not None:
+            call['pipeline'] = (
+                pipeline, CountingPipeline(counter, pipeline))
+        started = time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            elapsed = time() - started
+            del calls[id(self)]
+            observer.record(class_name, name, elapsed, counter.commands,
+                            counter.round_trips, counter.payload_bytes)
+    wrapper.__wrapped_method__ = method
+    wrapper.__wrapped_owned__ = name in vars(metrics_class)
+    return wrapper
+
+
+def _get_public_methods(metrics_class):
+    methods = {}
+    for klass in metrics_class.__mro__:
+        for name, value in vars(klass).items():
+            methods.setdefault(name, value)
+    for name, value in sorted(methods.items()):
+        if name.startswith('_') or not inspect.isfunction(value):
+            continue
+        if inspect.isgeneratorfunction(value):
+            continue
+        yield name, value
+
+
+def _get_default_classes():
+    from metrics import (
+        HourMetrics, TariffStats, TotalMetrics, UtmMetrics, VisitorMetrics)
+    return (VisitorMetrics, UtmMetrics, HourMetrics, TotalMetrics,
+            TariffStats)
+
+
+def install(observer, classes=None):
+    """
+    Wrap public methods of metrics classes and report calls to observer.
+    Static & class methods and generators are not wrapped
+    """
+    for metrics_class in classes or _get_default_classes():
+        uninstall([metrics_class])
+        for name, method in list(_get_public_methods(metrics_class)):
+            setattr(metrics_class, name, _observe(
+                metrics_class, name, method))
+        for name in ('redis', 'pipeline'):
+            setattr(metrics_class, name, ObservedClient(name))
+        metrics_class.observer = observer
+
+
+def uninstall(classes=None):
+    """
+    Restore original methods of metrics classes
+    """
+    for metrics_class in classes or _get_default_classes():
+        for name in list(vars(metrics_class)):
+            method = vars(metrics_class)[name]
+            if isinstance(method, ObservedClient):
+                delattr(metrics_class, name)
+                continue
+            if not hasattr(method, '__wrapped_method__'):
+                continue
+            if method.__wrapped_owned__:
+                setattr(metrics_class, name, method.__wrapped_method__)
+            else:
+                delattr(metrics_class, name)
+        metrics_class.observer = None
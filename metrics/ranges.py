@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+from datetime import date, datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from metrics import HourMetrics, UtmMetrics, VisitorMetrics
+from metrics.hll import count_union
+from metrics.top import get_top_union
+
+
+class MetricsRange(object):
+    """
+    Read-only queries for range of days and many variants.
+
+    All keys are built up front and read by chunked pipelines,
+    no metrics objects are created and nothing is written to redis.
+    Values of every cell (variant, day) are merged in memory.
+    Metrics classes can be replaced by subclasses, keys are built
+    by their options (namespace, hash_tag, compact)
+    """
+    counters = (
+        ('visits', 'visits_key'),
+        ('unique', 'unique_key'),
+        ('goals', 'goals_key'),
+    )
+
+    def __init__(self, redis, variant_ids, start_date, end_date,
+                 chunk_size=1000, visitor_class=VisitorMetrics,
+                 hour_class=HourMetrics, utm_class=UtmMetrics):
+        self.redis = redis
+        self.variant_ids = list(variant_ids)
+        self.dates = self._get_dates(start_date, end_date)
+        self.chunk_size = chunk_size
+        self.visitor_class = visitor_class
+        self.hour_class = hour_class
+        self.utm_class = utm_class
+
+    @staticmethod
+    def _get_dates(start_date, end_date):
+        """
+        Get all date strings between specified dates, both are included
+        """
+        days = []
+        for value in (start_date, end_date):
+            if not isinstance(value, date):
+                value = datetime.strptime(value, '%Y-%m-%d')
+            if isinstance(value, datetime):
+                value = value.date()
+            days.append(value)
+        start, end = days
+        return [(start + timedelta(days=i)).strftime('%Y-%m-%d')
+                for i in range((end - start).days + 1)]
+
+    def _get_cells(self):
+        return [(variant_id, date_string)
+                for variant_id in self.variant_ids
+                for date_string in self.dates]
+
+    def _get_keys(self, metrics_class, key):
+        return [metrics_class._build_redis_key(date_string, variant_id, key)
+                for variant_id, date_string in self._get_cells()]
+
+    def _read(self, command, keys):
+        """
+        Run read command for every key by chunked pipelines
+        """
+        replies = []
+        for i in range(0, len(keys), self.chunk_size):
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys[i:i + self.chunk_size]:
+                getattr(pipe, command)(key)
+            replies.extend(pipe.execute())
+        return replies
+
+    def _read_maps(self, metrics_class, key):
+        """
+        Read hash of every cell, fields of compact map are read
+        from packed hashes
+        """
+        prefix = metrics_class.compact and metrics_class.compact_maps.get(
+            tuple(key))
+        if not prefix:
+            return self._read('hgetall', self._get_keys(metrics_class, key))
+        return [metrics_class._unpack_map(data, prefix)
+                for data in self._read('hgetall', self._get_keys(
+                    metrics_class, metrics_class.packed_key))]
+
+    def _get_locations(self, metrics_class, key):
+        return [metrics_class._build_location(date_string, variant_id, key)
+                for variant_id, date_string in self._get_cells()]
+
+    def _get_counts(self, locations):
+        """
+        Get counters by (key, field) locations. String keys are read
+        by MGET, fields of packed hashes by HGET
+        """
+        if not any(field for key, field in locations):
+            return self._mget([key for key, field in locations])
+        replies = []
+        for i in range(0, len(locations), self.chunk_size):
+            pipe = self.redis.pipeline(transaction=False)
+            for key, field in locations[i:i + self.chunk_size]:
+                if field is None:
+                    pipe.get(key)
+                else:
+                    pipe.hget(key, field)
+            replies.extend(int(value or 0) for value in pipe.execute())
+        return replies
+
+    def _mget(self, keys):
+        """
+        Get values by MGET chunks, all chunks are sent by one pipeline
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for i in range(0, len(keys), self.chunk_size):
+            pipe.mget(keys[i:i + self.chunk_size])
+        return [int(value or 0)
+                for chunk in pipe.execute() for value in chunk]
+
+    @staticmethod
+    def _merge(hashes):
+        """
+        Sum hash fields of many cells
+        """
+        data = {}
+        for values in hashes:
+            for field, count in values.items():
+                data[field] = data.get(field, 0) + int(count or 0)
+        return data
+
+    def _group_by_day(self, replies):
+        """
+        Split replies of all cells by days, replies are ordered
+        by variant and then by date
+        """
+        days = dict((date_string, []) for date_string in self.dates)
+        for (variant_id, date_string), reply in zip(
+                self._get_cells(), replies):
+            days[date_string].append(reply)
+        return days
+
+    def _split(self, replies, parts):
+        """
+        Split replies of concatenated key lists by parts
+        """
+        size = len(replies) // parts if parts else 0
+        return [replies[i * size:(i + 1) * size] for i in range(parts)]
+
+    def get_counters_matrix(self):
+        """
+        Get visits, unique & goals as (variants x days) matrices.
+        NumPy arrays are returned, when NumPy is installed
+        """
+        cls = self.visitor_class
+        locations = []
+        for name, attr in self.counters:
+            locations.extend(self._get_locations(cls, getattr(cls, attr)))
+        values = self._split(
+            self._get_counts(locations), len(self.counters))
+
+        width = len(self.dates)
+        matrix = {}
+        for (name, key), counts in zip(self.counters, values):
+            if numpy is not None:
+                matrix[name] = numpy.array(counts, dtype='int64').reshape(
+                    len(self.variant_ids), width)
+            else:
+                matrix[name] = [counts[i:i + width]
+                                for i in range(0, len(counts), width)]
+        return matrix
+
+    def get_counters(self):
+        """
+        Get per-day series and totals of visits, unique & goals
+        for every variant and for all of them
+        """
+        matrix = self.get_counters_matrix()
+        names = [name for name, key in self.counters]
+
+        def _sum(values):
+            return int(sum(values))
+
+        variants = {}
+        for index, variant_id in enumerate(self.variant_ids):
+            days = {}
+            for day, date_string in enumerate(self.dates):
+                days[date_string] = dict(
+                    (name, int(matrix[name][index][day])) for name in names)
+            variants[variant_id] = {
+                'days': days,
+                'total': dict(
+                    (name, _sum(matrix[name][index])) for name in names),
+            }
+
+        days = {}
+        for day, date_string in enumerate(self.dates):
+            days[date_string] = dict(
+                (name, _sum(row[day] for row in matrix[name]))
+                for name in names)
+
+        return {
+            'days': days,
+            'variants': variants,
+            'total': dict(
+                (name, _sum(values['total'][name]
+                            for values in variants.values()))
+                for name in names),
+        }
+
+    def get_unique_estimate(self):
+        """
+        Count unique fingerprints of every day, every variant and whole
+        range by unions of HyperLogLogs, visitors of many days
+        or variants are counted once
+        """
+        cls = self.visitor_class
+        keys = dict(zip(self._get_cells(), self._get_keys(
+            cls, cls.hll_key)))
+        days = dict(
+            (date_string, count_union(self.redis, [
+                keys[(variant_id, date_string)]
+                for variant_id in self.variant_ids]))
+            for date_string in self.dates)
+        variants = dict(
+            (variant_id, count_union(self.redis, [
+                keys[(variant_id, date_string)]
+                for date_string in self.dates]))
+            for variant_id in self.variant_ids)
+        return {
+            'days': days,
+            'variants': variants,
+            'total': count_union(self.redis, keys.values()),
+        }
+
+    def _get_top(self, metrics_class, name, n):
+        return get_top_union(self.redis, [
+            metrics_class._build_top_key(date_string, variant_id, name)
+            for variant_id, date_string in self._get_cells()], n)
+
+    def _get_top_nodes(self, hash_key, n, by):
+        cls = self.utm_class
+        name = '%s:%s' % (hash_key[0], cls._get_count_type(by))
+        return cls._build_top_nodes(
+            hash_key, self._get_top(cls, name, n), by)
+
+    def top_terms(self, n, by='goals'):
+        """
+        Top utm terms of all variants & days by union of sorted set
+        indexes, `top_index` should be enabled for writes
+        """
+        return self._get_top_nodes(self.utm_class.utm_term_key, n, by)
+
+    def top_campaigns(self, n, by='goals'):
+        return self._get_top_nodes(self.utm_class.utm_campaign_key, n, by)
+
+    def top_geo(self, n, by='goals'):
+        if by not in ('goals', 'unique'):
+            raise ValueError('Unknown counter %s' % by)
+        return [{'ip': ip, by: count} for ip, count in self._get_top(
+            self.visitor_class, 'geo_%s' % by, n)]
+
+    def get_hours_stats(self):
+        """
+        Get hours stats for every day and summed for whole range
+        """
+        cls = self.hour_class
+        replies = self._read_maps(cls, cls.hour_key)
+        days = {}
+        for date_string, hashes in self._group_by_day(replies).items():
+            days[date_string] = cls._build_hours_stats(self._merge(hashes))
+        return {
+            'days': days,
+            'total': cls._build_hours_stats(self._merge(replies)),
+        }
+
+    def get_utm(self):
+        """
+        Get utm trees for every day and summed for whole range
+        """
+        cls = self.utm_class
+        hashes = [self._read_maps(cls, key) for key in cls.utm_read_keys]
+        grouped = [self._group_by_day(replies) for replies in hashes]
+
+        days = {}
+        for date_string in self.dates:
+            days[date_string] = cls._build_utm(
+                *[self._merge(level[date_string]) for level in grouped])
+        return {
+            'days': days,
+            'total': cls._build_utm(
+                *[self._merge(replies) for replies in hashes]),
+        }
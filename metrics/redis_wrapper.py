@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
-from redis import StrictRedis
+import os
+from threading import Lock
+from time import time
+
+from redis import ConnectionPool, StrictRedis
 try:
     from django.conf import settings
 except ImportError:
-    import settings
+    try:
+        import settings
+    except ImportError:
+        # defaults are used, e.g. with in-memory storage
+        settings = None
 
 REDIS_METRICS_HOST = getattr(settings, 'REDIS_METRICS_HOST', 'localhost')
 REDIS_METRICS_PORT = getattr(settings, 'REDIS_METRICS_PORT', 6379)
@@ -24,22 +32,169 @@ REDIS_SESSION_PASSWORD = getattr(settings, 'REDIS_SESSION_PASSWORD', None)
 REDIS_SESSION_DB = getattr(settings, 'REDIS_SESSION_DB', 6)
 
 
+READ_COMMANDS = frozenset([
+    'exists', 'get', 'hget', 'hgetall', 'hkeys', 'hlen', 'hmget', 'hscan',
+    'llen', 'lrange', 'mget', 'pfcount', 'scan', 'smembers', 'ttl', 'type',
+    'zrange', 'zrevrange', 'zscore',
+])
+
+WRITE_COMMANDS = frozenset([
+    'delete', 'eval', 'evalsha', 'execute_command', 'expire', 'expireat',
+    'hincrby', 'hset', 'incr', 'incrby', 'lpush', 'ltrim', 'pfadd',
+    'pfmerge', 'restore', 'sadd', 'set', 'setex', 'unlink', 'zadd',
+    'zincrby', 'zunionstore',
+])
+
+_pools = {}
+_pools_pid = None
+_pools_lock = Lock()
+
+
+def reset_connection_pools():
+    """
+    Drop all shared pools, new ones will be created on demand
+    """
+    global _pools_lock, _pools_pid
+    _pools_lock = Lock()
+    _pools.clear()
+    _pools_pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_connection_pools)
+
+
+def get_connection_pool(host, port, db, password=None):
+    """
+    Get process-wide shared connection pool.
+    Pools are rebuilt after fork, so prefork workers never share
+    connections with parent process
+    """
+    if _pools_pid != os.getpid():
+        reset_connection_pools()
+    key = (host, port, db, password)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                host=host, port=port, db=db, password=password)
+        return _pools[key]
+
+
 class RedisMetricsClient(StrictRedis):
     def __init__(self):
         super(RedisMetricsClient, self).__init__(
-            host=REDIS_METRICS_HOST, port=REDIS_METRICS_PORT,
-            db=REDIS_METRICS_DB, password=REDIS_METRICS_PASSWORD)
+            connection_pool=get_connection_pool(
+                REDIS_METRICS_HOST, REDIS_METRICS_PORT,
+                REDIS_METRICS_DB, REDIS_METRICS_PASSWORD))
 
 
 class RedisMetricsClientRead(StrictRedis):
     def __init__(self):
         super(RedisMetricsClientRead, self).__init__(
-            host=REDIS_METRICS_READ_HOST, port=REDIS_METRICS_READ_PORT,
-            db=REDIS_METRICS_READ_DB, password=REDIS_METRICS_READ_PASSWORD)
+            connection_pool=get_connection_pool(
+                REDIS_METRICS_READ_HOST, REDIS_METRICS_READ_PORT,
+                REDIS_METRICS_READ_DB, REDIS_METRICS_READ_PASSWORD))
 
 
 class RedisSessionClient(StrictRedis):
     def __init__(self):
         super(RedisSessionClient, self).__init__(
-            host=REDIS_SESSION_HOST, port=REDIS_SESSION_PORT,
-            db=REDIS_SESSION_DB, password=REDIS_SESSION_PASSWORD)
+            connection_pool=get_connection_pool(
+                REDIS_SESSION_HOST, REDIS_SESSION_PORT,
+                REDIS_SESSION_DB, REDIS_SESSION_PASSWORD))
+
+
+class RedisMetricsRouter(object):
+    """
+    Client, which sends read commands to read replica
+    and all other commands to primary.
+    With `pin_seconds`, reads are sent to primary during specified
+    time after last write, so just saved data is visible for reader
+    """
+    def __init__(self, write_client=None, read_client=None, pin_seconds=0):
+        self.write_client = write_client or RedisMetricsClient()
+        self.read_client = read_client or RedisMetricsClientRead()
+        self.pin_seconds = pin_seconds
+        self._last_write = 0
+        self._scripts = {}
+
+    def _get_client(self, is_read):
+        if is_read and time() - self._last_write >= self.pin_seconds:
+            return self.read_client
+        if not is_read:
+            self._last_write = time()
+        return self.write_client
+
+    def __getattr__(self, name):
+        if name in READ_COMMANDS:
+            return getattr(self._get_client(True), name)
+        return getattr(self.write_client, name)
+
+    def register_script(self, script):
+        script = self.write_client.register_script(script)
+        self._scripts[script.sha] = script
+        return script
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return RoutingPipeline(self, transaction, shard_hint)
+
+
+def _write_command(name):
+    def command(self, *args, **kwargs):
+        return getattr(self._get_client(False), name)(*args, **kwargs)
+    command.__name__ = name
+    return command
+
+
+for _name in WRITE_COMMANDS:
+    setattr(RedisMetricsRouter, _name, _write_command(_name))
+
+
+class RoutingPipeline(object):
+    """
+    Commands are collected and sent on execute to replica,
+    when all of them are reads, otherwise to primary
+    """
+    def __init__(self, router, transaction=True, shard_hint=None):
+        self.router = router
+        self.transaction = transaction
+        self.shard_hint = shard_hint
+        self._commands = []
+        self._is_read = True
+        self.scripts = set()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.reset()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if name not in READ_COMMANDS:
+                self._is_read = False
+            self._commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def reset(self):
+        self._commands = []
+        self._is_read = True
+        self.scripts = set()
+
+    def execute(self, raise_on_error=True):
+        client = self.router._get_client(self._is_read)
+        pipe = client.pipeline(self.transaction, self.shard_hint)
+        pipe.scripts.update(self.scripts)
+        for name, args, kwargs in self._commands:
+            if name == 'evalsha' and args[0] in self.router._scripts:
+                pipe.scripts.add(self.router._scripts[args[0]])
+            getattr(pipe, name)(*args, **kwargs)
+        self.reset()
+        return pipe.execute(raise_on_error)
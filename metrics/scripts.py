@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lua scripts, which are executed on redis side by EVALSHA
+"""
+
+# Save utm tree branch by single call.
+#
+# KEYS[1..4] - utm_source, utm_medium, utm_campaign & utm_term hashes
+# KEYS[5]    - utm_additional hash
+# KEYS[6..]  - utm_additional_keys set for every saved node
+#              (only when additional suffix was defined,
+#              sets are not passed for compact layout)
+#
+# ARGV[1]    - amount
+# ARGV[2]    - additional suffix (`ad_id:ad_type:ad_label`) or empty string
+# ARGV[3..]  - pairs of (tree level 1..4, hash field) for every node
+UTM_SAVE_SCRIPT = """
+local amount = tonumber(ARGV[1])
+local suffix = ARGV[2]
+local saved = 0
+for i = 3, #ARGV, 2 do
+    local level = tonumber(ARGV[i])
+    local field = ARGV[i + 1]
+    redis.call('HINCRBY', KEYS[level], field, amount)
+    saved = saved + 1
+    if suffix ~= '' then
+        local member = field .. '-||-' .. suffix
+        if KEYS[5 + saved] then
+            redis.call('SADD', KEYS[5 + saved], member)
+        end
+        redis.call('HINCRBY', KEYS[5], member, amount)
+    end
+end
+return saved
+"""
+
+# Move legacy counters of variant-day into packed hash.
+#
+# KEYS[1]    - packed hash
+# KEYS[2..]  - legacy keys
+#
+# ARGV       - pairs of (kind, name) for every legacy key:
+#              `string` key is added into field `name`,
+#              fields of `hash` key are added with prefix `name`
+COMPACT_MOVE_SCRIPT = """
+local moved = 0
+for i = 2, #KEYS do
+    local kind = ARGV[i * 2 - 3]
+    local name = ARGV[i * 2 - 2]
+    if kind == 'string' then
+        local value = redis.call('GET', KEYS[i])
+        if value then
+            redis.call('HINCRBY', KEYS[1], name, value)
+            moved = moved + 1
+        end
+    else
+        local data = redis.call('HGETALL', KEYS[i])
+        for j = 1, #data, 2 do
+            redis.call('HINCRBY', KEYS[1], name .. data[j], data[j + 1])
+            moved = moved + 1
+        end
+    end
+    redis.call('DEL', KEYS[i])
+end
+return moved
+"""
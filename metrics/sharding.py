@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+Client-side sharding by consistent hashing and keys migration
+into hash-tagged layout.
+
+Keys are placed by hash tag (part of key between `{` and `}`),
+so with `MetricsAbstract.hash_tag` all keys of one variant-day
+are stored on one shard and can be pipelined together.
+"""
+
+from bisect import bisect
+from hashlib import md5, sha1
+from multiprocessing.pool import ThreadPool
+
+from redis.exceptions import NoScriptError
+
+
+# Commands without keys are not routed, they should be sent to every
+# node by `get_nodes` or `fan_out`
+KEYLESS_COMMANDS = frozenset([
+    'client_list', 'config_get', 'config_set', 'dbsize', 'flushall',
+    'flushdb', 'info', 'keys', 'memory_stats', 'ping', 'randomkey', 'scan',
+    'scan_iter', 'script_exists', 'script_flush', 'script_load', 'time',
+])
+_key_types = (bytes, type(u''))
+
+
+def _check_routed(name, key):
+    """
+    Command is routed by first argument, it should be key
+    """
+    if name.lower() in KEYLESS_COMMANDS:
+        raise AttributeError(
+            '%s has no key for routing, use get_nodes or fan_out' % name)
+    if not isinstance(key, _key_types):
+        raise TypeError('%s is routed by key, %r was passed' % (name, key))
+
+
+def get_hash_tag(key):
+    """
+    Get part of key, which is used for shard selection,
+    same rules as for Redis Cluster
+    """
+    if isinstance(key, bytes):
+        key = key.decode('utf-8', 'ignore')
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class ShardedRedis(object):
+    """
+    Redis client, which routes commands to shards by consistent hashing.
+    Single key commands, MGET, DEL/UNLINK, EVALSHA & pipelines are routed,
+    scripts are loaded into every shard, other keyless commands
+    (SCAN, KEYS, ...) are refused, they should be sent to `shards` directly
+    """
+    def __init__(self, shards, replicas=128):
+        self.shards = list(shards)
+        self._ring = []
+        for index in range(len(self.shards)):
+            for replica in range(replicas):
+                self._ring.append(
+                    (self._hash('%s-%s' % (index, replica)), index))
+        self._ring.sort()
+        self._points = [point for point, index in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return int(md5(value).hexdigest()[:16], 16)
+
+    def get_shard_index(self, key):
+        point = bisect(self._points, self._hash(get_hash_tag(key)))
+        return self._ring[point % len(self._ring)][1]
+
+    def get_shard(self, key):
+        return self.shards[self.get_shard_index(key)]
+
+    def _group(self, keys):
+        """
+        Group keys positions by shard
+        """
+        groups = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(
+                self.get_shard_index(key), []).append(position)
+        return groups
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in KEYLESS_COMMANDS:
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            _check_routed(name, key)
+            return getattr(self.get_shard(key), name)(key, *args, **kwargs)
+        return command
+
+    def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        values = [None] * len(keys)
+        for index, positions in self._group(keys).items():
+            replies = self.shards[index].mget([keys[i] for i in positions])
+            for position, value in zip(positions, replies):
+                values[position] = value
+        return values
+
+    def delete(self, *keys):
+        return self.execute_command('DEL', *keys)
+
+    def unlink(self, *keys):
+        return self.execute_command('UNLINK', *keys)
+
+    def execute_command(self, command, *args, **kwargs):
+        if command.upper() in ('DEL', 'UNLINK'):
+            return sum(
+                self.shards[index].execute_command(
+                    command, *[args[i] for i in positions])
+                for index, positions in self._group(args).items())
+        _check_routed(command, args[0] if args else None)
+        return self.get_shard(args[0]).execute_command(
+            command, *args, **kwargs)
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        return self.get_shard(keys_and_args[0]).evalsha(
+            sha, numkeys, *keys_and_args)
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+    def script_load(self, script):
+        """
+        Load script into every shard, keys of script can be on any of them
+        """
+        for shard in self.shards:
+            sha = shard.script_load(script)
+        return sha
+
+    def pipeline(self, transaction=False, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+
+class ShardedScript(object):
+    """
+    Lua script of sharded client, it is executed on shard of first key
+    by EVALSHA and loaded into shards on NOSCRIPT error
+    """
+    def __init__(self, client, script):
+        self.client = client
+        self.script = script
+        if not isinstance(script, bytes):
+            script = script.encode('utf-8')
+        self.sha = sha1(script).hexdigest()
+
+    def __call__(self, keys=(), args=(), client=None):
+        keys, args = list(keys), list(args)
+        client = client or self.client
+        try:
+            return client.evalsha(self.sha, len(keys), *(keys + args))
+        except NoScriptError:
+            client.script_load(self.script)
+            return client.evalsha(self.sha, len(keys), *(keys + args))
+
+
+class ShardedPipeline(object):
+    """
+    Commands are grouped by shards, shard pipelines are executed
+    in parallel and replies are returned in order of queueing
+    """
+    def __init__(self, client, transaction=False):
+        self.client = client
+        self.transaction = transaction
+        self.reset()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if name == 'evalsha':
+                key = args[2]
+            elif name == 'execute_command':
+                _check_routed(args[0], args[1] if len(args) > 1 else None)
+                key = args[1]
+            else:
+                _check_routed(name, args[0] if args else None)
+                key = args[0]
+            self._commands.append(
+                [(self.client.get_shard_index(key), name, args, kwargs)])
+            return self
+        return command
+
+    def mget(self, keys, *args):
+        """
+        MGET is split by shards and merged back on execute
+        """
+        keys = list(keys) + list(args)
+        self._commands.append([
+            (index, 'mget', ([keys[i] for i in positions],), {}, positions)
+            for index, positions in self.client._group(keys).items()])
+        self._sizes[len(self._commands) - 1] = len(keys)
+        return self
+
+    def reset(self):
+        self._commands = []
+        self._sizes = {}
+        self.scripts = set()
+
+    def _execute_shard(self, commands, scripts=()):
+        index, items = commands
+        pipe = self.client.shards[index].pipeline(self.transaction)
+        pipe.scripts.update(scripts)
+        for position, part in items:
+            getattr(pipe, part[1])(*part[2], **part[3])
+        replies = pipe.execute(raise_on_error=False)
+        return [(position, part, reply)
+                for (position, part), reply in zip(items, replies)]
+
+    def execute(self, raise_on_error=True):
+        """
+        Shards are executed in parallel, errors of commands are raised
+        after all shards, like by pipeline of one node
+        """
+        groups = {}
+        for position, parts in enumerate(self._commands):
+            for part in parts:
+                groups.setdefault(part[0], []).append((position, part))
+        replies = [None] * len(self._commands)
+        for position, size in self._sizes.items():
+            replies[position] = [None] * size
+        scripts = self.scripts
+        self.reset()
+
+        def _execute(item):
+            return self._execute_shard(item, scripts)
+
+        if len(groups) > 1:
+            pool = ThreadPool(len(groups))
+            try:
+                results = pool.map(_execute, groups.items())
+            finally:
+                pool.close()
+        else:
+            results = [_execute(item) for item in groups.items()]
+
+        for result in results:
+            for position, part, reply in result:
+                if len(part) > 4 and not isinstance(reply, Exception):
+                    for key_position, value in zip(part[4], reply):
+                        replies[position][key_position] = value
+                else:
+                    replies[position] = reply
+        if raise_on_error:
+            for reply in replies:
+                if isinstance(reply, Exception):
+                    raise reply
+        return replies
+
+
+def _unwrap(redis):
+    """
+    Get client of wrapper, e.g. of counting wrapper of `metrics.observer`.
+    Wrapper class declares `wraps_client`, client is `redis` attribute
+    """
+    while getattr(type(redis), 'wraps_client', False):
+        redis = redis.redis
+    return redis
+
+
+def is_distributed(redis):
+    """
+    Check, that keys of client are spread by many nodes
+    """
+    redis = _unwrap(redis)
+    return isinstance(redis, ShardedRedis) or hasattr(redis, 'get_primaries')
+
+
+def get_key_group(redis, key):
+    """
+    Get index of node (or cluster slot) of key. Keys of one group
+    can be written by one transaction
+    """
+    client = _unwrap(redis)
+    if isinstance(client, ShardedRedis):
+        return client.get_shard_index(key)
+    if hasattr(client, 'keyslot'):
+        return client.keyslot(key)
+    return 0
+
+
+def get_nodes(redis):
+    """
+    Get clients of all primary nodes for fan-out operations
+    """
+    client = _unwrap(redis)
+    if isinstance(client, ShardedRedis):
+        return list(client.shards)
+    if hasattr(client, 'get_primaries'):
+        return [client.get_redis_connection(node)
+                for node in client.get_primaries()]
+    return [redis]
+
+
+def get_tagged_key(key, variants_keys=('variants', 'profiles')):
+    """
+    Convert key `namespace:date:variant:...` into hash-tagged one
+    `namespace:{date:variant}:...`. Variants hashes are not changed
+    """
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    parts = key.split(':')
+    if len(parts) < 3 or '{' in key or (
+            len(parts) == 3 and parts[2] in variants_keys):
+        return None
+    return '%s:{%s:%s}:%s' % (
+        parts[0], parts[1], parts[2], ':'.join(parts[3:]))
+
+
+def migrate_keys(source, target, pattern, count=1000, delete=True):
+    """
+    Re-key existing data into hash-tagged layout.
+    Keys are moved by DUMP & RESTORE with TTL, so source and target
+    can be different servers or cluster. Return count of moved keys
+    """
+    moved = 0
+    cursor = None
+    while cursor != 0:
+        cursor, keys = source.scan(cursor or 0, match=pattern, count=count)
+        keys = [(key, get_tagged_key(key)) for key in keys]
+        keys = [(key, new_key) for key, new_key in keys if new_key]
+        if not keys:
+            continue
+
+        pipe = source.pipeline(transaction=False)
+        for key, new_key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        replies = pipe.execute()
+
+        restore = target.pipeline(transaction=False)
+        for i, (key, new_key) in enumerate(keys):
+            value, ttl = replies[i * 2], replies[i * 2 + 1]
+            if value is not None:
+                restore.restore(new_key, max(ttl, 0), value, replace=True)
+        restore.execute()
+
+        if delete:
+            pipe = source.pipeline(transaction=False)
+            for key, new_key in keys:
+                pipe.delete(key)
+            pipe.execute()
+        moved += len(keys)
+    return moved
+
+
+def fan_out(redis, function, workers=None):
+    """
+    Call function for every primary node in parallel,
+    return list of results
+    """
+    nodes = get_nodes(redis)
+    if len(nodes) == 1:
+        return [function(nodes[0])]
+    pool = ThreadPool(workers or len(nodes))
+    try:
+        return pool.map(function, nodes)
+    finally:
+        pool.close()
@@ -0,0 +1,893 @@
+# -*- coding: utf-8 -*-
+
+"""
+Storage backends of metrics.
+
+Metrics classes call commands of storage client directly, abstract
+`StorageBackend` declares all commands, which are used by library,
+with signatures of redis-py client. Client is an instance of it,
+when all commands are implemented, so redis-py clients
+(`StrictRedis`, `RedisMetricsClient`) are checked structurally,
+and proxies with dynamic commands (`ShardedRedis`, `RedisMetricsRouter`)
+are registered.
+
+`MemoryStorage` is in-process engine on dicts for single-node collectors,
+unit tests & benchmarks without network. Replies are the same as replies
+of redis client with `decode_responses=True`. Data can be saved
+into local snapshot file periodically and loaded on start.
+Lua scripts of library are executed by Python equivalents.
+"""
+
+import os
+import pickle
+import threading
+from abc import ABCMeta, abstractmethod
+from collections import deque
+from fnmatch import fnmatchcase
+from functools import wraps
+from hashlib import sha1
+from itertools import islice
+from time import time
+
+from redis.exceptions import ResponseError
+
+from metrics.redis_wrapper import RedisMetricsRouter
+from metrics.scripts import COMPACT_MOVE_SCRIPT, UTM_SAVE_SCRIPT
+from metrics.sharding import ShardedRedis
+
+
+# Python 2 & 3 compatible base with ABCMeta
+_ABC = ABCMeta('_ABC', (object,), {'__slots__': ()})
+
+
+class StorageBackend(_ABC):
+    """
+    Storage interface. Commands have signatures of redis-py client,
+    `pipeline` queues the same commands and returns replies by `execute`.
+    ZINCRBY & ZADD are sent by `execute_command`
+    """
+    __slots__ = ()
+    commands = ()
+
+    @classmethod
+    def __subclasshook__(cls, klass):
+        if cls is StorageBackend and not cls.get_missing(klass):
+            return True
+        return NotImplemented
+
+    @classmethod
+    def get_missing(cls, client):
+        """
+        Get commands, which are not implemented by client
+        """
+        return [name for name in cls.commands
+                if not callable(getattr(client, name, None))]
+
+    # keys
+
+    @abstractmethod
+    def delete(self, *names):
+        raise NotImplementedError
+
+    @abstractmethod
+    def exists(self, *names):
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire(self, name, time):
+        raise NotImplementedError
+
+    @abstractmethod
+    def expireat(self, name, when):
+        raise NotImplementedError
+
+    @abstractmethod
+    def keys(self, pattern='*'):
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan(self, cursor=0, match=None, count=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def ttl(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pttl(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def type(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def dump(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def restore(self, name, ttl, value, replace=False):
+        raise NotImplementedError
+
+    # strings
+
+    @abstractmethod
+    def get(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def mget(self, keys, *args):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        raise NotImplementedError
+
+    @abstractmethod
+    def setex(self, name, time, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def incr(self, name, amount=1):
+        raise NotImplementedError
+
+    @abstractmethod
+    def incrby(self, name, amount=1):
+        raise NotImplementedError
+
+    # hashes
+
+    @abstractmethod
+    def hget(self, name, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hgetall(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hincrby(self, name, key, amount=1):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hkeys(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hlen(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hmget(self, name, keys, *args):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hscan(self, name, cursor=0, match=None, count=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def hset(self, name, key=None, value=None, mapping=None):
+        raise NotImplementedError
+
+    # lists
+
+    @abstractmethod
+    def llen(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lpush(self, name, *values):
+        raise NotImplementedError
+
+    @abstractmethod
+    def lrange(self, name, start, end):
+        raise NotImplementedError
+
+    @abstractmethod
+    def ltrim(self, name, start, end):
+        raise NotImplementedError
+
+    # sets & HyperLogLogs
+
+    @abstractmethod
+    def sadd(self, name, *values):
+        raise NotImplementedError
+
+    @abstractmethod
+    def scard(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def smembers(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pfadd(self, name, *values):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pfcount(self, *sources):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pfmerge(self, dest, *sources):
+        raise NotImplementedError
+
+    # sorted sets
+
+    @abstractmethod
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        raise NotImplementedError
+
+    @abstractmethod
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        raise NotImplementedError
+
+    @abstractmethod
+    def zscore(self, name, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def zunionstore(self, dest, keys, aggregate=None):
+        raise NotImplementedError
+
+    # commands, pipelines & scripts
+
+    @abstractmethod
+    def execute_command(self, *args, **options):
+        raise NotImplementedError
+
+    @abstractmethod
+    def pipeline(self, transaction=True, shard_hint=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def register_script(self, script):
+        raise NotImplementedError
+
+    @abstractmethod
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        raise NotImplementedError
+
+
+StorageBackend.commands = tuple(sorted(StorageBackend.__abstractmethods__))
+# keyless commands of sharded client are sent to nodes by helpers
+StorageBackend.register(ShardedRedis)
+StorageBackend.register(RedisMetricsRouter)
+
+
+class _HyperLogLog(set):
+    """
+    Exact set of values, it is stored as string by redis
+    """
+
+
+class _SortedSet(dict):
+    pass
+
+
+_text_type = type(u'')
+
+
+def _text(value):
+    """
+    Keys, fields & members are strings like in redis
+    """
+    if isinstance(value, _text_type):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return _text_type(value)
+
+
+def _reply(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def _locked(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _utm_save(storage, keys, args):
+    amount = int(args[0])
+    suffix = _text(args[1])
+    saved = 0
+    for i in range(2, len(args), 2):
+        field = _text(args[i + 1])
+        storage.hincrby(keys[int(args[i]) - 1], field, amount)
+        saved += 1
+        if suffix:
+            member = '%s-||-%s' % (field, suffix)
+            if len(keys) > 4 + saved:
+                storage.sadd(keys[4 + saved], member)
+            storage.hincrby(keys[4], member, amount)
+    return saved
+
+
+def _compact_move(storage, keys, args):
+    moved = 0
+    for i in range(1, len(keys)):
+        kind, name = _text(args[i * 2 - 2]), _text(args[i * 2 - 1])
+        if kind == 'string':
+            value = storage.get(keys[i])
+            if value is not None:
+                storage.hincrby(keys[0], name, int(value))
+                moved += 1
+        else:
+            for field, value in storage.hgetall(keys[i]).items():
+                storage.hincrby(keys[0], name + field, int(value))
+                moved += 1
+        storage.delete(keys[i])
+    return moved
+
+
+def _get_sha(script):
+    if not isinstance(script, bytes):
+        script = script.encode('utf-8')
+    return sha1(script).hexdigest()
+
+
+# Python equivalents of Lua scripts by SHA1
+SCRIPTS = {
+    _get_sha(UTM_SAVE_SCRIPT): _utm_save,
+    _get_sha(COMPACT_MOVE_SCRIPT): _compact_move,
+}
+
+
+class MemoryScript(object):
+    def __init__(self, storage, script):
+        self.storage = storage
+        self.script = script
+        self.sha = _get_sha(script)
+
+    def __call__(self, keys=(), args=(), client=None):
+        keys, args = list(keys), list(args)
+        client = client or self.storage
+        return client.evalsha(self.sha, len(keys), *(keys + args))
+
+
+class MemoryPipeline(object):
+    """
+    Commands are queued and executed under storage lock,
+    so pipeline is applied atomically
+    """
+    def __init__(self, storage, transaction=True):
+        self.storage = storage
+        self.transaction = transaction
+        self.reset()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.reset()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def reset(self):
+        self._commands = []
+        self.scripts = set()
+
+    def execute(self, raise_on_error=True):
+        """
+        Commands are applied atomically under storage lock. Like in redis,
+        failed command doesn't roll back others, its error is raised
+        after all commands or returned in place of reply
+        """
+        commands = self._commands
+        self.reset()
+        replies = []
+        with self.storage._lock:
+            for name, args, kwargs in commands:
+                command = getattr(self.storage, name)
+                try:
+                    replies.append(command(*args, **kwargs))
+                except ResponseError as exc:
+                    replies.append(exc)
+        if raise_on_error:
+            for reply in replies:
+                if isinstance(reply, ResponseError):
+                    raise reply
+        return replies
+
+
+class MemoryStorage(StorageBackend):
+    """
+    In-process storage engine. With `snapshot_path` data is loaded
+    from file on start and saved by `save`, on `close` and every
+    `snapshot_interval` seconds by background thread
+    """
+    def __init__(self, snapshot_path=None, snapshot_interval=None):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load()
+        if snapshot_path and snapshot_interval:
+            self._thread = threading.Thread(
+                target=self._run, name='metrics-snapshot')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # snapshots
+
+    def _run(self):
+        while not self._stopped.wait(self.snapshot_interval):
+            self.purge()
+            self.save()
+
+    def save(self, path=None):
+        """
+        Write snapshot atomically by temporary file & rename
+        """
+        path = path or self.snapshot_path
+        with self._lock:
+            payload = pickle.dumps(
+                (self._data, self._expires), pickle.HIGHEST_PROTOCOL)
+        temp = '%s.tmp' % path
+        with open(temp, 'wb') as f:
+            f.write(payload)
+        getattr(os, 'replace', os.rename)(temp, path)
+
+    def load(self, path=None):
+        with open(path or self.snapshot_path, 'rb') as f:
+            data, expires = pickle.load(f)
+        with self._lock:
+            self._data, self._expires = data, expires
+            self.purge()
+
+    def close(self):
+        """
+        Stop snapshot thread and save last snapshot
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.snapshot_path:
+            self.save()
+
+    @_locked
+    def purge(self):
+        """
+        Delete expired keys, return count of deleted keys
+        """
+        now = time()
+        expired = [key for key, timestamp in self._expires.items()
+                   if timestamp <= now]
+        for key in expired:
+            self._data.pop(key, None)
+            del self._expires[key]
+        return len(expired)
+
+    # internals
+
+    def _alive(self, key):
+        timestamp = self._expires.get(key)
+        if timestamp is not None and timestamp <= time():
+            self._data.pop(key, None)
+            del self._expires[key]
+        return key in self._data
+
+    def _get(self, key, kind, create=False):
+        key = _text(key)
+        if self._alive(key):
+            value = self._data[key]
+            if type(value) is not kind:
+                raise ResponseError('WRONGTYPE Operation against a key '
+                                    'holding the wrong kind of value')
+            return value
+        if create:
+            value = self._data[key] = kind()
+            return value
+
+    def _get_string(self, key):
+        key = _text(key)
+        if not self._alive(key):
+            return None
+        value = self._data[key]
+        if type(value) in (dict, deque, set, _HyperLogLog, _SortedSet):
+            raise ResponseError('WRONGTYPE Operation against a key '
+                                'holding the wrong kind of value')
+        return value
+
+    @staticmethod
+    def _slice(length, start, end):
+        if start < 0:
+            start = max(length + start, 0)
+        if end < 0:
+            end += length
+        return start, min(end, length - 1)
+
+    # keys
+
+    @_locked
+    def delete(self, *keys):
+        deleted = 0
+        for key in map(_text, keys):
+            if self._alive(key):
+                del self._data[key]
+                self._expires.pop(key, None)
+                deleted += 1
+        return deleted
+
+    unlink = delete
+
+    @_locked
+    def exists(self, *keys):
+        return sum(1 for key in map(_text, keys) if self._alive(key))
+
+    @_locked
+    def expireat(self, name, when):
+        name = _text(name)
+        if not self._alive(name):
+            return False
+        self._expires[name] = float(when)
+        self._alive(name)
+        return True
+
+    def expire(self, name, time_seconds):
+        return self.expireat(name, time() + int(time_seconds))
+
+    @_locked
+    def pttl(self, name):
+        name = _text(name)
+        if not self._alive(name):
+            return -2
+        if name not in self._expires:
+            return -1
+        return int((self._expires[name] - time()) * 1000)
+
+    def ttl(self, name):
+        ttl = self.pttl(name)
+        return ttl if ttl < 0 else int(round(ttl / 1000.0))
+
+    @_locked
+    def type(self, name):
+        name = _text(name)
+        if not self._alive(name):
+            return 'none'
+        return {
+            dict: 'hash',
+            deque: 'list',
+            set: 'set',
+            _SortedSet: 'zset',
+        }.get(type(self._data[name]), 'string')
+
+    @_locked
+    def keys(self, pattern='*'):
+        pattern = _text(pattern)
+        return [key for key in list(self._data)
+                if self._alive(key) and fnmatchcase(key, pattern)]
+
+    def scan(self, cursor=0, match=None, count=None, **kwargs):
+        """
+        All keys are returned by one call, COUNT is a hint only
+        """
+        return 0, self.keys(match or '*')
+
+    @_locked
+    def flushdb(self, *args, **kwargs):
+        self._data.clear()
+        self._expires.clear()
+        return True
+
+    @_locked
+    def dump(self, name):
+        name = _text(name)
+        if not self._alive(name):
+            return None
+        return pickle.dumps(self._data[name], pickle.HIGHEST_PROTOCOL)
+
+    @_locked
+    def restore(self, name, ttl, value, replace=False, **kwargs):
+        name = _text(name)
+        if self._alive(name) and not replace:
+            raise ResponseError('BUSYKEY Target key name already exists.')
+        self._data[name] = pickle.loads(value)
+        self._expires.pop(name, None)
+        if ttl:
+            self._expires[name] = time() + ttl / 1000.0
+        return True
+
+    @_locked
+    def memory_usage(self, key, samples=None):
+        value = self.dump(key)
+        return len(value) if value is not None else None
+
+    # strings
+
+    @_locked
+    def get(self, name):
+        return _reply(self._get_string(name))
+
+    @_locked
+    def mget(self, keys, *args):
+        values = []
+        for key in list(keys) + list(args):
+            try:
+                values.append(self.get(key))
+            except ResponseError:
+                values.append(None)
+        return values
+
+    @_locked
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        name = _text(name)
+        exists = self._alive(name)
+        if (nx and exists) or (xx and not exists):
+            return None
+        if not isinstance(value, bytes):
+            value = _text(value)
+        self._data[name] = value
+        self._expires.pop(name, None)
+        if ex:
+            self._expires[name] = time() + ex
+        elif px:
+            self._expires[name] = time() + px / 1000.0
+        return True
+
+    def setex(self, name, time_seconds, value):
+        return self.set(name, value, ex=time_seconds)
+
+    @_locked
+    def incrby(self, name, amount=1):
+        name = _text(name)
+        value = int(self._get_string(name) or 0) + int(amount)
+        self._data[name] = value
+        return value
+
+    def incr(self, name, amount=1):
+        return self.incrby(name, amount)
+
+    # hashes
+
+    @_locked
+    def hset(self, name, key=None, value=None, mapping=None):
+        data = self._get(name, dict, create=True)
+        items = list((mapping or {}).items())
+        if key is not None:
+            items.append((key, value))
+        added = 0
+        for key, value in items:
+            key = _text(key)
+            added += key not in data
+            data[key] = value if isinstance(value, bytes) else _text(value)
+        return added
+
+    @_locked
+    def hget(self, name, key):
+        return _reply((self._get(name, dict) or {}).get(_text(key)))
+
+    @_locked
+    def hmget(self, name, keys, *args):
+        data = self._get(name, dict) or {}
+        return [_reply(data.get(_text(key)))
+                for key in list(keys) + list(args)]
+
+    @_locked
+    def hgetall(self, name):
+        return dict((key, _reply(value)) for key, value in
+                    (self._get(name, dict) or {}).items())
+
+    @_locked
+    def hkeys(self, name):
+        return list(self._get(name, dict) or ())
+
+    @_locked
+    def hlen(self, name):
+        return len(self._get(name, dict) or ())
+
+    @_locked
+    def hincrby(self, name, key, amount=1):
+        data = self._get(name, dict, create=True)
+        key = _text(key)
+        value = data[key] = int(data.get(key) or 0) + int(amount)
+        return value
+
+    def hscan(self, name, cursor=0, match=None, count=None):
+        """
+        All fields are returned by one call, COUNT is a hint only
+        """
+        data = self.hgetall(name)
+        if match:
+            match = _text(match)
+            data = dict((key, value) for key, value in data.items()
+                        if fnmatchcase(key, match))
+        return 0, data
+
+    # lists
+
+    @_locked
+    def lpush(self, name, *values):
+        data = self._get(name, deque, create=True)
+        for value in values:
+            data.appendleft(value)
+        return len(data)
+
+    @_locked
+    def lrange(self, name, start, end):
+        data = self._get(name, deque) or deque()
+        start, end = self._slice(len(data), start, end)
+        if start > end:
+            return []
+        return [_reply(value) for value in islice(data, start, end + 1)]
+
+    @_locked
+    def ltrim(self, name, start, end):
+        data = self._get(name, deque)
+        if data is None:
+            return True
+        start, end = self._slice(len(data), start, end)
+        if start > end:
+            return self.delete(name) or True
+        self._data[_text(name)] = deque(islice(data, start, end + 1))
+        return True
+
+    @_locked
+    def llen(self, name):
+        return len(self._get(name, deque) or ())
+
+    # sets & HyperLogLogs
+
+    @_locked
+    def sadd(self, name, *values):
+        data = self._get(name, set, create=True)
+        size = len(data)
+        data.update(map(_text, values))
+        return len(data) - size
+
+    @_locked
+    def smembers(self, name):
+        return set(self._get(name, set) or ())
+
+    @_locked
+    def scard(self, name):
+        return len(self._get(name, set) or ())
+
+    @_locked
+    def pfadd(self, name, *values):
+        data = self._get(name, _HyperLogLog, create=True)
+        size = len(data)
+        data.update(map(_text, values))
+        return int(len(data) != size or not size)
+
+    @_locked
+    def pfcount(self, *sources):
+        values = set()
+        for source in sources:
+            values.update(self._get(source, _HyperLogLog) or ())
+        return len(values)
+
+    @_locked
+    def pfmerge(self, dest, *sources):
+        data = self._get(dest, _HyperLogLog, create=True)
+        for source in sources:
+            data.update(self._get(source, _HyperLogLog) or ())
+        return True
+
+    # sorted sets
+
+    @_locked
+    def zincrby(self, name, amount, value):
+        data = self._get(name, _SortedSet, create=True)
+        value = _text(value)
+        score = data[value] = data.get(value, 0.0) + float(amount)
+        return score
+
+    @_locked
+    def zadd(self, name, *args, **kwargs):
+        """
+        Members are passed by mapping (redis-py 3) or by score,
+        member pairs (redis-py 2 & raw ZADD)
+        """
+        if args and isinstance(args[0], dict):
+            items = list(args[0].items())
+        else:
+            items = [(args[i + 1], args[i]) for i in range(0, len(args), 2)]
+            items.extend(kwargs.get('mapping', {}).items())
+        data = self._get(name, _SortedSet, create=True)
+        added = 0
+        for member, score in items:
+            member = _text(member)
+            added += member not in data
+            data[member] = float(score)
+        return added
+
+    @_locked
+    def zscore(self, name, value):
+        return (self._get(name, _SortedSet) or {}).get(_text(value))
+
+    @_locked
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        data = self._get(name, _SortedSet) or {}
+        items = sorted(data.items(), key=lambda item: (item[1], item[0]),
+                       reverse=desc)
+        start, end = self._slice(len(items), start, end)
+        if start > end:
+            return []
+        items = items[start:end + 1]
+        if withscores:
+            return [(member, score_cast_func(score))
+                    for member, score in items]
+        return [member for member, score in items]
+
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        return self.zrange(name, start, end, True, withscores,
+                           score_cast_func)
+
+    @_locked
+    def zunionstore(self, dest, keys, aggregate=None):
+        if not isinstance(keys, dict):
+            keys = dict((key, 1) for key in keys)
+        merge = {'MIN': min, 'MAX': max}.get(
+            (aggregate or 'SUM').upper(), lambda a, b: a + b)
+        result = _SortedSet()
+        for key, weight in keys.items():
+            for member, score in (self._get(key, _SortedSet) or {}).items():
+                score *= weight
+                if member in result:
+                    score = merge(result[member], score)
+                result[member] = score
+        self.delete(dest)
+        if result:
+            self._data[_text(dest)] = result
+        return len(result)
+
+    # commands, pipelines & scripts
+
+    @_locked
+    def execute_command(self, command, *args, **kwargs):
+        name = _text(command).lower()
+        if name == 'del':
+            name = 'delete'
+        if name not in self.commands and name not in (
+                'unlink', 'zadd', 'zincrby', 'flushdb'):
+            raise ResponseError('Unknown command %s' % command)
+        return getattr(self, name)(*args, **kwargs)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self, transaction)
+
+    def register_script(self, script):
+        return MemoryScript(self, script)
+
+    @_locked
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        function = SCRIPTS.get(_text(sha))
+        if function is None:
+            raise NotImplementedError(
+                'Script %s has no Python equivalent' % sha)
+        keys = [_text(key) for key in keys_and_args[:numkeys]]
+        return function(self, keys, keys_and_args[numkeys:])
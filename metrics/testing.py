@@ -9,8 +9,10 @@ from metrics import *
 class TestData(object):
     def __init__(self, date=datetime.now().strftime('%Y-%m-%d'),
                  page_id=28025, variant_id=34924, profile_id=1, channel_id=1,
-                 data_values=None, utm_params=None, additional_params=None):
-        self.redis = RedisMetricsClient()
+                 data_values=None, utm_params=None, additional_params=None,
+                 redis=None):
+        # any storage can be passed, e.g. MemoryStorage without redis
+        self.redis = redis if redis is not None else RedisMetricsClient()
         self.data_values = data_values or [
             '91.195.136.52',
             time(),
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multi-resolution time series of visits, unique, goals & leads.
+
+Every event is bucketed by its own timestamp (UTC) at fine resolution
+(minute or 5 minutes) and rolled up into hour and day aggregates
+by the same pipeline. Old fine buckets are downsampled by TTL,
+hour and day aggregates are kept longer.
+
+Storage is packed into small hashes, which are kept in listpack
+encoding by redis (not more than 128 fields):
+
+* fine buckets - hash per 30 buckets, field `<bucket>:<type>`
+* hours        - hash per day, field `<hour>:<type>`
+* days         - hash per month, field `<day>:<type>`
+"""
+
+from calendar import timegm
+from datetime import datetime
+from time import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from metrics.cache import MISSING, LocalCache
+
+
+def _get_timestamp(value=None):
+    """
+    Get unix time from datetime or number, now by default
+    """
+    if value is None:
+        return int(time())
+    if isinstance(value, datetime):
+        return timegm(value.utctimetuple())
+    return int(value)
+
+
+class TimeSeries(object):
+    namespace = 'timeseries'
+    hash_tag = False
+    types = ('visits', 'unique', 'goals', 'leads')
+    buckets_per_key = 30
+    steps = ('fine', 'hour', 'day')
+
+    # EXPIRE is sent once per key by process, while key is in cache.
+    # Key is cached by reply of EXPIRE, so into pipeline of caller
+    # the command is queued with every write
+    expire_cache = LocalCache(maxsize=100000, ttl=3600)
+
+    def __init__(self, redis, variant_id, resolution=60,
+                 fine_ttl=2 * 86400, hour_ttl=90 * 86400, day_ttl=None,
+                 pipeline=None):
+        if resolution <= 0 or 3600 % resolution:
+            raise ValueError('Resolution should be divisor of hour')
+        self.redis = redis
+        self.variant_id = variant_id
+        self.resolution = resolution
+        self.ttl = {'fine': fine_ttl, 'hour': hour_ttl, 'day': day_ttl}
+        self.pipeline = pipeline
+
+    def _get_key(self, step, name):
+        variant = self.variant_id
+        if self.hash_tag:
+            variant = '{%s}' % variant
+        if step == 'fine':
+            step = 'fine%s' % self.resolution
+        return '%s:%s:%s:%s' % (self.namespace, variant, step, name)
+
+    def _get_fine_span(self):
+        return self.resolution * self.buckets_per_key
+
+    def _locate(self, step, timestamp):
+        """
+        Get (key, field prefix) of bucket with timestamp
+        """
+        if step == 'fine':
+            span = self._get_fine_span()
+            start = timestamp - timestamp % span
+            return (self._get_key(step, start),
+                    (timestamp - start) // self.resolution)
+        moment = datetime.utcfromtimestamp(timestamp)
+        if step == 'hour':
+            return (self._get_key(step, moment.strftime('%Y%m%d')),
+                    moment.hour)
+        return self._get_key(step, moment.strftime('%Y%m')), moment.day
+
+    def _expire(self, pipe, step, key, expires):
+        """
+        Queue EXPIRE of key once per call, position of command
+        is kept for check of reply
+        """
+        ttl = self.ttl[step]
+        if not ttl or key in expires or (
+                self.expire_cache.get(key) is not MISSING):
+            return
+        expires[key] = (len(pipe), ttl)
+        pipe.expire(key, ttl)
+
+    def add(self, types, timestamp=None, amount=1):
+        """
+        Increment counters of event time in fine bucket
+        and in hour & day aggregates by one round trip.
+        `types` is list of counter types of the same event
+        """
+        timestamp = _get_timestamp(timestamp)
+        pipe = self.pipeline
+        if pipe is None:
+            pipe = self.redis.pipeline(transaction=False)
+        expires = {}
+        for count_type in types:
+            if count_type not in self.types:
+                raise ValueError('Unknown type %s' % count_type)
+            for step in self.steps:
+                key, bucket = self._locate(step, timestamp)
+                pipe.hincrby(key, '%s:%s' % (bucket, count_type), amount)
+                self._expire(pipe, step, key, expires)
+        if self.pipeline is not None:
+            return
+        replies = pipe.execute()
+        # EXPIRE of not existing key does nothing
+        for key, (index, ttl) in expires.items():
+            if replies[index]:
+                self.expire_cache.set(key, ttl)
+        return replies
+
+    def save_visitor(self, is_unique=0, timestamp=None):
+        if is_unique:
+            return self.add(['visits', 'unique'], timestamp)
+        return self.add(['visits'], timestamp)
+
+    def save_goal(self, timestamp=None, amount=1):
+        self.add(['goals'], timestamp, amount)
+
+    def decrease_goal(self, timestamp=None):
+        self.add(['goals'], timestamp, -1)
+
+    def save_lead(self, timestamp=None, amount=1):
+        self.add(['leads'], timestamp, amount)
+
+    def decrease_lead(self, timestamp=None):
+        self.add(['leads'], timestamp, -1)
+
+    def _get_size(self, step):
+        return {'fine': self.resolution, 'hour': 3600, 'day': 86400}[step]
+
+    def _get_points(self, step, start, end):
+        """
+        Get timestamps of all buckets between start & end
+        """
+        size = self._get_size(step)
+        first = start - start % size
+        return list(range(first, end + 1, size))
+
+    def get_range(self, start, end=None, step='fine'):
+        """
+        Get dense series of every type for range of time by one
+        pipelined call. Result contains `timestamps` of buckets and
+        array of counters for every type (NumPy, when it is installed)
+        """
+        if step not in self.steps:
+            raise ValueError('Unknown step %s' % step)
+        start = _get_timestamp(start)
+        end = _get_timestamp(end)
+        points = self._get_points(step, start, end)
+
+        locations = [self._locate(step, point) for point in points]
+        keys = []
+        for key, bucket in locations:
+            if key not in keys:
+                keys.append(key)
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        hashes = dict(zip(keys, pipe.execute()))
+
+        series = {'timestamps': points}
+        for count_type in self.types:
+            values = []
+            for key, bucket in locations:
+                field = '%s:%s' % (bucket, count_type)
+                data = hashes[key]
+                value = data.get(field)
+                if value is None:
+                    value = data.get(field.encode('utf-8'))
+                values.append(int(value or 0))
+            series[count_type] = values
+        if numpy is not None:
+            for name in ('timestamps',) + self.types:
+                series[name] = numpy.array(series[name], dtype='int64')
+        return series
+
+    def get_last(self, seconds=3600, step='fine'):
+        """
+        Get dense series of last seconds, e.g. last 60 minutes
+        for real-time dashboard by one round trip.
+        Current (not finished) bucket is the last one
+        """
+        size = self._get_size(step)
+        end = _get_timestamp()
+        return self.get_range(end - end % size - seconds + size, end, step)
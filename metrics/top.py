@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+Top-K by sorted set indexes.
+
+Metrics classes with `top_index` increment sorted sets of utm terms,
+campaigns & ips of variant-day with the same writes as hashes
+(see `MetricsAbstract._top_increment`), top is read by ZREVRANGE
+in O(log N + n). Helpers below merge indexes of many days & variants
+by ZUNIONSTORE.
+"""
+
+from heapq import nlargest
+from operator import itemgetter
+from uuid import uuid4
+
+from metrics.sharding import is_distributed
+
+
+def _merge_in_memory(redis, keys):
+    """
+    Keys of many nodes are read by ZRANGE and summed in memory
+    """
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.zrange(key, 0, -1, withscores=True)
+    data = {}
+    for members in pipe.execute():
+        for member, score in members:
+            data[member] = data.get(member, 0) + int(score)
+    return data
+
+
+def get_top_union(redis, keys, n):
+    """
+    Get [(member, count), ...] of union of sorted sets,
+    scores of the same member are summed
+    """
+    keys = list(keys)
+    if not keys:
+        return []
+    if is_distributed(redis):
+        return nlargest(n, _merge_in_memory(redis, keys).items(),
+                        key=itemgetter(1))
+    if len(keys) == 1:
+        top = redis.zrevrange(keys[0], 0, n - 1, withscores=True)
+    else:
+        target = 'top_union:%s' % uuid4().hex
+        pipe = redis.pipeline(transaction=False)
+        pipe.zunionstore(target, keys)
+        pipe.zrevrange(target, 0, n - 1, withscores=True)
+        pipe.delete(target)
+        top = pipe.execute()[1]
+    return [(member, int(score)) for member, score in top]
+
+
+def merge_top(redis, destination, keys, ttl=None, chunk_size=1000):
+    """
+    Save union of sorted sets into destination key by ZUNIONSTORE,
+    return count of members
+    """
+    keys = list(keys)
+    if is_distributed(redis):
+        items = list(_merge_in_memory(redis, keys).items())
+        pipe = redis.pipeline(transaction=False)
+        pipe.delete(destination)
+        for i in range(0, len(items), chunk_size):
+            args = []
+            for member, score in items[i:i + chunk_size]:
+                args.extend([score, member])
+            pipe.execute_command('ZADD', destination, *args)
+        if ttl:
+            pipe.expire(destination, ttl)
+        pipe.execute()
+        return len(items)
+    pipe = redis.pipeline(transaction=False)
+    pipe.zunionstore(destination, keys)
+    if ttl:
+        pipe.expire(destination, ttl)
+    return pipe.execute()[0]
@@ -10,7 +10,7 @@ setup(
     author="GoTLiuM InSPiRiT",
     author_email='gotlium@gmail.com',
     url='https://github.com/LPgenerator/lpg-metrics',
-    packages=find_packages(exclude=['demo']),
+    packages=find_packages(exclude=['demo', 'tests', 'tests.*']),
     include_package_data=True,
     install_requires=[
         'redis>=2.8.0',
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime
+
+from metrics import (
+    HourMetrics, MetricsAbstract, TariffStats, TotalMetrics, UtmMetrics,
+    VisitorMetrics)
+from metrics.cache import LocalCache
+from metrics.storage import MemoryStorage
+
+
+CLASSES = (MetricsAbstract, VisitorMetrics, UtmMetrics, HourMetrics,
+           TotalMetrics, TariffStats)
+OPTIONS = ('retention_days', 'hash_tag', 'compact', 'top_index',
+           'track_version', 'geo_resolver')
+
+
+def dump(redis):
+    data = {}
+    for key in redis.keys('*'):
+        kind = redis.type(key)
+        if 'hll' in key:
+            value = redis.pfcount(key)
+        elif kind == 'hash':
+            value = redis.hgetall(key)
+        elif kind == 'list':
+            value = sorted(redis.lrange(key, 0, -1))
+        elif kind == 'set':
+            value = sorted(redis.smembers(key))
+        elif kind == 'zset':
+            value = redis.zrange(key, 0, -1, withscores=True)
+        else:
+            value = redis.get(key)
+        data[key] = (value, redis.ttl(key) > 0)
+    return data
+
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    Every test is run against empty in-memory storage, class options
+    & process caches are restored after test
+    """
+    def setUp(self):
+        self.redis = MemoryStorage()
+        self.date = datetime.utcnow().strftime('%Y-%m-%d')
+        self._options = [(cls, dict((name, vars(cls)[name])
+                                    for name in OPTIONS if name in vars(cls)))
+                         for cls in CLASSES]
+        self._retention_cache = MetricsAbstract.retention_cache
+        MetricsAbstract.retention_cache = LocalCache(maxsize=1000, ttl=3600)
+
+    def tearDown(self):
+        for cls, options in self._options:
+            for name in OPTIONS:
+                if name in options:
+                    setattr(cls, name, options[name])
+                elif name in vars(cls):
+                    delattr(cls, name)
+        MetricsAbstract.retention_cache = self._retention_cache
+        self.redis.close()
+
+    def set_options(self, classes=CLASSES[:1], **options):
+        for cls in classes:
+            for name, value in options.items():
+                setattr(cls, name, value)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+
+from redis.exceptions import ConnectionError
+
+from metrics import VisitorMetrics
+from metrics.aggregator import CounterAggregator
+from metrics.storage import MemoryPipeline, MemoryStorage
+
+from tests.base import MetricsTestCase
+
+
+class FailingPipeline(MemoryPipeline):
+    def execute(self, raise_on_error=True):
+        names = set(name for name, args, kwargs in self._commands)
+        if self.storage.failures and names & self.storage.failing:
+            self.storage.failures -= 1
+            self.reset()
+            raise ConnectionError('failed')
+        return super(FailingPipeline, self).execute(raise_on_error)
+
+
+class FailingStorage(MemoryStorage):
+    """
+    Pipelines with failing commands are failed `failures` times
+    """
+    def __init__(self, failing, failures=1):
+        super(FailingStorage, self).__init__()
+        self.failing = set(failing)
+        self.failures = failures
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return FailingPipeline(self, transaction)
+
+
+class AggregatorTestCase(MetricsTestCase):
+    def get_aggregator(self, redis, **options):
+        return CounterAggregator(redis, autostart=False, **options)
+
+    def test_coalescing(self):
+        aggregator = self.get_aggregator(self.redis)
+        visitor = VisitorMetrics(1, self.date, self.redis,
+                                 aggregator=aggregator)
+        for _ in range(10):
+            visitor.save_goal(['1.2.3.4'])
+        self.assertEqual(visitor.get_goals(), 0)
+        self.assertEqual(aggregator.pending(), 2)
+        self.assertEqual(aggregator.flush(), 2)
+        self.assertEqual(visitor.get_goals(), '10')
+        stats = aggregator.get_stats()
+        self.assertEqual(stats['hits'], 20)
+        self.assertEqual(stats['coalescing_ratio'], 10.0)
+
+    def test_failed_deltas(self):
+        redis = FailingStorage(['incrby'])
+        aggregator = self.get_aggregator(redis, batch_size=1)
+        aggregator.hash_increment('hash', 'a', 2)
+        aggregator.increment('counter', 3)
+        aggregator.expire_at('counter', 4102444800)
+        with self.assertRaises(ConnectionError):
+            aggregator.flush()
+        # executed batch is not sent again
+        self.assertEqual(redis.hgetall('hash'), {'a': '2'})
+        self.assertEqual(aggregator.pending(), 1)
+        self.assertEqual(aggregator.flush(), 1)
+        self.assertEqual(redis.hgetall('hash'), {'a': '2'})
+        self.assertEqual(redis.get('counter'), '3')
+        self.assertTrue(redis.ttl('counter') > 0)
+        stats = aggregator.get_stats()
+        self.assertEqual((stats['hits'], stats['commands']), (2, 2))
+        self.assertEqual(stats['errors'], 1)
+
+    def test_failed_expires(self):
+        redis = FailingStorage(['expireat'])
+        aggregator = self.get_aggregator(redis)
+        aggregator.increment('counter', 3)
+        aggregator.expire_at('counter', 4102444800)
+        with self.assertRaises(ConnectionError):
+            aggregator.flush()
+        self.assertEqual(redis.get('counter'), '3')
+        self.assertEqual(redis.ttl('counter'), -1)
+        self.assertEqual(aggregator.pending(), 0)
+
+        # only EXPIREAT is retried
+        self.assertEqual(aggregator.flush(), 0)
+        self.assertEqual(redis.get('counter'), '3')
+        self.assertTrue(redis.ttl('counter') > 0)
+        stats = aggregator.get_stats()
+        self.assertEqual((stats['hits'], stats['commands']), (1, 1))
+
+    def test_rejected_delta(self):
+        self.redis.set('string', 'value')
+        aggregator = self.get_aggregator(self.redis, max_retries=3)
+        aggregator.hash_increment('string', 'a', 2)
+        aggregator.increment('counter', 1)
+        self.assertEqual(aggregator.flush(), 1)
+        self.assertEqual(self.redis.get('counter'), '1')
+        self.assertEqual(aggregator.pending(), 1)
+
+        # applied commands of batch are not sent again
+        for _ in range(4):
+            aggregator.flush()
+        self.assertEqual(self.redis.get('counter'), '1')
+        self.assertEqual(self.redis.get('string'), 'value')
+        self.assertEqual(aggregator.pending(), 0)
+        stats = aggregator.get_stats()
+        self.assertEqual(stats['errors'], 3)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['commands'], 1)
+
+    def test_exit_handler(self):
+        handlers = []
+        register = atexit.register
+        atexit.register = handlers.append
+        try:
+            aggregator = self.get_aggregator(self.redis)
+            for _ in range(3):
+                aggregator.start()
+                aggregator.close()
+        finally:
+            atexit.register = register
+        self.assertEqual(handlers, [aggregator.close])
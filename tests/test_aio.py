@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from metrics import (
+    HourMetrics, MetricsAbstract, TariffStats, TotalMetrics, UtmMetrics,
+    VisitorMetrics)
+from metrics.aio import (
+    AsyncHourMetrics, AsyncMetricsBatch, AsyncTariffStats, AsyncTotalMetrics,
+    AsyncUtmMetrics, AsyncVisitorMetrics)
+
+from tests.base import MetricsTestCase, dump
+
+DATA = ['10.0.0.1', 'Mozilla', 'direct']
+UTM_PARAMS = {'utm_medium': 'cpc', 'utm_campaign': 'sale', 'utm_term': 'a'}
+AD_PARAMS = {'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'}
+
+
+class RecordingPipeline(object):
+    """
+    Names of queued commands are recorded by client
+    """
+    def __init__(self, client, pipe):
+        self.client = client
+        self.pipe = pipe
+
+    def __len__(self):
+        return len(self.pipe)
+
+    def __getattr__(self, name):
+        command = getattr(self.pipe, name)
+
+        def record(*args, **kwargs):
+            self.client.commands.append(name)
+            command(*args, **kwargs)
+            return self
+        return record
+
+    async def execute(self):
+        return await self.pipe.execute()
+
+
+class RecordingRedis(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        return RecordingPipeline(self, self.redis.pipeline(transaction))
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is required')
+class AsyncMetricsTestCase(MetricsTestCase):
+    def setUp(self):
+        super(AsyncMetricsTestCase, self).setUp()
+        server = fakeredis.FakeServer()
+        self.async_redis = fakeredis.FakeAsyncRedis(
+            server=server, decode_responses=True)
+        self.sync_redis = fakeredis.FakeStrictRedis(
+            server=server, decode_responses=True)
+        self.set_options(retention_days=30)
+
+    def save_sync(self):
+        MetricsAbstract.retention_cache.clear()
+        visitor = VisitorMetrics(1, self.date, self.redis)
+        visitor.save_visitor(1, DATA, fingerprint='x')
+        visitor.save_goal(DATA)
+        visitor.save_additional(**AD_PARAMS)
+        UtmMetrics(1, self.date, self.redis).save_utm_goal(
+            3, dict(UTM_PARAMS), AD_PARAMS)
+        hour = HourMetrics(1, self.date, self.redis)
+        hour.time_string = '09'
+        hour.save_goal()
+        TotalMetrics(5, self.redis).save_unique()
+        TariffStats(4, self.date, self.redis).save_unique('x')
+
+    async def save_async(self, batch=None):
+        MetricsAbstract.retention_cache.clear()
+
+        def create(cls, *args):
+            if batch is not None:
+                return batch.bind(cls, *args)
+            return cls(*args, redis=self.async_redis)
+
+        visitor = create(AsyncVisitorMetrics, 1, self.date)
+        hour = create(AsyncHourMetrics, 1, self.date)
+        hour.metrics.time_string = '09'
+        await asyncio.gather(
+            visitor.save_visitor(1, DATA, fingerprint='x'),
+            visitor.save_goal(DATA),
+            visitor.save_additional(**AD_PARAMS),
+            create(AsyncUtmMetrics, 1, self.date).save_utm_goal(
+                3, dict(UTM_PARAMS), AD_PARAMS),
+            hour.save_goal(),
+            create(AsyncTotalMetrics, 5).save_unique(),
+            create(AsyncTariffStats, 4, self.date).save_unique('x'))
+
+    def test_parity(self):
+        self.save_sync()
+        asyncio.run(self.save_async())
+        self.assertEqual(dump(self.sync_redis), dump(self.redis))
+
+    def test_batch(self):
+        self.save_sync()
+
+        async def save():
+            batch = AsyncMetricsBatch(self.async_redis)
+            executed = []
+            execute = batch.execute
+
+            async def counting_execute():
+                executed.append(len(batch.pipeline))
+                return await execute()
+            batch.execute = counting_execute
+            await self.save_async(batch)
+            return executed
+
+        executed = asyncio.run(save())
+        self.assertEqual(len(executed), 1)
+        self.assertEqual(dump(self.sync_redis), dump(self.redis))
+
+    def test_getters(self):
+        self.save_sync()
+        asyncio.run(self.save_async())
+        visitor = VisitorMetrics(1, self.date, self.redis, save_variant=False)
+
+        async def read():
+            metrics = AsyncVisitorMetrics(1, self.date, self.async_redis)
+            details = [row async for row in metrics.get_details()]
+            return (
+                await metrics.get_visits(), await metrics.get_goals(),
+                await metrics.get_additional_list(), details,
+                await metrics.get_geo(), await metrics.get_unique_estimate(),
+                await AsyncUtmMetrics(1, self.date,
+                                      self.async_redis).get_utm(),
+                await AsyncTotalMetrics(5, self.async_redis).get_conversion())
+
+        utm = UtmMetrics(1, self.date, self.redis, save_variant=False)
+        total = TotalMetrics(5, self.redis, save_variant=False)
+        self.assertEqual(asyncio.run(read()), (
+            visitor.get_visits(), visitor.get_goals(),
+            visitor.get_additional_list(), list(visitor.get_details()),
+            visitor.get_geo(), 1, utm.get_utm(), total.get_conversion()))
+
+    def test_expire_is_sent_once(self):
+        redis = RecordingRedis(self.async_redis)
+
+        async def save(batch=None):
+            if batch is not None:
+                visitor = batch.bind(AsyncVisitorMetrics, 1, self.date)
+            else:
+                visitor = AsyncVisitorMetrics(1, self.date, redis)
+            await visitor.save_goal(DATA)
+            commands = list(redis.commands)
+            del redis.commands[:]
+            return commands
+
+        self.assertIn('expireat', asyncio.run(save()))
+        # keys were remembered by replies of EXPIREAT
+        self.assertEqual(asyncio.run(save()), ['hset', 'incrby', 'hincrby'])
+        self.assertEqual(asyncio.run(save(AsyncMetricsBatch(redis))),
+                         ['hset', 'incrby', 'hincrby'])
+        self.assertFalse(any(MetricsAbstract.pending_expires.values()))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from metrics import (
+    HourMetrics, MetricsAbstract, MetricsBatch, TariffStats, TotalMetrics,
+    UtmMetrics, VisitorMetrics)
+from metrics.observer import CountingRedis
+from metrics.storage import MemoryStorage
+
+from tests.base import MetricsTestCase, dump
+
+DATA = ['10.0.0.1', 'Mozilla', 'http://example.com/?utm_medium=cpc']
+UTM_PARAMS = {'utm_medium': 'cpc', 'utm_campaign': 'sale', 'utm_term': 'a'}
+
+
+class BatchTestCase(MetricsTestCase):
+    def save(self, bind):
+        bind(VisitorMetrics, 1, self.date).save_visitor(
+            1, DATA, fingerprint='x')
+        bind(VisitorMetrics, 1, self.date).save_goal(DATA)
+        bind(UtmMetrics, 1, self.date).save_visit_with_utm(
+            1, 3, dict(UTM_PARAMS))
+        hour = bind(HourMetrics, 1, self.date)
+        hour.time_string = '09'
+        hour.save_visitor(1)
+        bind(TotalMetrics, 5).save_unique()
+        bind(TariffStats, 4, self.date).save_unique('x')
+
+    def test_round_trip(self):
+        self.set_options(retention_days=30, track_version=True)
+        counter = CountingRedis(self.redis)
+        with MetricsBatch(counter) as batch:
+            self.save(batch.bind)
+            self.assertEqual(counter.round_trips, 0)
+        self.assertEqual(counter.round_trips, 1)
+
+        expected = MemoryStorage()
+        self.addCleanup(expected.close)
+        MetricsAbstract.retention_cache.clear()
+        self.save(lambda cls, *args: cls(*args, redis=expected))
+        self.assertEqual(dump(self.redis), dump(expected))
+
+    def test_replies(self):
+        batch = MetricsBatch(self.redis)
+        batch.bind(TotalMetrics, 5, save_variant=False).save_unique()
+        batch.bind(TotalMetrics, 5, save_variant=False).save_unique()
+        self.assertEqual(batch.execute(), [1, 2])
+        self.assertEqual(batch.execute(), [])
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with MetricsBatch(self.redis) as batch:
+                batch.bind(TotalMetrics, 5).save_unique()
+                raise ValueError()
+        self.assertEqual(self.redis.keys('*'), [])
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from metrics.benchmark import Benchmark
+from metrics.storage import MemoryStorage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def run_benchmark(self, *args):
+        output = subprocess.check_output(
+            [sys.executable, os.path.join('metrics', 'benchmark.py'),
+             '--iterations', '2', '--variants', '2', '--ips', '5',
+             '--details', '5'] + list(args), cwd=ROOT,
+            env=dict(os.environ, PYTHONPATH=ROOT))
+        return json.loads(output.decode('utf-8'))['results']
+
+    def test_operations(self):
+        names = [name for name, operation in
+                 Benchmark(MemoryStorage()).get_operations()]
+        for name in ('TotalMetrics.get_goals', 'VisitorMetrics.get_variants',
+                     'TotalMetrics.get_conversions',
+                     'VisitorMetrics.get_details_count',
+                     'VisitorMetrics.get_details_overflow',
+                     'VisitorMetrics.get_unique_estimate'):
+            self.assertIn(name, names)
+
+    def test_fake(self):
+        results = self.run_benchmark('--fake')
+        names = [name for name, operation in
+                 Benchmark(MemoryStorage()).get_operations()]
+        self.assertEqual(sorted(results), sorted(names))
+        self.assertTrue(
+            results['VisitorMetrics.get_goals']['round_trips_per_call'])
+
+    def test_memory(self):
+        results = self.run_benchmark('--memory')
+        self.assertTrue(results['UtmMetrics.get_utm']['ops_per_second'])
+
+    def test_micro(self):
+        results = self.run_benchmark('--micro')
+        self.assertTrue(results['MetricsFacade.hit']['cpu_us_per_call'])
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import warnings
+from datetime import datetime, timedelta
+
+from metrics import HourMetrics, MetricsAbstract, UtmMetrics, VisitorMetrics
+from metrics.cache import LocalCache, RedisCache, ReportCache
+
+from tests.base import MetricsTestCase
+
+
+class ReportCacheTestCase(MetricsTestCase):
+    def setUp(self):
+        super(ReportCacheTestCase, self).setUp()
+        self.set_options(track_version=True)
+        self.cache = ReportCache(LocalCache(), RedisCache(self.redis))
+
+    def get_additional(self, date_string):
+        return VisitorMetrics(1, date_string, self.redis,
+                              cache=self.cache).get_additional_list()
+
+    def test_report_is_cached_by_version(self):
+        metrics = VisitorMetrics(1, self.date, self.redis)
+        metrics.save_additional(ad_id=1, ad_type=1, ad_label='f')
+        self.assertEqual(len(self.get_additional(self.date)), 1)
+
+        calls = []
+        build = VisitorMetrics._build_additional_list
+        VisitorMetrics._build_additional_list = staticmethod(
+            lambda data: calls.append(data) or build(data))
+        try:
+            self.get_additional(self.date)
+            self.assertEqual(calls, [])
+            metrics.save_additional(ad_id=2, ad_type=1, ad_label='f')
+            self.assertEqual(len(self.get_additional(self.date)), 2)
+            self.assertEqual(len(calls), 1)
+        finally:
+            VisitorMetrics._build_additional_list = staticmethod(build)
+
+    def test_past_day_is_invalidated(self):
+        day = (datetime.utcnow() - timedelta(days=3)).strftime('%Y-%m-%d')
+        metrics = VisitorMetrics(1, day, self.redis)
+        metrics.save_additional(ad_id=1, ad_type=1, ad_label='f')
+        self.assertEqual(len(self.get_additional(day)), 1)
+        metrics.decrease_additional(ad_id=1, ad_type=1, ad_label='f')
+        metrics.save_additional(ad_id=2, ad_type=1, ad_label='f')
+        self.assertEqual(len(self.get_additional(day)), 2)
+
+        hour = HourMetrics(1, day, self.redis)
+        hour.time_string = '10'
+        hour.save_lead()
+        cached = HourMetrics(1, day, self.redis, cache=self.cache)
+        self.assertEqual(cached.get_hours_stats(), {'10': {'leads': '1'}})
+        hour.clean_up()
+        self.assertEqual(cached.get_hours_stats(), {})
+
+    def test_warning_without_track_version(self):
+        MetricsAbstract.track_version = False
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            VisitorMetrics(1, self.date, self.redis, cache=self.cache)
+            VisitorMetrics(1, self.date, self.redis)
+        self.assertEqual(len(caught), 1)
+        self.assertTrue(issubclass(caught[0].category, RuntimeWarning))
+
+    def test_flush_db_is_invalidated(self):
+        metrics = VisitorMetrics(1, self.date, self.redis)
+        metrics.save_additional(ad_id=1, ad_type=1, ad_label='f')
+        self.assertEqual(len(self.get_additional(self.date)), 1)
+
+        # version restarts after flush, reports are cached by generation
+        metrics.flush_db()
+        metrics.save_additional(ad_id=2, ad_type=1, ad_label='f')
+        self.assertEqual(self.get_additional(self.date),
+                         VisitorMetrics(1, self.date, self.redis,
+                                        save_variant=False)
+                         .get_additional_list())
+
+    def test_copy_is_returned(self):
+        UtmMetrics(1, self.date, self.redis).save_visit_with_utm(
+            1, 3, {'utm_medium': 'cpc'})
+        utm = UtmMetrics(1, self.date, self.redis, cache=self.cache)
+        expected = utm.get_utm()
+        utm.get_utm().clear()
+        utm.get_utm()['3']['unique'] = 'x'
+        self.assertEqual(UtmMetrics(1, self.date, self.redis,
+                                    cache=self.cache).get_utm(), expected)
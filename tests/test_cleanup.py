@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from redis.exceptions import ResponseError
+
+from metrics import TariffStats, UtmMetrics, VisitorMetrics, now
+from metrics.cleanup import KeysCleaner
+from metrics.storage import MemoryStorage
+
+from tests.base import MetricsTestCase
+
+
+class LegacyStorage(MemoryStorage):
+    """
+    Server without UNLINK, commands are recorded
+    """
+    def __init__(self):
+        super(LegacyStorage, self).__init__()
+        self.sent = []
+
+    def execute_command(self, command, *args, **kwargs):
+        self.sent.append((command, len(args)))
+        if command == 'UNLINK':
+            raise ResponseError("unknown command 'UNLINK'")
+        return super(LegacyStorage, self).execute_command(
+            command, *args, **kwargs)
+
+
+class KeysCleanerTestCase(MetricsTestCase):
+    def setUp(self):
+        super(KeysCleanerTestCase, self).setUp()
+        self.redis = LegacyStorage()
+        for i in range(10):
+            self.redis.set('a:%s' % i, i)
+            self.redis.set('b:%s' % i, i)
+
+    def test_batches(self):
+        cleaner = KeysCleaner(self.redis, batch_size=4)
+        self.assertEqual(cleaner.delete_pattern('a:*'), (10, 0))
+        # like redis, pipeline isn't stopped by unknown command
+        self.assertEqual(self.redis.sent, [
+            ('UNLINK', 4), ('UNLINK', 4), ('UNLINK', 2),
+            ('DEL', 4), ('DEL', 4), ('DEL', 2)])
+        self.assertFalse(cleaner.use_unlink)
+        self.assertEqual(len(self.redis.keys('*')), 10)
+
+    def test_dry_run(self):
+        cleaner = KeysCleaner(self.redis, dry_run=True)
+        self.assertEqual(cleaner.delete_patterns(['a:*', 'b:*']), (20, 0))
+        self.assertEqual(self.redis.sent, [])
+        self.assertEqual(len(self.redis.keys('*')), 20)
+
+    def test_delete_keys(self):
+        cleaner = KeysCleaner(self.redis)
+        self.assertEqual(cleaner.delete_keys([]), 0)
+        self.assertEqual(cleaner.delete_keys(['a:1', 'a:2', 'c']), 2)
+
+
+class CleanUpTestCase(MetricsTestCase):
+    def test_flush_db(self):
+        yesterday = (now() - timedelta(days=1)).strftime('%Y-%m-%d')
+        for date_string in (yesterday, self.date):
+            VisitorMetrics(1, date_string, self.redis).save_goal(['1.1.1.1'])
+            UtmMetrics(1, date_string, self.redis).save_utm_goal(
+                3, {'utm_medium': 'cpc'}, {'ad_id': 1, 'ad_type': 2,
+                                           'ad_label': 'form'})
+        keys = set(self.redis.keys('*'))
+        VisitorMetrics(1, self.date, self.redis).flush_db()
+        self.assertEqual(set(self.redis.keys('*')),
+                         set(key for key in keys if yesterday in key))
+
+    def test_clean_up(self):
+        utm = UtmMetrics(1, self.date, self.redis, save_variant=False)
+        utm.save_utm_goal(3, {'utm_medium': 'cpc'}, {
+            'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'})
+        self.assertTrue(self.redis.keys('*utm_additional_keys*'))
+        UtmMetrics(2, self.date, self.redis).save_utm_goal(
+            3, {'utm_medium': 'cpc'}, None)
+        utm.clean_up()
+        self.assertEqual(self.redis.keys('*:1:*'), [])
+        self.assertTrue(self.redis.keys('*:2:*'))
+
+    def test_tariff_clean_up(self):
+        previous_mon = (now() - timedelta(days=31)).strftime('%Y-%m')
+        for month in (previous_mon, self.date[:7]):
+            stats = TariffStats(4, month, self.redis)
+            stats.save_unique()
+            stats.save_unique('x')
+        self.assertEqual(TariffStats(4, self.date, self.redis).clean_up(), 2)
+        self.assertEqual(self.redis.keys('*%s:4:*' % previous_mon), [])
+        self.assertEqual(len(self.redis.keys('*%s:4:*' % self.date[:7])), 2)
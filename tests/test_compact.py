@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from metrics import HourMetrics, TotalMetrics, UtmMetrics, VisitorMetrics
+from metrics.compact import (
+    benchmark_memory, convert_day, drop_utm_additional_sets)
+from metrics.storage import MemoryStorage
+
+from tests.base import CLASSES, MetricsTestCase, dump
+
+DATA = ['10.0.0.1', 'Mozilla', 'direct']
+UTM_PARAMS = {'utm_medium': 'cpc', 'utm_campaign': 'spring',
+              'utm_term': 'a, b'}
+AD_PARAMS = {'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'}
+
+
+class CompactTestCase(MetricsTestCase):
+    """
+    Getters give the same results for legacy & compact layouts
+    """
+    def save(self, redis):
+        for variant_id in (1, 2):
+            visitor = VisitorMetrics(variant_id, self.date, redis)
+            visitor.save_visitor(1, DATA)
+            visitor.save_visitor(0, DATA)
+            visitor.save_goal(DATA)
+            visitor.save_additional(**AD_PARAMS)
+            utm = UtmMetrics(variant_id, self.date, redis)
+            utm.save_visit_with_utm(1, 3, dict(UTM_PARAMS))
+            utm.save_utm_goal(3, dict(UTM_PARAMS), AD_PARAMS)
+            HourMetrics(variant_id, self.date, redis).save_visitor(1)
+            total = TotalMetrics(variant_id, redis)
+            total.save_unique()
+            total.save_unique()
+            total.save_goal()
+
+    def get_reports(self, redis):
+        reports = {}
+        for variant_id in (1, 2):
+            visitor = VisitorMetrics(variant_id, self.date, redis)
+            total = TotalMetrics(variant_id, redis)
+            reports[variant_id] = {
+                'unique': visitor.get_unique(),
+                'visits': visitor.get_visits(),
+                'goals': visitor.get_goals(),
+                'additional': visitor.get_additional_list(),
+                'geo': visitor.get_geo(),
+                'utm': UtmMetrics(variant_id, self.date, redis).get_utm(),
+                'hours': HourMetrics(
+                    variant_id, self.date, redis).get_hours_stats(),
+                'total_unique': total.get_unique(),
+                'total_goals': total.get_goals(),
+                'conversion': total.get_conversion(),
+            }
+        reports['bulk'] = TotalMetrics.get_bulk(redis, [1, 2, 3])
+        return reports
+
+    def test_getters(self):
+        legacy = MemoryStorage()
+        self.save(legacy)
+        expected = self.get_reports(legacy)
+        self.set_options(classes=CLASSES, compact=True)
+        self.save(self.redis)
+        self.assertTrue(self.redis.keys('*packed'))
+        self.assertTrue(len(self.redis.keys('*')) < len(legacy.keys('*')))
+        self.assertEqual(self.get_reports(self.redis), expected)
+
+    def test_convert_day(self):
+        self.save(self.redis)
+        legacy = self.get_reports(self.redis)
+        self.assertTrue(self.redis.keys('*utm_additional_keys*'))
+
+        self.set_options(classes=CLASSES, compact=True)
+        self.assertTrue(convert_day(self.redis, self.date))
+        self.assertTrue(convert_day(
+            self.redis, TotalMetrics.total_date, TotalMetrics))
+        self.assertTrue(drop_utm_additional_sets(self.redis, self.date))
+        self.assertEqual(self.redis.keys('*utm_additional_keys*'), [])
+        self.assertEqual(self.get_reports(self.redis), legacy)
+
+        # converted day is the same as day written in compact layout
+        expected = MemoryStorage()
+        self.save(expected)
+        self.assertEqual(dump(self.redis), dump(expected))
+        self.assertEqual(convert_day(self.redis, self.date), 0)
+
+
+class BenchmarkMemoryTestCase(MetricsTestCase):
+    def test_variants(self):
+        one = benchmark_memory(self.redis, variants=1)
+        two = benchmark_memory(self.redis, variants=2)
+        for name in ('legacy', 'compact'):
+            # every variant is saved into one variants hash
+            per_variant = one[name]['keys'] - 1
+            self.assertTrue(per_variant > 0)
+            self.assertEqual(two[name]['keys'], 1 + 2 * per_variant)
+        self.assertTrue(two['compact']['keys'] < two['legacy']['keys'])
+        self.assertEqual(self.redis.keys('*'), [])
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+
+from metrics import (
+    HourMetrics, TariffStats, TotalMetrics, UtmMetrics, VisitorMetrics)
+from metrics.export import DayExporter, Record, export_day
+
+from tests.base import MetricsTestCase
+
+DATA = ['10.0.0.1', 'Mozilla', 'http://example.com/?utm_medium=cpc']
+AD_PARAMS = {'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'}
+
+
+class SiteVisitor(VisitorMetrics):
+    namespace = 'site'
+    hash_tag = True
+    compact = True
+
+
+class SiteHour(HourMetrics):
+    namespace = 'site_hours'
+    hash_tag = True
+    compact = True
+    compact_maps = {HourMetrics.hour_key: 'h:'}
+
+
+class SiteUtm(UtmMetrics):
+    namespace = 'site'
+    hash_tag = True
+    compact = True
+    compact_maps = {
+        UtmMetrics.utm_channel_key: 's:',
+        UtmMetrics.utm_medium_key: 'm:',
+    }
+
+
+class SiteTariff(TariffStats):
+    namespace = 'site_stats'
+    hash_tag = True
+
+
+class ExportTestCase(MetricsTestCase):
+    def save(self, visitor_class=VisitorMetrics, hour_class=HourMetrics,
+             utm_class=UtmMetrics):
+        for variant_id in (1, 2):
+            visitor = visitor_class(variant_id, self.date, self.redis)
+            visitor.save_visitor(1, DATA)
+            visitor.save_visitor(0, DATA)
+            visitor.save_goal(DATA)
+            visitor.save_additional(**AD_PARAMS)
+            hour = hour_class(variant_id, self.date, self.redis)
+            hour.time_string = '09'
+            hour.save_visitor(1)
+            utm_class(variant_id, self.date, self.redis).save_visit_with_utm(
+                1, 3, {'utm_medium': 'cpc'})
+
+    def export(self, **options):
+        records = DayExporter(self.redis, self.date, **options).iter_records()
+        return set(records)
+
+    def assertVariant(self, records, variant_id):
+        def record(metric, key, value):
+            return Record(self.date, variant_id, metric, key, value)
+
+        expected = set([
+            record('visits', '', 2), record('unique', '', 1),
+            record('goals', '', 1), record('additional', '1:2:form', 1),
+            record('hour_visits', '09', 1), record('hour_unique', '09', 1),
+        ])
+        self.assertEqual(expected - records, set())
+        utm = set(item for item in records
+                  if item.variant_id == variant_id and
+                  item.metric.startswith('utm_'))
+        self.assertIn(record('utm_source', '3:0', 1), utm)
+        self.assertIn(record('utm_medium', 'cpc:3:1', 1), utm)
+
+    def test_records(self):
+        self.save()
+        records = self.export()
+        self.assertVariant(records, '1')
+        self.assertVariant(records, '2')
+        self.assertEqual(set(item.metric for item in records if item.metric
+                             .startswith('geo')), set())
+        records = self.export(sections=('geo',))
+        self.assertIn(Record(self.date, '1', 'geo_unique', DATA[0], 1),
+                      records)
+
+    def test_classes(self):
+        self.save(SiteVisitor, SiteHour, SiteUtm)
+        self.assertFalse(self.redis.keys('metrics:*'))
+        self.assertEqual(self.export(), set())
+        records = self.export(visitor_class=SiteVisitor,
+                              hour_class=SiteHour, utm_class=SiteUtm)
+        self.assertVariant(records, '1')
+        self.assertVariant(records, '2')
+
+    def test_profiles(self):
+        stats = SiteTariff(4, self.date, self.redis)
+        stats.save_unique()
+        stats.save_unique('x')
+        stats.save_unique('y')
+        TotalMetrics(5, self.redis).save_unique()
+        TotalMetrics(5, self.redis).save_goal()
+        records = self.export(sections=('profiles', 'totals'),
+                              tariff_class=SiteTariff)
+        self.assertEqual(records, set([
+            Record(self.date, '4', 'tariff', '', 1),
+            Record(self.date, '4', 'tariff_unique', '', 2),
+            Record(self.date, '4', 'tariff_unique_month', '', 2),
+            Record(TotalMetrics.total_date, '5', 'total_unique', '', 1),
+            Record(TotalMetrics.total_date, '5', 'total_goals', '', 1),
+        ]))
+
+    def test_chunks(self):
+        for variant_id in range(1, 8):
+            VisitorMetrics(variant_id, self.date, self.redis).save_visitor(
+                1, DATA)
+        exporter = DayExporter(self.redis, self.date, chunk_size=2,
+                               sections=('counters',))
+        variants = sum(exporter.iter_variants(), [])
+        self.assertEqual(sorted(variants), [str(i) for i in range(1, 8)])
+        self.assertEqual(len(list(exporter.iter_records())), 21)
+
+    def test_export_day(self):
+        self.save()
+        fileobj = io.StringIO()
+        count = export_day(self.redis, self.date, fileobj)
+        lines = fileobj.getvalue().splitlines()
+        self.assertEqual(count, len(lines))
+        self.assertIn({'date': self.date, 'variant_id': '1',
+                       'metric': 'visits', 'key': '', 'value': 2},
+                      [json.loads(line) for line in lines])
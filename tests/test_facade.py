@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from redis.exceptions import ConnectionError
+
+from metrics import MetricsAbstract, TariffStats, UtmMetrics, VisitorMetrics
+from metrics.facade import (
+    MetricsFacade, TariffFacade, UtmFacade, VisitorFacade)
+from metrics.storage import MemoryStorage
+
+from tests.base import MetricsTestCase, dump
+
+DATA = ['10.0.0.1', 'Mozilla', 'http://example.com/?utm_medium=cpc']
+UTM_PARAMS = {'utm_medium': 'cpc', 'utm_term': 'a, b'}
+AD_PARAMS = {'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'}
+
+
+class FacadeTestCase(MetricsTestCase):
+    """
+    Writes of facades and of metrics objects give the same data
+    """
+    def setUp(self):
+        super(FacadeTestCase, self).setUp()
+        self.expected = MemoryStorage()
+        self.set_options(retention_days=30, top_index=True)
+        self._details_limit = VisitorMetrics.details_limit
+        MetricsFacade.variants_cache.clear()
+
+    def tearDown(self):
+        VisitorMetrics.details_limit = self._details_limit
+        MetricsFacade.variants_cache.clear()
+        self.expected.close()
+        super(FacadeTestCase, self).tearDown()
+
+    def assertParity(self):
+        self.assertEqual(dump(self.redis), dump(self.expected))
+
+    def save_objects(self, redis):
+        MetricsAbstract.retention_cache.clear()
+        visitor = VisitorMetrics(1, self.date, redis)
+        visitor.save_visitor(1, DATA, fingerprint='x')
+        visitor.save_visitor(0, DATA, fingerprint='y')
+        visitor.save_goal(DATA)
+        visitor.save_additional(**AD_PARAMS)
+        UtmMetrics(1, self.date, redis).save_visit_with_utm(
+            1, 3, dict(UTM_PARAMS))
+        UtmMetrics(1, self.date, redis).save_utm_goal(
+            3, dict(UTM_PARAMS), AD_PARAMS)
+
+    def save_facades(self, redis):
+        MetricsAbstract.retention_cache.clear()
+        visitor = VisitorFacade(1, self.date, redis)
+        visitor.save_visitor(1, DATA, fingerprint='x')
+        visitor.save_visitor(0, DATA, fingerprint='y')
+        visitor.save_goal(DATA)
+        visitor.save_additional(**AD_PARAMS)
+        utm = UtmFacade(1, self.date, redis)
+        utm.save_visit_with_utm(1, 3, dict(UTM_PARAMS))
+        utm.save_utm_goal(3, dict(UTM_PARAMS), AD_PARAMS)
+
+    def test_visitor(self):
+        self.save_objects(self.expected)
+        self.save_facades(self.redis)
+        self.assertParity()
+
+    def test_details_limit(self):
+        VisitorMetrics.details_limit = 1
+        self.assertEqual(VisitorFacade(1, self.date, None).details_limit, 1)
+        self.assertIsNone(VisitorFacade(
+            1, self.date, None, details_limit=None).details_limit)
+        self.save_objects(self.expected)
+        self.save_facades(self.redis)
+        self.assertParity()
+        key = VisitorMetrics._build_redis_key(
+            self.date, 1, VisitorMetrics.details_key)
+        self.assertEqual(self.redis.llen(key), 1)
+
+    def test_tariff(self):
+        stats = TariffStats(4, self.date, self.expected)
+        stats.save_unique('x')
+        stats.save_unique('y')
+        stats.save_unique()
+        MetricsAbstract.retention_cache.clear()
+        facade = TariffFacade(4, self.date, self.redis)
+        facade.save_unique('x')
+        facade.save_unique('y')
+        facade.save_unique()
+        self.assertParity()
+        reader = facade.reader()
+        self.assertEqual(reader.get_unique_estimate(), 2)
+        self.assertEqual(reader.get_unique_estimate(month=True), 2)
+
+    def test_month(self):
+        month = self.date[:7]
+        TariffStats(4, month, self.expected).save_unique('x')
+        MetricsAbstract.retention_cache.clear()
+        TariffFacade(4, month, self.redis).save_unique('x')
+        self.assertParity()
+        self.assertEqual(len(self.redis.keys('*hll*')), 1)
+
+    def test_variant_is_cached_after_reply(self):
+        facade = VisitorFacade(1, self.date, self.redis)
+        variants_key = VisitorMetrics._build_variants_key(self.date)
+        pipeline = self.redis.pipeline
+
+        def failing(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+
+            def execute(*args, **kwargs):
+                raise ConnectionError()
+            pipe.execute = execute
+            return pipe
+        self.redis.pipeline = failing
+        self.assertRaises(ConnectionError, facade.save_goal, DATA)
+        del self.redis.pipeline
+        self.assertFalse(self.redis.exists(variants_key))
+
+        facade.save_goal(DATA)
+        self.assertEqual(self.redis.hkeys(variants_key), ['1'])
+
+    def test_variant_into_caller_pipeline(self):
+        utm = UtmFacade(1, self.date, self.redis)
+        pipe = self.redis.pipeline(transaction=False)
+        hset, calls = pipe.hset, []
+
+        def recorded(*args):
+            calls.append(args)
+            return hset(*args)
+        pipe.hset = recorded
+        utm.save_visit_with_utm(1, 3, dict(UTM_PARAMS), pipeline=pipe)
+        utm.save_visit_with_utm(1, 3, dict(UTM_PARAMS), pipeline=pipe)
+        pipe.execute()
+        variants_key = UtmMetrics._build_variants_key(self.date)
+        self.assertEqual(calls, [(variants_key, 1, '')])
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+from metrics import VisitorMetrics
+from metrics.facade import MetricsFacade, VisitorFacade
+from metrics.geo import UNKNOWN, GeoResolver
+
+from tests.base import MetricsTestCase, dump
+
+CSV = u"""network,country,region
+10.0.0.0/24,DE,BE
+10.0.1.0/24,DE,
+10.1.0.0/16,US,CA
+broken,XX,
+2001:db8::/32,FR,IDF
+"""
+
+
+class GeoResolverTestCase(MetricsTestCase):
+    def setUp(self):
+        super(GeoResolverTestCase, self).setUp()
+        self.resolver = GeoResolver.from_csv(io.StringIO(CSV))
+
+    def test_resolve(self):
+        self.assertEqual(len(self.resolver), 4)
+        self.assertEqual(self.resolver.resolve('10.0.0.255'), ('DE', 'BE'))
+        self.assertEqual(self.resolver.resolve('10.0.1.1'), ('DE', ''))
+        self.assertEqual(self.resolver.resolve('10.1.200.3'), ('US', 'CA'))
+        self.assertEqual(self.resolver.resolve('2001:db8::1'),
+                         ('FR', 'IDF'))
+        for ip in ('10.0.2.1', '9.255.255.255', '2001:db9::1', 'nope', None):
+            self.assertEqual(self.resolver.resolve(ip), UNKNOWN)
+
+
+class GeoAggregationTestCase(GeoResolverTestCase):
+    def setUp(self):
+        super(GeoAggregationTestCase, self).setUp()
+        self._keep_ips = VisitorMetrics.geo_keep_ips
+        self.set_options([VisitorMetrics], geo_resolver=self.resolver)
+        MetricsFacade.variants_cache.clear()
+
+    def tearDown(self):
+        VisitorMetrics.geo_keep_ips = self._keep_ips
+        MetricsFacade.variants_cache.clear()
+        super(GeoAggregationTestCase, self).tearDown()
+
+    def save(self, visitor):
+        for ip in ('10.0.0.1', '10.0.0.2', '10.0.1.1', '10.1.0.1', '8.8.8.8'):
+            visitor.save_visitor(1, [ip, 1, 'direct'])
+        visitor.save_goal(['10.0.0.1', 1, 'direct'])
+        visitor.save_goal(['10.1.0.1', 1, 'direct'])
+        visitor.decrease_goal(['10.1.0.1', 1, 'direct'])
+
+    def test_countries(self):
+        self.save(VisitorMetrics(1, self.date, self.redis))
+        visitor = VisitorMetrics(1, self.date, self.redis)
+        self.assertEqual(visitor.get_geo_countries(), {
+            'DE': {'unique': 3, 'goals': 1},
+            'US': {'unique': 1, 'goals': 0},
+            'ZZ': {'unique': 1, 'goals': 0},
+        })
+        self.assertEqual(visitor.get_geo_regions(), {
+            'DE': {'BE': {'unique': 2, 'goals': 1}},
+            'US': {'CA': {'unique': 1, 'goals': 0}},
+        })
+        self.assertEqual(len(visitor.get_geo()), 5)
+
+    def test_without_ips(self):
+        VisitorMetrics.geo_keep_ips = False
+        self.save(VisitorMetrics(1, self.date, self.redis))
+        visitor = VisitorMetrics(1, self.date, self.redis)
+        self.assertEqual(visitor.get_geo(), [])
+        self.assertEqual(visitor.get_geo_countries()['DE']['unique'], 3)
+
+    def test_facade(self):
+        self.save(VisitorMetrics(1, self.date, self.redis))
+        expected = dump(self.redis)
+        self.redis.flushdb()
+        self.save(VisitorFacade(1, self.date, self.redis))
+        self.assertEqual(dump(self.redis), expected)
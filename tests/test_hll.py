@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from metrics import TariffStats, VisitorMetrics
+from metrics.hll import count_union, merge_union
+from metrics.sharding import ShardedRedis
+from metrics.storage import MemoryStorage
+
+from tests.base import MetricsTestCase
+
+DATA = ['10.0.0.1', 'Mozilla', 'direct']
+
+
+class UniqueTestCase(MetricsTestCase):
+    def save(self, redis, variant_id, fingerprints):
+        visitor = VisitorMetrics(variant_id, self.date, redis)
+        for fingerprint in fingerprints:
+            visitor.save_visitor(0, DATA, fingerprint=fingerprint)
+        return visitor
+
+    def test_estimate(self):
+        visitor = self.save(self.redis, 1, ['a', 'b', 'a', 'c'])
+        self.assertEqual(visitor.get_unique_estimate(), 3)
+        self.assertEqual(visitor.get_unique_estimate(month=True), 3)
+        self.assertEqual(visitor.get_visits(), '4')
+
+    def test_tariff(self):
+        stats = TariffStats(4, self.date, self.redis)
+        for fingerprint in ('a', 'b', 'a'):
+            stats.save_unique(fingerprint)
+        self.assertEqual(stats.get_unique_estimate(), 2)
+        self.assertEqual(stats.get_unique(), 0)
+
+    def get_keys(self, variant_ids):
+        return [VisitorMetrics._build_redis_key(
+            self.date, variant_id, VisitorMetrics.hll_key)
+            for variant_id in variant_ids]
+
+    def assertUnion(self, redis, variant_ids=(1, 2)):
+        self.save(redis, variant_ids[0], ['a', 'b'])
+        self.save(redis, variant_ids[1], ['b', 'c', 'd'])
+        keys = self.get_keys(list(variant_ids) + [100])
+        self.assertEqual(count_union(redis, keys), 4)
+        self.assertEqual(count_union(redis, []), 0)
+        self.assertEqual(merge_union(redis, 'union', keys, ttl=60), 4)
+        self.assertEqual(redis.pfcount('union'), 4)
+        self.assertTrue(0 < redis.ttl('union') <= 60)
+
+    def test_union(self):
+        self.assertUnion(self.redis)
+
+    def test_sharded_union(self):
+        self.set_options(hash_tag=True)
+        shards = [MemoryStorage(), MemoryStorage()]
+        redis = ShardedRedis(shards)
+        # variants of different shards
+        variants = {}
+        for variant_id in range(1, 100):
+            variants.setdefault(redis.get_shard_index(
+                self.get_keys([variant_id])[0]), variant_id)
+        self.assertUnion(redis, sorted(variants.values())[:2])
+        # temporary keys are deleted
+        self.assertEqual(sum(len(shard.keys('hll_union*'))
+                             for shard in shards), 0)
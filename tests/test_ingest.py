@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+from calendar import timegm
+from datetime import datetime
+
+from redis.exceptions import ConnectionError
+
+from metrics import HourMetrics, UtmMetrics, VisitorMetrics
+from metrics.ingest import (
+    AggregatingPipeline, Ingestion, _get_moment, aggregate_lines,
+    ingest_files, replay_event)
+from metrics.sharding import ShardedRedis
+from metrics.storage import MemoryStorage
+
+from tests.base import MetricsTestCase, dump
+
+
+def get_events(date_string, variants=5):
+    start = timegm(datetime.strptime(date_string, '%Y-%m-%d').timetuple())
+    events = []
+    for i in range(100):
+        event = {
+            'variant_id': i % variants + 1, 'time': start + i * 600,
+            'ip': '10.0.0.%s' % (i % 7), 'is_unique': i % 2,
+            'page_id': 3, 'profile_id': 4, 'channel_id': 1,
+            'utm': {'utm_medium': 'cpc', 'utm_term': 'a, b'},
+            'fingerprint': 'f%s' % (i % 11),
+        }
+        if i % 5 == 0:
+            event.update(event='goal', additional={
+                'ad_id': 1, 'ad_type': 1, 'ad_label': 'form'})
+        elif i % 7 == 0:
+            event = {'event': 'lead', 'variant_id': 1, 'time': start + i}
+        events.append(event)
+    return events
+
+
+class CountingStorage(MemoryStorage):
+    """
+    Sizes of executed pipelines are collected
+    """
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.sizes = []
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(CountingStorage, self).pipeline(transaction, shard_hint)
+        execute, sizes = pipe.execute, self.sizes
+
+        def counted(*args, **kwargs):
+            sizes.append(len(pipe))
+            return execute(*args, **kwargs)
+        pipe.execute = counted
+        return pipe
+
+
+class FailingStorage(MemoryStorage):
+    """
+    Reply of `fail_at` transaction is lost after its commands are applied
+    """
+    def __init__(self, fail_at, *args, **kwargs):
+        super(FailingStorage, self).__init__(*args, **kwargs)
+        self.fail_at = fail_at
+        self.transactions = 0
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(FailingStorage, self).pipeline(transaction, shard_hint)
+        if not transaction:
+            return pipe
+        execute = pipe.execute
+
+        def failing(*args, **kwargs):
+            reply = execute(*args, **kwargs)
+            self.transactions += 1
+            if self.transactions == self.fail_at:
+                raise ConnectionError('reply is lost')
+            return reply
+        pipe.execute = failing
+        return pipe
+
+
+def get_data(redis):
+    data = dump(redis)
+    data.pop(Ingestion.checkpoint_key)
+    return data
+
+
+class IngestTestCase(MetricsTestCase):
+    def setUp(self):
+        super(IngestTestCase, self).setUp()
+        self.set_options(retention_days=30)
+        self.events = get_events(self.date)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'hits.jsonl')
+        self.write(self.events)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(IngestTestCase, self).tearDown()
+
+    def write(self, events, mode='w'):
+        with open(self.path, mode) as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+
+    def test_moment(self):
+        self.assertEqual(_get_moment({'time': 1401606000}),
+                         ('2014-06-01', '07'))
+        self.assertEqual(_get_moment({'date': '2014-06-01', 'hour': 7}),
+                         ('2014-06-01', '07'))
+        self.assertEqual(
+            _get_moment({'date': '2014-06-01', 'time': 1401606000}),
+            ('2014-06-01', '07'))
+        self.assertRaises(ValueError, _get_moment, {'date': '2014-06-01'})
+
+    def test_hour_of_event_without_hour(self):
+        self.set_options(retention_days=None)
+        pipe = AggregatingPipeline()
+        replay_event({'event': 'lead', 'variant_id': 1,
+                      'date': '2014-06-01', 'time': 1401606000}, pipe)
+        pipe.apply(self.redis)
+        stats = HourMetrics(1, '2014-06-01', self.redis).get_hours_stats()
+        self.assertEqual(stats, {'07': {'leads': '1'}})
+
+        pipe, events, errors = aggregate_lines([json.dumps(
+            {'event': 'lead', 'variant_id': 1, 'date': '2014-06-01'})])
+        self.assertEqual((events, errors), (0, 1))
+
+    def test_same_as_hit_by_hit(self):
+        expected = MemoryStorage()
+        for event in self.events:
+            pipe = expected.pipeline(transaction=False)
+            replay_event(event, pipe, expected)
+            pipe.execute()
+
+        report = ingest_files(self.redis, [self.path], chunk_size=30)
+        self.assertEqual(report['events'], len(self.events))
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(get_data(self.redis), dump(expected))
+
+        visitor = VisitorMetrics(2, self.date, self.redis)
+        self.assertTrue(int(visitor.get_visits()))
+        self.assertTrue(UtmMetrics(2, self.date, self.redis).get_utm())
+
+    def test_broken_event(self):
+        line = json.dumps({'event': 'goal', 'variant_id': 1,
+                           'time': 1401606000,
+                           'additional': {'ad_id': 1, 'ad_type': 1}})
+        pipe, events, errors = aggregate_lines([line])
+        self.assertEqual((events, errors), (0, 1))
+        self.assertEqual(len(pipe), 0)
+
+    def test_interrupted_chunk(self):
+        expected = MemoryStorage()
+        ingest_files(expected, [self.path], chunk_size=60, batch_size=20)
+
+        redis = FailingStorage(fail_at=5)
+        self.assertRaises(ConnectionError, ingest_files, redis, [self.path],
+                          chunk_size=60, batch_size=20)
+        report = ingest_files(redis, [self.path], chunk_size=60,
+                              batch_size=20)
+        self.assertTrue(report['events'])
+        self.assertEqual(dump(redis), dump(expected))
+
+    def test_batches_are_bounded(self):
+        redis = CountingStorage()
+        report = Ingestion(redis, chunk_size=1000, batch_size=50).ingest(
+            [self.path])
+        self.assertTrue(report['commands'] > 50)
+        self.assertTrue(len(redis.sizes) > 1)
+        self.assertTrue(max(redis.sizes) <= 50)
+
+    def test_checkpoint(self):
+        ingest_files(self.redis, [self.path], chunk_size=30)
+        data = dump(self.redis)
+        report = ingest_files(self.redis, [self.path], chunk_size=30)
+        self.assertEqual(report['events'], 0)
+        self.assertEqual(dump(self.redis), data)
+
+        self.write(self.events[:10], 'a')
+        report = ingest_files(self.redis, [self.path], chunk_size=30)
+        self.assertEqual(report['events'], 10)
+
+    def test_files_with_same_head(self):
+        other = os.path.join(self.directory, 'other.jsonl')
+        shutil.copy(self.path, other)
+        report = ingest_files(self.redis, [self.path, other])
+        self.assertEqual(report['events'], 2 * len(self.events))
+
+    def test_rotated_file(self):
+        ingest_files(self.redis, [self.path])
+        self.write(self.events[10:30])
+        report = ingest_files(self.redis, [self.path])
+        self.assertEqual(report['events'], 20)
+        self.assertEqual(report['files'][0]['skipped_bytes'], 0)
+
+    def test_sharded(self):
+        self.set_options(hash_tag=True)
+        shards = [MemoryStorage(), MemoryStorage()]
+        report = ingest_files(ShardedRedis(shards), [self.path],
+                              chunk_size=30, batch_size=20)
+        self.assertEqual(report['events'], len(self.events))
+        self.assertTrue(shards[0].keys() and shards[1].keys())
+
+    def test_processes(self):
+        report = ingest_files(self.redis, [self.path], processes=2)
+        self.assertEqual(report['events'], len(self.events))
+        expected = MemoryStorage()
+        ingest_files(expected, [self.path])
+        self.assertEqual(dump(self.redis), dump(expected))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from metrics import MetricsBatch, VisitorMetrics
+from metrics.observer import (
+    CountingRedis, StatsObserver, install, uninstall)
+from metrics.sharding import ShardedRedis, get_nodes, is_distributed
+from metrics.storage import MemoryStorage
+
+from tests.base import MetricsTestCase
+
+AD_PARAMS = {'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'}
+
+
+class BlockingStorage(MemoryStorage):
+    """
+    HINCRBY waits for all threads, so calls are running in parallel
+    """
+    def __init__(self, parties):
+        super(BlockingStorage, self).__init__()
+        self.barrier = threading.Barrier(parties, timeout=5)
+
+    def hincrby(self, name, key, amount=1):
+        self.barrier.wait()
+        return super(BlockingStorage, self).hincrby(name, key, amount)
+
+
+class ObserverTestCase(MetricsTestCase):
+    def setUp(self):
+        super(ObserverTestCase, self).setUp()
+        self.stats = StatsObserver()
+        install(self.stats, [VisitorMetrics])
+
+    def tearDown(self):
+        uninstall([VisitorMetrics])
+        super(ObserverTestCase, self).tearDown()
+
+    def get_stats(self, method):
+        return self.stats.get_stats()[('VisitorMetrics', method)]
+
+    def test_counts(self):
+        visitor = VisitorMetrics(1, self.date, self.redis)
+        visitor.save_goal(['1.2.3.4'])
+        visitor.get_goals()
+        stats = self.get_stats('save_goal')
+        self.assertEqual(stats['calls'], 1)
+        self.assertTrue(stats['commands'] > 1)
+        self.assertEqual(self.get_stats('get_goals')['commands'], 1)
+        self.assertIs(visitor.redis, self.redis)
+
+    def test_threads(self):
+        redis = BlockingStorage(2)
+        visitor = VisitorMetrics(1, self.date, redis, save_variant=False)
+        threads = [threading.Thread(target=visitor.save_additional,
+                                    kwargs=AD_PARAMS)
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.get_stats('save_additional')
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['commands'], 2)
+        self.assertIs(visitor.redis, redis)
+        self.assertEqual(visitor.get_additional_list()[0]['count'], '2')
+
+    def test_tracked_pipeline(self):
+        self.set_options(retention_days=30)
+        with MetricsBatch(self.redis) as batch:
+            visitor = batch.bind(VisitorMetrics, 1, self.date)
+            visitor.save_goal(['1.2.3.4'])
+            queued = len(batch.pipeline)
+            visitor.save_goal(['1.2.3.4'])
+            # EXPIREATs are queued once into tracked pipeline
+            self.assertEqual(len(batch.pipeline) - queued, 2)
+        self.assertTrue(all(self.redis.ttl(key) > 0
+                            for key in self.redis.keys('*')))
+
+    def test_distributed(self):
+        redis = ShardedRedis([MemoryStorage(), MemoryStorage()])
+        counter = CountingRedis(redis)
+        self.assertTrue(is_distributed(counter))
+        self.assertEqual(get_nodes(counter), redis.shards)
+        counter = CountingRedis(self.redis)
+        self.assertFalse(is_distributed(counter))
+        self.assertEqual(get_nodes(counter), [counter])
+
+        for variant_id in range(1, 20):
+            VisitorMetrics(variant_id, self.date, redis).save_goal(
+                ['1.2.3.4'])
+        VisitorMetrics(1, self.date, redis).flush_db()
+        self.assertEqual(sum(len(shard.keys('*'))
+                             for shard in redis.shards), 0)
+        self.assertEqual(self.get_stats('flush_db')['calls'], 1)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from metrics import HourMetrics, UtmMetrics, VisitorMetrics
+from metrics.ranges import MetricsRange
+
+from tests.base import MetricsTestCase
+from tests.test_export import DATA, SiteHour, SiteUtm, SiteVisitor
+
+
+class RangeTestCase(MetricsTestCase):
+    def setUp(self):
+        super(RangeTestCase, self).setUp()
+        today = datetime.strptime(self.date, '%Y-%m-%d')
+        self.dates = [(today - timedelta(days=1)).strftime('%Y-%m-%d'),
+                      self.date]
+
+    def save(self, visitor_class=VisitorMetrics, hour_class=HourMetrics,
+             utm_class=UtmMetrics):
+        for date_string in self.dates:
+            for variant_id in (1, 2):
+                visitor = visitor_class(variant_id, date_string, self.redis)
+                visitor.save_visitor(1, DATA, fingerprint='x')
+                visitor.save_visitor(0, DATA, fingerprint=date_string)
+                visitor.save_goal(DATA)
+                hour = hour_class(variant_id, date_string, self.redis)
+                hour.time_string = '09'
+                hour.save_visitor(1)
+                hour.save_goal()
+                utm_class(variant_id, date_string, self.redis).save_utm_goal(
+                    3, {'utm_medium': 'cpc'}, None)
+
+    def get_range(self, **options):
+        return MetricsRange(self.redis, [1, 2], self.dates[0],
+                            self.dates[1], **options)
+
+    def assertRange(self, report):
+        counters = report.get_counters()
+        self.assertEqual(counters['total'],
+                         {'visits': 8, 'unique': 4, 'goals': 4})
+        self.assertEqual(counters['days'][self.date],
+                         {'visits': 4, 'unique': 2, 'goals': 2})
+        self.assertEqual(counters['variants'][1]['total'],
+                         {'visits': 4, 'unique': 2, 'goals': 2})
+
+        hours = report.get_hours_stats()
+        self.assertEqual(hours['total'],
+                         {'09': {'visits': 4, 'unique': 4, 'goals': 4}})
+        self.assertEqual(hours['days'][self.date],
+                         {'09': {'visits': 2, 'unique': 2, 'goals': 2}})
+
+        utm = report.get_utm()
+        self.assertEqual(utm['total']['3']['goals'], 4)
+        self.assertEqual(
+            utm['days'][self.date]['3']['utm_medium']['cpc']['goals'], 2)
+
+        unique = report.get_unique_estimate()
+        self.assertEqual(unique['total'], 3)
+        self.assertEqual(unique['days'][self.date], 2)
+        self.assertEqual(unique['variants'][2], 3)
+
+    def test_range(self):
+        self.save()
+        self.assertRange(self.get_range())
+
+    def test_classes(self):
+        self.save(SiteVisitor, SiteHour, SiteUtm)
+        self.assertEqual(self.get_range().get_counters()['total'],
+                         {'visits': 0, 'unique': 0, 'goals': 0})
+        self.assertRange(self.get_range(
+            visitor_class=SiteVisitor, hour_class=SiteHour,
+            utm_class=SiteUtm))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from metrics import MetricsAbstract, MetricsBatch, UtmMetrics, VisitorMetrics
+from metrics.cache import MISSING
+from metrics.facade import UtmFacade
+
+from tests.base import MetricsTestCase
+
+
+UTM_PARAMS = {'utm_medium': 'cpc', 'utm_campaign': 'sale', 'utm_term': 'a'}
+
+
+class RetentionTestCase(MetricsTestCase):
+    def setUp(self):
+        super(RetentionTestCase, self).setUp()
+        self.set_options(retention_days=30)
+
+    def assertExpired(self, *keys):
+        for key in keys:
+            self.assertGreater(self.redis.ttl(key), 0, key)
+
+    def test_keys_are_expired(self):
+        metrics = VisitorMetrics(1, self.date, self.redis)
+        metrics.save_visitor(1, ['1.2.3.4', 1, None], fingerprint='x')
+        self.assertExpired(*self.redis.keys('*'))
+
+    def test_script_expires_written_keys_only(self):
+        UtmMetrics(1, self.date, self.redis, use_script=True).save_utm(
+            1, {'utm_medium': 'cpc'}, None)
+        self.assertEqual(self.redis.keys('*:utm_campaign'), [])
+        UtmMetrics(1, self.date, self.redis, use_script=True).save_utm(
+            1, UTM_PARAMS, {'ad_id': 1, 'ad_type': 1, 'ad_label': 'f'}, 2)
+        keys = self.redis.keys('metrics:*')
+        self.assertTrue([key for key in keys if 'utm_term' in key])
+        self.assertExpired(*keys)
+
+    def test_not_existing_key_is_not_cached(self):
+        metrics = UtmMetrics(1, self.date, self.redis)
+        key = metrics._get_redis_key(metrics.utm_term_key)
+        metrics._expire(key)
+        self.assertIs(metrics.retention_cache.get(key), MISSING)
+        metrics.save_utm(1, UTM_PARAMS, None)
+        self.assertExpired(key)
+
+    def test_reset_batch_is_not_cached(self):
+        batch = MetricsBatch(self.redis)
+        batch.bind(VisitorMetrics, 1, self.date).save_goal(['1.2.3.4'])
+        batch.reset()
+        VisitorMetrics(1, self.date, self.redis).save_goal(['1.2.3.4'])
+        self.assertExpired(*self.redis.keys('*'))
+
+        with MetricsBatch(self.redis) as batch:
+            batch.bind(VisitorMetrics, 2, self.date).save_goal(['1.2.3.4'])
+        self.assertExpired(*self.redis.keys('*'))
+        self.assertFalse(MetricsAbstract.pending_expires.get(batch.pipeline))
+
+    def test_raw_pipeline_is_not_cached(self):
+        pipe = self.redis.pipeline(transaction=False)
+        VisitorMetrics(1, self.date, self.redis, pipeline=pipe).save_goal(
+            ['1.2.3.4'])
+        pipe.reset()
+        UtmFacade(1, self.date, self.redis).save_utm(1, UTM_PARAMS, None)
+        VisitorMetrics(1, self.date, self.redis).save_goal(['1.2.3.4'])
+        self.assertExpired(*self.redis.keys('*'))
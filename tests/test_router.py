@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from metrics import MetricsBatch, UtmMetrics, VisitorMetrics
+from metrics import redis_wrapper
+from metrics.redis_wrapper import (
+    RedisMetricsRouter, get_connection_pool, reset_connection_pools)
+from metrics.storage import MemoryStorage
+
+from tests.base import MetricsTestCase
+
+
+class RouterTestCase(MetricsTestCase):
+    def setUp(self):
+        super(RouterTestCase, self).setUp()
+        self.replica = MemoryStorage()
+        self.router = RedisMetricsRouter(self.redis, self.replica)
+
+    def tearDown(self):
+        self.replica.close()
+        super(RouterTestCase, self).tearDown()
+
+    def test_routing(self):
+        visitor = VisitorMetrics(1, self.date, self.router)
+        visitor.save_goal(['1.2.3.4'])
+        self.assertTrue(self.redis.keys('*'))
+        self.assertEqual(self.replica.keys('*'), [])
+        # replica is not synced, so reads are sent to it
+        self.assertEqual(visitor.get_goals(), 0)
+        self.replica.set(self.redis.keys('*count:2')[0], 7)
+        self.assertEqual(visitor.get_goals(), '7')
+
+    def test_pin(self):
+        router = RedisMetricsRouter(self.redis, self.replica, pin_seconds=60)
+        visitor = VisitorMetrics(1, self.date, router)
+        self.assertEqual(visitor.get_goals(), 0)
+        visitor.save_goal(['1.2.3.4'])
+        self.assertEqual(visitor.get_goals(), '1')
+
+    def test_pipeline(self):
+        pipe = self.router.pipeline(transaction=False)
+        pipe.get('a').hgetall('b')
+        self.replica.set('a', 1)
+        self.assertEqual(pipe.execute(), ['1', {}])
+
+        pipe.get('a').incr('a')
+        self.assertEqual(pipe.execute(), [None, 1])
+        self.assertEqual(self.redis.get('a'), '1')
+
+    def test_script(self):
+        with MetricsBatch(self.router) as batch:
+            batch.bind(UtmMetrics, 1, self.date, use_script=True).save_utm(
+                3, {'utm_medium': 'cpc'}, None)
+        UtmMetrics(1, self.date, self.router, use_script=True).save_utm(
+            3, {'utm_medium': 'cpc'}, None)
+        utm = UtmMetrics(1, self.date, self.redis).get_utm()
+        self.assertEqual(utm['3']['utm_medium']['cpc']['visits'], '2')
+
+
+class PoolsTestCase(unittest.TestCase):
+    def tearDown(self):
+        reset_connection_pools()
+
+    def test_shared(self):
+        pool = get_connection_pool('localhost', 6379, 5)
+        self.assertIs(get_connection_pool('localhost', 6379, 5), pool)
+        self.assertIsNot(get_connection_pool('localhost', 6379, 6), pool)
+
+    def test_fork(self):
+        pool = get_connection_pool('localhost', 6379, 5)
+        # pools of parent process are not used after fork
+        redis_wrapper._pools_pid = -1
+        self.assertIsNot(get_connection_pool('localhost', 6379, 5), pool)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import lupa
+except ImportError:
+    lupa = None
+
+from metrics import MetricsAbstract, MetricsBatch, UtmMetrics, VisitorMetrics
+from metrics.compact import get_memory_usage
+from metrics.sharding import ShardedRedis, get_hash_tag, migrate_keys
+from metrics.storage import MemoryStorage
+
+from tests.base import MetricsTestCase, dump
+
+
+UTM_PARAMS = {'utm_medium': 'cpc', 'utm_campaign': 'sale', 'utm_term': 'a'}
+AD_PARAMS = {'ad_id': 1, 'ad_type': 1, 'ad_label': 'f'}
+
+
+class ShardedRedisTestCase(MetricsTestCase):
+    def setUp(self):
+        super(ShardedRedisTestCase, self).setUp()
+        self.shards = [MemoryStorage(), MemoryStorage()]
+        self.sharded = ShardedRedis(self.shards)
+        self.set_options(hash_tag=True)
+
+    def save(self, variants=10):
+        for variant_id in range(1, variants + 1):
+            VisitorMetrics(variant_id, self.date, self.sharded).save_visitor(
+                1, ['1.2.3.4', 1, None])
+            UtmMetrics(variant_id, self.date, self.sharded).save_utm(
+                1, UTM_PARAMS, AD_PARAMS, 2)
+
+    def get_keys(self):
+        return sorted(key for shard in self.shards for key in shard.keys())
+
+    def test_hash_tag(self):
+        self.assertEqual(get_hash_tag('metrics:{2014-06-01:1}:goals'),
+                         '2014-06-01:1')
+        self.assertEqual(get_hash_tag('metrics:2014-06-01:1:goals'),
+                         'metrics:2014-06-01:1:goals')
+
+    def test_keys_are_spread(self):
+        self.save()
+        self.assertTrue(self.shards[0].keys())
+        self.assertTrue(self.shards[1].keys())
+
+    def test_keyless_commands_are_refused(self):
+        self.assertRaises(AttributeError, getattr, self.sharded, 'scan')
+        self.assertRaises(TypeError, self.sharded.get, 0)
+        self.assertRaises(AttributeError, self.sharded.execute_command,
+                          'SCAN', 0)
+
+    def test_utm_clean_up(self):
+        self.save()
+        self.assertTrue([key for key in self.get_keys()
+                         if 'utm_additional_keys' in key])
+        for variant_id in range(1, 11):
+            UtmMetrics(variant_id, self.date, self.sharded).clean_up()
+        self.assertFalse([key for key in self.get_keys()
+                          if ':utm' in key])
+
+    def test_flush_db(self):
+        self.save()
+        deleted, cursor = VisitorMetrics(
+            1, self.date, self.sharded).flush_db()
+        self.assertTrue(deleted)
+        self.assertEqual(cursor, 0)
+        self.assertEqual(self.get_keys(), [])
+
+    def test_memory_usage(self):
+        self.save()
+        usage = get_memory_usage(self.sharded, 'metrics:*')
+        self.assertEqual(usage['keys'], len(self.get_keys()))
+        self.assertTrue(usage['bytes'])
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is required for SCAN cursor')
+class FlushTestCase(MetricsTestCase):
+    def setUp(self):
+        super(FlushTestCase, self).setUp()
+        self.redis = fakeredis.FakeStrictRedis(decode_responses=True)
+        for variant_id in range(1, 21):
+            VisitorMetrics(variant_id, self.date, self.redis).save_goal(
+                ['1.2.3.4'])
+        self.set_options(hash_tag=True)
+        for variant_id in range(1, 21):
+            VisitorMetrics(variant_id, self.date, self.redis).save_goal(
+                ['1.2.3.4'])
+        self.total = len(self.redis.keys())
+
+    def tearDown(self):
+        super(FlushTestCase, self).tearDown()
+        self.redis.close()
+
+    def test_limit_is_applied_to_call(self):
+        metrics = VisitorMetrics(1, self.date, self.redis)
+        deleted, cursor = metrics.flush_db(limit=5, count=5)
+        self.assertTrue(5 <= deleted < self.total)
+        self.assertEqual(cursor[0], 0)
+
+    def test_cursor_of_pattern_is_resumed(self):
+        metrics = VisitorMetrics(1, self.date, self.redis)
+        deleted, cursor, calls = 0, 0, 0
+        while True:
+            count, cursor = metrics.flush_db(cursor, limit=5, count=5)
+            deleted += count
+            calls += 1
+            if not cursor:
+                break
+            self.assertLess(calls, self.total)
+        self.assertTrue(calls > 2)
+        self.assertEqual(deleted, self.total)
+        self.assertEqual(self.redis.keys('*'), [])
+
+
+@unittest.skipIf(fakeredis is None or lupa is None,
+                 'fakeredis & lupa are required for Lua scripts')
+class ShardedScriptTestCase(MetricsTestCase):
+    def setUp(self):
+        super(ShardedScriptTestCase, self).setUp()
+        self.shards = [fakeredis.FakeStrictRedis(decode_responses=True),
+                       fakeredis.FakeStrictRedis(decode_responses=True)]
+        self.sharded = ShardedRedis(self.shards)
+        self.set_options(hash_tag=True)
+
+    def save(self, redis, use_script, pipeline=False):
+        MetricsAbstract.retention_cache.clear()
+        batch = MetricsBatch(redis)
+        for variant_id in range(1, 11):
+            if pipeline:
+                utm = batch.bind(UtmMetrics, variant_id, self.date,
+                                 use_script=use_script)
+            else:
+                utm = UtmMetrics(variant_id, self.date, redis,
+                                 use_script=use_script)
+            utm.save_utm(1, dict(UTM_PARAMS), AD_PARAMS, 2)
+        batch.execute()
+
+    def get_data(self):
+        data = {}
+        for shard in self.shards:
+            data.update(dump(shard))
+        return data
+
+    def test_script(self):
+        expected = fakeredis.FakeStrictRedis(decode_responses=True)
+        self.save(expected, False)
+        self.save(expected, False)
+        self.save(self.sharded, True)
+        # script is loaded into every shard on NOSCRIPT
+        for shard in self.shards:
+            self.assertTrue(shard.keys())
+            self.assertEqual(shard.script_exists(
+                UtmMetrics(1, self.date, self.sharded)._get_utm_script().sha),
+                [True])
+        self.save(self.sharded, True, pipeline=True)
+        self.assertEqual(self.get_data(), dump(expected))
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is required for SCAN cursor')
+class MigrateKeysTestCase(MetricsTestCase):
+    def test_migrate(self):
+        source = fakeredis.FakeStrictRedis(decode_responses=True)
+        self.set_options(retention_days=30)
+        for variant_id in range(1, 11):
+            VisitorMetrics(variant_id, self.date, source).save_goal(
+                ['1.2.3.4'])
+        keys = len(source.keys('metrics:*'))
+
+        shards = [fakeredis.FakeStrictRedis(decode_responses=True),
+                  fakeredis.FakeStrictRedis(decode_responses=True)]
+        sharded = ShardedRedis(shards)
+        self.assertEqual(migrate_keys(source, sharded, 'metrics:*'), keys - 1)
+        # variants hash is not re-keyed
+        self.assertEqual(source.keys('metrics:*'),
+                         ['metrics:%s:variants' % self.date])
+        self.assertTrue(shards[0].keys() and shards[1].keys())
+
+        self.set_options(hash_tag=True)
+        for variant_id in range(1, 11):
+            visitor = VisitorMetrics(variant_id, self.date, sharded,
+                                     save_variant=False)
+            self.assertEqual(visitor.get_goals(), '1')
+            self.assertTrue(sharded.ttl(visitor._get_redis_key(
+                visitor.goals_key)) > 0)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from redis import StrictRedis
+from redis.exceptions import ResponseError
+
+from metrics import MetricsAbstract, MetricsBatch, UtmMetrics, VisitorMetrics
+from metrics.compact import convert_day
+from metrics.sharding import ShardedRedis
+from metrics.storage import MemoryStorage, StorageBackend
+
+from tests.base import MetricsTestCase, dump
+
+
+UTM_PARAMS = {'utm_medium': 'cpc', 'utm_campaign': 'sale', 'utm_term': 'a'}
+AD_PARAMS = {'ad_id': 1, 'ad_type': 1, 'ad_label': 'f'}
+
+
+class StorageBackendTestCase(unittest.TestCase):
+    def test_clients(self):
+        self.assertTrue(isinstance(MemoryStorage(), StorageBackend))
+        self.assertTrue(isinstance(StrictRedis(), StorageBackend))
+        self.assertTrue(isinstance(ShardedRedis([]), StorageBackend))
+        self.assertFalse(isinstance(object(), StorageBackend))
+        self.assertEqual(StorageBackend.get_missing(StrictRedis()), [])
+        self.assertIn('hincrby', StorageBackend.get_missing(object()))
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, StorageBackend)
+
+        class Partial(StorageBackend):
+            def get(self, name):
+                return None
+        self.assertRaises(TypeError, Partial)
+
+
+class MemoryStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.redis = MemoryStorage()
+
+    def test_replies(self):
+        redis = self.redis
+        self.assertEqual(redis.incrby('a', 2), 2)
+        self.assertEqual(redis.get('a'), '2')
+        self.assertEqual(redis.hincrby('h', 5, 3), 3)
+        self.assertEqual(redis.hgetall('h'), {'5': '3'})
+        self.assertEqual(redis.lpush('l', 1, 2, 3), 3)
+        self.assertEqual(redis.lrange('l', 0, -1), ['3', '2', '1'])
+        redis.ltrim('l', 0, 1)
+        self.assertEqual(redis.lrange('l', 0, -1), ['3', '2'])
+        self.assertEqual(redis.pfadd('u', 'x', 'y'), 1)
+        self.assertEqual(redis.pfcount('u'), 2)
+        redis.execute_command('ZINCRBY', 'z', 2, 'm')
+        redis.execute_command('ZADD', 'z', 1, 'n')
+        self.assertEqual(redis.zrevrange('z', 0, -1, withscores=True),
+                         [('m', 2.0), ('n', 1.0)])
+        self.assertEqual(redis.type('u'), 'string')
+        self.assertRaises(ResponseError, redis.hget, 'l', 'x')
+
+    def test_expire(self):
+        self.redis.set('a', 1)
+        self.assertFalse(self.redis.expire('missing', 10))
+        self.assertTrue(self.redis.expire('a', 10))
+        self.assertEqual(self.redis.ttl('a'), 10)
+        self.assertEqual(self.redis.ttl('missing'), -2)
+        self.redis.expireat('a', 1)
+        self.assertEqual(self.redis.exists('a'), 0)
+
+    def test_pipeline(self):
+        pipe = self.redis.pipeline()
+        pipe.incr('a').hset('h', 'f', 'v').get('a')
+        self.assertEqual(len(pipe), 3)
+        self.assertEqual(pipe.execute(), [1, 1, '1'])
+        self.assertEqual(len(pipe), 0)
+
+        # failed command doesn't stop others
+        pipe.incr('h').incr('a')
+        self.assertRaises(ResponseError, pipe.execute)
+        self.assertEqual(self.redis.get('a'), '2')
+        pipe.incr('h').incr('a')
+        error, reply = pipe.execute(raise_on_error=False)
+        self.assertTrue(isinstance(error, ResponseError))
+        self.assertEqual(reply, 3)
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'snapshot.pickle')
+            with MemoryStorage(path) as redis:
+                redis.setex('a', 100, 'x')
+                redis.hincrby('h', 'f')
+            redis = MemoryStorage(path)
+            self.assertEqual(redis.get('a'), 'x')
+            self.assertTrue(0 < redis.ttl('a') <= 100)
+            self.assertEqual(redis.hgetall('h'), {'f': '1'})
+        finally:
+            shutil.rmtree(directory)
+
+
+class ScriptsTestCase(MetricsTestCase):
+    def test_utm_script(self):
+        for use_script in (False, True):
+            UtmMetrics(1, self.date, self.redis,
+                       use_script=use_script).save_utm(
+                           1, UTM_PARAMS, AD_PARAMS, 2)
+        utm = UtmMetrics(1, self.date, self.redis).get_utm()
+        self.assertEqual(
+            utm['1']['utm_medium']['cpc']['utm_campaign']['sale'][
+                'terms']['a']['goals'], '2')
+
+        batch = MetricsBatch(self.redis)
+        batch.bind(UtmMetrics, 1, self.date, use_script=True).save_utm(
+            1, UTM_PARAMS, AD_PARAMS, 2)
+        batch.execute()
+        utm = UtmMetrics(1, self.date, self.redis).get_utm()
+        self.assertEqual(utm['1']['utm_medium']['cpc']['goals'], '3')
+
+    def test_compact_move_script(self):
+        VisitorMetrics(1, self.date, self.redis).save_visitor(
+            1, ['1.2.3.4', 1, None])
+        self.set_options([VisitorMetrics], compact=True)
+        self.assertTrue(convert_day(self.redis, self.date))
+        metrics = VisitorMetrics(1, self.date, self.redis)
+        self.assertEqual(metrics.get_visits(), '1')
+        self.assertEqual(metrics.get_unique(), '1')
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is required')
+class ParityTestCase(MetricsTestCase):
+    """
+    Data of metrics classes is the same in memory & in redis
+    """
+    def save(self, redis):
+        data = ['1.2.3.4', 1, None]
+        visitor = VisitorMetrics(1, self.date, redis, details_limit=10)
+        visitor.save_visitor(1, data, fingerprint='x')
+        visitor.save_goal(data)
+        visitor.save_additional(**AD_PARAMS)
+        utm = UtmMetrics(1, self.date, redis)
+        utm.save_visit_with_utm(1, 3, dict(UTM_PARAMS))
+        UtmMetrics(1, self.date, redis).save_utm_goal(
+            3, dict(UTM_PARAMS), AD_PARAMS)
+
+    def test_parity(self):
+        self.set_options(retention_days=30, top_index=True)
+        self.save(self.redis)
+        MetricsAbstract.retention_cache.clear()
+        expected = fakeredis.FakeStrictRedis(decode_responses=True)
+        self.save(expected)
+        self.assertEqual(dump(self.redis), dump(expected))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+from calendar import timegm
+from datetime import datetime
+
+from redis.exceptions import ConnectionError
+
+from metrics.cache import LocalCache
+from metrics.observer import CountingRedis
+from metrics.timeseries import TimeSeries
+
+from tests.base import MetricsTestCase
+
+START = timegm(datetime(2014, 6, 1, 10, 0).utctimetuple())
+
+
+class TimeSeriesTestCase(MetricsTestCase):
+    def setUp(self):
+        super(TimeSeriesTestCase, self).setUp()
+        self._expire_cache = TimeSeries.expire_cache
+        TimeSeries.expire_cache = LocalCache(maxsize=1000, ttl=3600)
+
+    def tearDown(self):
+        TimeSeries.expire_cache = self._expire_cache
+        super(TimeSeriesTestCase, self).tearDown()
+
+    def save(self, series):
+        # every 10 minutes from 10:00 till 11:50
+        for i in range(12):
+            series.save_visitor(i % 2, START + i * 600)
+        series.save_goal(START + 59)
+        series.save_lead(datetime(2014, 6, 1, 11, 30))
+        series.decrease_lead(START + 7200 - 1)
+
+    def series(self, start, end, step):
+        data = TimeSeries(self.redis, 1, resolution=300).get_range(
+            start, end, step)
+        return dict((name, list(values)) for name, values in data.items())
+
+    def test_resolutions(self):
+        self.save(TimeSeries(self.redis, 1, resolution=300))
+        fine = self.series(START, START + 1799, 'fine')
+        self.assertEqual(fine['timestamps'],
+                         [START + i * 300 for i in range(6)])
+        self.assertEqual(fine['visits'], [1, 0, 1, 0, 1, 0])
+        self.assertEqual(fine['unique'], [0, 0, 1, 0, 0, 0])
+        self.assertEqual(fine['goals'], [1, 0, 0, 0, 0, 0])
+
+        hours = self.series(START - 3600, START + 7199, 'hour')
+        self.assertEqual(hours['timestamps'],
+                         [START - 3600, START, START + 3600])
+        self.assertEqual(hours['visits'], [0, 6, 6])
+        self.assertEqual(hours['unique'], [0, 3, 3])
+        self.assertEqual(hours['leads'], [0, 0, 0])
+
+        days = self.series(START, START, 'day')
+        self.assertEqual(days['timestamps'], [START - 10 * 3600])
+        self.assertEqual(days['visits'], [12])
+        self.assertEqual(days['goals'], [1])
+
+    def test_single_round_trip(self):
+        counter = CountingRedis(self.redis)
+        series = TimeSeries(counter, 1)
+        series.save_visitor(1, START)
+        self.assertEqual(counter.round_trips, 1)
+        series.get_range(START - 86400, START + 86400, 'fine')
+        self.assertEqual(counter.round_trips, 2)
+
+    def test_ttl(self):
+        series = TimeSeries(self.redis, 1, fine_ttl=100, hour_ttl=1000)
+        series.save_visitor(1, START)
+        ttls = dict((key.split(':')[2], self.redis.ttl(key))
+                    for key in self.redis.keys('*'))
+        self.assertTrue(0 < ttls['fine60'] <= 100)
+        self.assertTrue(100 < ttls['hour'] <= 1000)
+        self.assertEqual(ttls['day'], -1)
+
+    def test_pipeline(self):
+        pipe = self.redis.pipeline(transaction=False)
+        series = TimeSeries(self.redis, 1, pipeline=pipe)
+        self.assertIsNone(series.save_visitor(1, START))
+        self.assertEqual(self.redis.keys('*'), [])
+        pipe.execute()
+        self.assertEqual(len(self.redis.keys('*')), 3)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            TimeSeries(self.redis, 1, resolution=7)
+        series = TimeSeries(self.redis, 1)
+        with self.assertRaises(ValueError):
+            series.add(['views'], START)
+        with self.assertRaises(ValueError):
+            series.get_range(START, START, 'week')
+
+    def test_types(self):
+        series = TimeSeries(self.redis, 1)
+        series.add(['visits', 'goals'], START, 2)
+        data = series.get_range(START, START, 'hour')
+        self.assertEqual((list(data['visits']), list(data['goals']),
+                          list(data['unique'])), ([2], [2], [0]))
+
+    def test_failed_expire_is_retried(self):
+        series = TimeSeries(self.redis, 1, fine_ttl=100)
+        pipeline = self.redis.pipeline
+
+        def failing_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+
+            def execute():
+                pipe.reset()
+                raise ConnectionError('failed')
+            pipe.execute = execute
+            return pipe
+        self.redis.pipeline = failing_pipeline
+        with self.assertRaises(ConnectionError):
+            series.save_visitor(1, START)
+        del self.redis.pipeline
+
+        series.save_visitor(1, START)
+        for key in self.redis.keys('*'):
+            if ':day:' not in key:
+                self.assertGreater(self.redis.ttl(key), 0, key)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from metrics import UtmMetrics, VisitorMetrics
+from metrics.sharding import ShardedRedis
+from metrics.storage import MemoryStorage
+from metrics.top import get_top_union, merge_top
+
+from tests.base import MetricsTestCase
+
+
+class TopTestCase(MetricsTestCase):
+    def setUp(self):
+        super(TopTestCase, self).setUp()
+        self.set_options(top_index=True)
+
+    def save_goals(self, redis, variant_id, goals):
+        """
+        Goals by ips & terms, {index: count}
+        """
+        for index, count in goals.items():
+            visitor = VisitorMetrics(variant_id, self.date, redis)
+            data = ['10.0.0.%s' % index, 'Mozilla', 'direct']
+            visitor.save_visitor(1, data)
+            utm = UtmMetrics(variant_id, self.date, redis)
+            params = {'utm_medium': 'cpc', 'utm_campaign': 'sale',
+                      'utm_term': 't%s' % index}
+            for _ in range(count):
+                visitor.save_goal(data)
+                utm.save_utm_goal(3, dict(params), None)
+
+    def test_top(self):
+        self.save_goals(self.redis, 1, {1: 3, 2: 1, 3: 5, 4: 0})
+        visitor = VisitorMetrics(1, self.date, self.redis)
+        self.assertEqual(visitor.top_geo(2), [
+            {'ip': '10.0.0.3', 'goals': 5, 'unique': 1},
+            {'ip': '10.0.0.1', 'goals': 3, 'unique': 1}])
+        self.assertEqual(visitor.top_geo(1, by='unique')[0]['unique'], 1)
+        utm = UtmMetrics(1, self.date, self.redis)
+        self.assertEqual(utm.top_terms(2), [
+            {'term': 't3', 'campaign': 'sale', 'medium': 'cpc',
+             'channel': '3', 'goals': 5},
+            {'term': 't1', 'campaign': 'sale', 'medium': 'cpc',
+             'channel': '3', 'goals': 3}])
+        self.assertEqual(utm.top_campaigns(1), [
+            {'campaign': 'sale', 'medium': 'cpc', 'channel': '3',
+             'goals': 9}])
+        with self.assertRaises(ValueError):
+            visitor.top_geo(1, by='visits')
+
+    def test_without_index(self):
+        self.save_goals(self.redis, 1, {1: 3, 2: 1, 3: 5})
+        self.set_options(top_index=False)
+        self.assertEqual(
+            VisitorMetrics(1, self.date, self.redis).top_geo(1),
+            [{'ip': '10.0.0.3', 'unique': 1, 'goals': 5}])
+
+    def get_keys(self, variant_ids):
+        return [VisitorMetrics._build_top_key(
+            self.date, variant_id, 'geo_goals')
+            for variant_id in variant_ids]
+
+    def assertUnion(self, redis):
+        self.save_goals(redis, 1, {1: 3, 2: 1})
+        self.save_goals(redis, 2, {2: 3, 3: 1})
+        keys = self.get_keys([1, 2])
+        self.assertEqual(get_top_union(redis, keys, 2),
+                         [('10.0.0.2', 4), ('10.0.0.1', 3)])
+        self.assertEqual(get_top_union(redis, keys[:1], 1),
+                         [('10.0.0.1', 3)])
+        self.assertEqual(get_top_union(redis, [], 1), [])
+        self.assertEqual(merge_top(redis, 'top', keys, ttl=60), 3)
+        self.assertTrue(0 < redis.ttl('top') <= 60)
+
+    def test_union(self):
+        self.assertUnion(self.redis)
+        self.assertEqual(self.redis.keys('top_union*'), [])
+
+    def test_sharded_union(self):
+        self.set_options(hash_tag=True)
+        self.assertUnion(ShardedRedis([MemoryStorage(), MemoryStorage()]))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from metrics import TotalMetrics
+from metrics.observer import CountingRedis
+
+from tests.base import MetricsTestCase
+
+
+class BulkTestCase(MetricsTestCase):
+    def save(self):
+        for page_id in range(1, 6):
+            total = TotalMetrics(page_id, self.redis)
+            for _ in range(page_id * 2):
+                total.save_unique()
+            for _ in range(page_id):
+                total.save_goal()
+
+    def assertBulk(self, chunk_size=1000):
+        counter = CountingRedis(self.redis)
+        data = TotalMetrics.get_bulk(counter, range(1, 8),
+                                     chunk_size=chunk_size)
+        self.assertEqual(counter.round_trips, 1)
+        self.assertEqual(data[3], {'unique': 6, 'goals': 3,
+                                   'conversion': 50.0})
+        self.assertEqual(data[7], {'unique': 0, 'goals': 0,
+                                   'conversion': 0.0})
+        for page_id in range(1, 6):
+            total = TotalMetrics(page_id, self.redis, save_variant=False)
+            self.assertEqual(data[page_id]['conversion'],
+                             total.get_conversion())
+
+    def test_bulk(self):
+        self.save()
+        self.assertBulk()
+        self.assertBulk(chunk_size=2)
+
+    def test_compact(self):
+        self.set_options([TotalMetrics], compact=True)
+        self.save()
+        self.assertTrue(self.redis.keys('*packed'))
+        self.assertBulk()
+
+    @unittest.skipIf(numpy is None, 'NumPy is required')
+    def test_array(self):
+        self.save()
+        data = TotalMetrics.get_bulk(self.redis, [1, 2, 9], as_array=True)
+        self.assertEqual(data['unique'].tolist(), [2, 4, 0])
+        self.assertEqual(data['goals'].tolist(), [1, 2, 0])
+        self.assertEqual(data['conversion'].tolist(), [50.0, 50.0, 0.0])
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import lupa
+except ImportError:
+    lupa = None
+
+from metrics import MetricsAbstract, MetricsBatch, UtmMetrics
+from metrics.facade import MetricsFacade, UtmFacade
+from metrics.observer import CountingRedis
+
+from tests.base import MetricsTestCase, dump
+
+
+class EncodeParamsTestCase(MetricsTestCase):
+    """
+    Utm params are written as native strings
+    """
+    def get_fields(self):
+        key = UtmMetrics._build_redis_key(
+            self.date, 1, UtmMetrics.utm_medium_key)
+        return sorted(self.redis.hgetall(key))
+
+    def test_native(self):
+        UtmMetrics(1, self.date, self.redis).save_utm(
+            3, {'utm_medium': u'реклама'}, None)
+        self.assertEqual(self.get_fields(), [u'реклама:3:0'])
+
+    def test_bytes(self):
+        UtmMetrics(1, self.date, self.redis).save_utm(
+            3, {'utm_medium': u'реклама'.encode('utf-8')}, None)
+        self.assertEqual(self.get_fields(), [u'реклама:3:0'])
+        utm = UtmMetrics(1, self.date, self.redis).get_utm()
+        self.assertIn(u'реклама', utm['3']['utm_medium'])
+
+    def test_facade(self):
+        MetricsFacade.variants_cache.clear()
+        UtmMetrics(1, self.date, self.redis).save_utm(
+            3, {'utm_medium': b'cpc', 'utm_term': None}, None)
+        expected = dump(self.redis)
+        self.redis.flushdb()
+        UtmFacade(1, self.date, self.redis).save_utm(
+            3, {'utm_medium': 'cpc', 'utm_term': None}, None)
+        self.assertEqual(dump(self.redis), expected)
+        MetricsFacade.variants_cache.clear()
+
+
+SAVES = (
+    (3, {'utm_medium': 'cpc', 'utm_campaign': 'sale', 'utm_term': 'a'},
+     None, 0, 1),
+    (3, {'utm_medium': 'cpc', 'utm_campaign': 'sale', 'utm_term': 'a'},
+     {'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'}, 2, 1),
+    (3, {'utm_medium': 'cpc', 'utm_campaign': None, 'utm_term': 'b'},
+     {'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'}, 2, -1),
+    (4, {'utm_medium': None, 'utm_campaign': None, 'utm_term': None},
+     None, 1, 1),
+)
+
+
+@unittest.skipIf(fakeredis is None or lupa is None,
+                 'fakeredis & lupa are required for Lua scripts')
+class UtmScriptTestCase(MetricsTestCase):
+    """
+    Lua script is run by fakeredis and writes the same data
+    as hash-by-hash writes of pipeline
+    """
+    def save(self, redis, use_script, pipeline=False):
+        MetricsAbstract.retention_cache.clear()
+        batch = MetricsBatch(redis)
+        for channel_id, params, additional, count_type, amount in SAVES:
+            if pipeline:
+                utm = batch.bind(UtmMetrics, 1, self.date,
+                                 use_script=use_script)
+            else:
+                utm = UtmMetrics(1, self.date, redis, use_script=use_script)
+            utm.save_utm(channel_id, dict(params), additional, count_type,
+                         amount)
+        batch.execute()
+        return dump(redis)
+
+    def assertScript(self):
+        expected = self.save(fakeredis.FakeStrictRedis(
+            decode_responses=True), False, pipeline=True)
+        self.assertTrue(expected)
+        for pipeline in (False, True):
+            redis = fakeredis.FakeStrictRedis(decode_responses=True)
+            self.assertEqual(self.save(redis, True, pipeline), expected)
+            sha = UtmMetrics(1, self.date, redis)._get_utm_script().sha
+            self.assertEqual(redis.script_exists(sha), [True])
+
+    def test_script(self):
+        self.assertScript()
+
+    def test_options(self):
+        self.set_options(retention_days=30, top_index=True)
+        self.assertScript()
+        self.set_options(hash_tag=True, compact=True)
+        self.assertScript()
+
+
+class GetUtmTestCase(MetricsTestCase):
+    def test_single_round_trip(self):
+        params = {'utm_medium': 'cpc', 'utm_campaign': 'sale'}
+        for term in range(20):
+            params['utm_term'] = 't%s' % term
+            UtmMetrics(1, self.date, self.redis).save_visit_with_utm(
+                term % 2, 3, dict(params))
+        UtmMetrics(1, self.date, self.redis).save_utm_goal(
+            3, dict(params), {'ad_id': 1, 'ad_type': 2, 'ad_label': 'form'})
+
+        counter = CountingRedis(self.redis)
+        utm = UtmMetrics(
+            1, self.date, counter, save_variant=False).get_utm()
+        self.assertEqual(counter.round_trips, 1)
+
+        channel = utm['3']
+        self.assertEqual((channel['visits'], channel['unique']), ('20', '10'))
+        campaign = channel['utm_medium']['cpc']['utm_campaign']['sale']
+        self.assertEqual(len(campaign['terms']), 20)
+        self.assertEqual(campaign['terms']['t19']['goals'], '1')
+        self.assertEqual(campaign['terms']['t19']['additional'], [
+            {'count': '1', 'id': '1', 'label': 'form', 'type': '2'}])
+        self.assertNotIn('goals', campaign['terms']['t0'])
+
+    def test_empty(self):
+        counter = CountingRedis(self.redis)
+        self.assertEqual(UtmMetrics(
+            1, self.date, counter, save_variant=False).get_utm(), {})
+        self.assertEqual(counter.round_trips, 1)
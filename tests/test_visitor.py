@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from operator import itemgetter
+
+from metrics import VisitorMetrics
+from metrics.observer import CountingRedis
+
+from tests.base import MetricsTestCase
+
+
+class GeoTestCase(MetricsTestCase):
+    def setUp(self):
+        super(GeoTestCase, self).setUp()
+        for i in range(30):
+            visitor = VisitorMetrics(1, self.date, self.redis)
+            data = ['10.0.0.%s' % (i % 10), 'Mozilla', 'direct']
+            visitor.save_visitor(1, data)
+            if i % 10 < 3:
+                for _ in range(i % 10 + 1):
+                    visitor.save_goal(data)
+
+    def get_visitor(self, redis=None):
+        return VisitorMetrics(1, self.date, redis or self.redis,
+                              save_variant=False)
+
+    def test_get_geo(self):
+        counter = CountingRedis(self.redis)
+        rows = self.get_visitor(counter).get_geo()
+        self.assertEqual(counter.round_trips, 1)
+        self.assertEqual(len(rows), 10)
+        self.assertIn({'ip': '10.0.0.2', 'unique': 3, 'goals': 9}, rows)
+        self.assertIn({'ip': '10.0.0.9', 'unique': 3, 'goals': 0}, rows)
+
+    def test_order(self):
+        rows = self.get_visitor().get_geo(limit=2, order_by='goals')
+        self.assertEqual([row['ip'] for row in rows],
+                         ['10.0.0.2', '10.0.0.1'])
+        self.assertEqual(len(self.get_visitor().get_geo(limit=4)), 4)
+
+    def test_iter_geo(self):
+        visitor = self.get_visitor()
+        rows = list(visitor.iter_geo(chunk_size=3))
+        key = itemgetter('ip')
+        self.assertEqual(sorted(rows, key=key),
+                         sorted(visitor.get_geo(), key=key))
+        self.assertEqual(len(list(visitor.iter_geo(limit=5, chunk_size=3))),
+                         5)
+        self.assertEqual(visitor.get_top_geo(2, chunk_size=3),
+                         visitor.get_geo(limit=2, order_by='goals'))
+
+
+class DetailsTestCase(MetricsTestCase):
+    def save(self, count, **options):
+        visitor = VisitorMetrics(1, self.date, self.redis, **options)
+        for i in range(count):
+            visitor.save_visitor(1, ['10.0.0.%s' % i, i, 'direct'])
+        return VisitorMetrics(1, self.date, self.redis, save_variant=False)
+
+    def test_pages(self):
+        visitor = self.save(12)
+        details = list(visitor.get_details(page_size=5))
+        self.assertEqual([row['time'] for row in details],
+                         list(range(11, -1, -1)))
+        self.assertEqual(details[0],
+                         {'ip': '10.0.0.11', 'time': 11, 'channel': 'direct'})
+        rows = list(visitor.get_details(offset=3, limit=4, page_size=3))
+        self.assertEqual([row['time'] for row in rows], [8, 7, 6, 5])
+        self.assertEqual(list(visitor.get_details(offset=20)), [])
+        self.assertEqual(visitor.get_details_count(), 12)
+        self.assertEqual(visitor.get_details_overflow(), 0)
+
+    def test_limit(self):
+        visitor = self.save(12, details_limit=5)
+        self.assertEqual(visitor.get_details_count(), 5)
+        self.assertEqual(visitor.get_details_overflow(), 7)
+        self.assertEqual([row['time'] for row in visitor.get_details()],
+                         [11, 10, 9, 8, 7])
+
+    def test_pages_are_streamed(self):
+        self.save(12)
+        counter = CountingRedis(self.redis)
+        details = VisitorMetrics(
+            1, self.date, counter, save_variant=False).get_details(
+                page_size=5)
+        next(details)
+        self.assertEqual(counter.round_trips, 1)
+        self.assertEqual(len(list(details)), 11)
+        self.assertEqual(counter.round_trips, 3)